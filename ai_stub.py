@@ -0,0 +1,173 @@
+"""
+Локальная заглушка AI-провайдеров для проверок без сети и ключей.
+
+Отвечает на запросы OpenAI (/v1/chat/completions), Anthropic (/v1/messages)
+и YandexGPT (/foundationModels/v1/completion) в их форматах — обычном
+и потоковом. Ядро направляется на заглушку переменной окружения:
+
+    python ai_stub.py --порт 8765 --первый 0.5 --пауза 0.02
+    SVETOFOR_AI_URL=http://127.0.0.1:8765 streamlit run app.py
+
+Из кода: сервер = ai_stub.запустить(), адрес — сервер.адрес.
+"""
+
+import argparse, json, re, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+ОТВЕТ_ПО_УМОЛЧАНИЮ = """## 1. ЧТО ЭТО
+Договор транспортно-экспедиционного обслуживания (заглушка AI).
+
+## 2. КРИТИЧЕСКИЕ ПУНКТЫ
+- **Пункт 5.3** — ответственность Заказчика не ограничена
+- ❌ Риск: неограниченные убытки
+- ✅ Исправить: "Ответственность Заказчика ограничена суммой Договора"
+
+## 3. ЗАМЕЧАНИЯ
+Замечаний нет.
+
+## 4. РЕКОМЕНДАЦИЯ
+⚠️ С ЗАМЕЧАНИЯМИ
+"""
+
+
+def нарезать(текст: str):
+    # Куски по слову с пробелами — примерно как токены у настоящих API
+    return re.findall(r"\S+\s*|\s+", текст)
+
+
+class ОбработчикЗаглушки(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        настройки = self.server.настройки
+        тело = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        with self.server.замок:
+            self.server.запросов += 1
+            self.server.последний_запрос = {"путь": self.path, "тело": тело}
+
+        if self.path.endswith("/v1/chat/completions"):
+            провайдер, поток = "openai", тело.get("stream", False)
+        elif self.path.endswith("/v1/messages"):
+            провайдер, поток = "anthropic", тело.get("stream", False)
+        elif self.path.endswith("/foundationModels/v1/completion"):
+            провайдер, поток = "yandexgpt", тело.get("completionOptions", {}).get("stream", False)
+        else:
+            return self._ответить(404, {"error": {"message": "not found"}})
+
+        if настройки["ошибка"]:
+            return self._ответить(настройки["ошибка"], {"error": {"message": "stub error"}})
+
+        time.sleep(настройки["первый"])
+        текст = настройки["ответ"]
+        if not поток:
+            return self._ответить(200, self._целиком(провайдер, текст))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if провайдер == "yandexgpt" else "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        накоплено = ""
+        try:
+            for i, кусок in enumerate(нарезать(текст)):
+                if i:
+                    time.sleep(настройки["пауза"])
+                накоплено += кусок
+                self._кусок(self._событие(провайдер, кусок, накоплено))
+            if провайдер == "openai":
+                self._кусок("data: [DONE]\n\n")
+            elif провайдер == "anthropic":
+                self._кусок('event: message_stop\ndata: {"type": "message_stop"}\n\n')
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент отменил запрос (проигравший хедж, закрытая вкладка)
+            self.close_connection = True
+
+    @staticmethod
+    def _целиком(провайдер: str, текст: str) -> Dict:
+        if провайдер == "openai":
+            return {"choices": [{"message": {"role": "assistant", "content": текст}}]}
+        if провайдер == "anthropic":
+            return {"content": [{"type": "text", "text": текст}]}
+        return {"result": {"alternatives": [{"message": {"role": "assistant", "text": текст},
+                                             "status": "ALTERNATIVE_STATUS_FINAL"}]}}
+
+    @staticmethod
+    def _событие(провайдер: str, кусок: str, накоплено: str) -> str:
+        if провайдер == "openai":
+            return "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": кусок}}]}) + "\n\n"
+        if провайдер == "anthropic":
+            return ("event: content_block_delta\ndata: " + json.dumps(
+                {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": кусок}}) + "\n\n")
+        # YandexGPT: построчный JSON с накопленным текстом
+        return json.dumps({"result": {"alternatives": [{"message": {"role": "assistant", "text": накоплено},
+                                                        "status": "ALTERNATIVE_STATUS_PARTIAL"}]}}) + "\n"
+
+    def _кусок(self, данные: str):
+        байты = данные.encode("utf-8")
+        self.wfile.write(f"{len(байты):x}\r\n".encode() + байты + b"\r\n")
+        self.wfile.flush()
+
+    def _ответить(self, код: int, тело: Dict):
+        байты = json.dumps(тело).encode("utf-8")
+        self.send_response(код)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(байты)))
+        self.end_headers()
+        self.wfile.write(байты)
+
+
+class СерверЗаглушки(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, адрес, настройки: Dict):
+        super().__init__(адрес, ОбработчикЗаглушки)
+        self.настройки = настройки
+        self.замок = threading.Lock()
+        self.запросов = 0
+        self.последний_запрос: Optional[Dict] = None
+
+    def handle_error(self, request, client_address):
+        # Обрыв соединения клиентом — штатная ситуация, а не ошибка заглушки
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def адрес(self) -> str:
+        хост, порт = self.server_address[:2]
+        return f"http://{хост}:{порт}"
+
+
+def запустить(порт: int = 0, первый: float = 0.0, пауза: float = 0.0, ошибка: int = 0,
+              ответ: str = ОТВЕТ_ПО_УМОЛЧАНИЮ) -> СерверЗаглушки:
+    """Запуск в фоновом потоке; порт 0 — любой свободный. Остановка: сервер.shutdown()."""
+    сервер = СерверЗаглушки(("127.0.0.1", порт),
+                            {"первый": первый, "пауза": пауза, "ошибка": ошибка, "ответ": ответ})
+    threading.Thread(target=сервер.serve_forever, daemon=True).start()
+    return сервер
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI/Anthropic/YandexGPT")
+    parser.add_argument("--порт", type=int, default=8765)
+    parser.add_argument("--первый", type=float, default=0.3, help="задержка до первого токена, с")
+    parser.add_argument("--пауза", type=float, default=0.02, help="пауза между кусками ответа, с")
+    parser.add_argument("--ошибка", type=int, default=0, help="отвечать этим HTTP-кодом (0 — без ошибок)")
+    args = parser.parse_args(argv)
+
+    сервер = СерверЗаглушки(("127.0.0.1", args.порт),
+                            {"первый": args.первый, "пауза": args.пауза, "ошибка": args.ошибка,
+                             "ответ": ОТВЕТ_ПО_УМОЛЧАНИЮ})
+    print(f"Заглушка AI: {сервер.адрес} (SVETOFOR_AI_URL={сервер.адрес})", file=sys.stderr)
+    try:
+        сервер.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
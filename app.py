@@ -9,32 +9,17 @@
 """
 
 import streamlit as st
-import re, json, hashlib, io, time
-from datetime import datetime, date
-from typing import Dict, List, Tuple, Optional
-
-# Библиотеки
-DOCX_AVAILABLE = False
-PDF_AVAILABLE = False
-REQUESTS_AVAILABLE = False
-
-try:
-    from docx import Document as DocxDocument
-    DOCX_AVAILABLE = True
-except:
-    pass
-
-try:
-    from PyPDF2 import PdfReader
-    PDF_AVAILABLE = True
-except:
-    pass
-
-try:
-    import requests
-    REQUESTS_AVAILABLE = True
-except:
-    pass
+import re, os, hashlib, io, time
+from datetime import datetime, timedelta
+
+from core import (
+    DEFAULT_ORG, DEFAULT_THRESHOLDS, AI_ПРОВАЙДЕРЫ, КРАСНАЯ_ЗОНА, ЖЁЛТАЯ_ЗОНА, ФОРМЫ_ДОКУМЕНТА,
+    ТИПОВЫЕ_ФОРМЫ, ДЕМО_ДОГОВОР, ОХВАТ_ПРАВИЛА, БЮДЖЕТ_ПРАВИЛА_МС, ЗОНЫ, МАКС_СИМВОЛОВ_ДОКУМЕНТА,
+    извлечь_все_данные, набор_правил, анализ_rag, анализ_rag_изменений, изменённые_пункты, определить_зону, ai_анализ_поток, разобрать_загрузку,
+    СимуляторПорогов, кэш_ai, планировщик_ai, оценка_анализа, очередь_ai,
+    ограничитель_ai, метрики_prometheus, запустить_экспорт_метрик,
+)
+from history import архив, запись_анализа, РАЗМЕР_СТРАНИЦЫ
 
 # Настройки
 st.set_page_config(
@@ -51,103 +36,28 @@ st.set_page_config(
 РОЛЬ_АДМИН = "администратор"
 РОЛЬ_ЮЗЕР = "пользователь"
 
-DEFAULT_ORG = {
-    "full_name": 'АО «Старая перевозочная компания»',
-    "short_name": 'АО «СПК»',
-    "inn": "7701234567",
-}
-
-DEFAULT_THRESHOLDS = {
-    "зелёная_тф_макс": 100_000,
-    "зелёная_нетф_макс": 50_000,
-    "жёлтая_макс": 5_000_000,
-}
-
 ПОЛЬЗОВАТЕЛИ = {
     "admin": {"хеш": hashlib.sha256("admin123".encode()).hexdigest(), "роль": РОЛЬ_АДМИН, "имя": "Администратор"},
     "legal": {"хеш": hashlib.sha256("legal123".encode()).hexdigest(), "роль": РОЛЬ_АДМИН, "имя": "Руководитель ЮД"},
 }
 
-AI_ПРОВАЙДЕРЫ = {
-    "openai": {"название": "OpenAI GPT-4", "url": "https://platform.openai.com/api-keys", "цена": "$0.15/1M"},
-    "anthropic": {"название": "Anthropic Claude", "url": "https://console.anthropic.com/settings/keys", "цена": "$0.25/1M"},
-    "gigachat": {"название": "GigaChat", "url": "https://developers.sber.ru/portal/products/gigachat-api", "цена": "Бесплатно"},
-    "yandexgpt": {"название": "YandexGPT", "url": "https://console.cloud.yandex.ru/", "цена": "1.2₽/1000"},
-}
-
 ПОДРАЗДЕЛЕНИЯ = ["Юридический департамент", "Департамент перевозок", "Коммерческий департамент", 
                  "Департамент подвижного состава", "Финансовый департамент", "ИТ-департамент"]
 ДОЛЖНОСТИ = ["Специалист", "Ведущий специалист", "Начальник отдела", "Руководитель департамента"]
 
-КРАСНАЯ_ЗОНА = ["Аренда вагонов", "Лизинг вагонов", "Покупка вагонов", "Договор с РЖД", "Кредит", "Займ"]
-ЖЁЛТАЯ_ЗОНА = ["Договор ТЭО", "Рамочный договор", "Единственный поставщик"]
-ФОРМЫ_ДОКУМЕНТА = ["Типовая форма (ТФ)", "Форма контрагента", "Свободная форма"]
+ОПРОС_ЗАДАЧ_С = 1.0   # как часто страница спрашивает статус фоновой AI-задачи
+СТРОК_НА_СТРАНИЦЕ = 25   # нарушения RAG в таблице за один раз
+ПРЕВЬЮ_ТЕКСТА = 50_000   # символов: длинный документ показывается началом, без правки
 
-# ============================================================================
-# ТИПОВЫЕ ФОРМЫ
-# ============================================================================
+ЗНАЧКИ_ЗОН = {"зелёная": "🟢", "жёлтая": "🟡", "красная": "🔴"}
+ПОРЯДКИ_ИСТОРИИ = {"Сначала новые": "новые", "Сначала старые": "старые",
+                   "По сумме": "сумма", "По контрагенту": "контрагент"}
 
-ТИПОВЫЕ_ФОРМЫ = {
-    "услуги_тэо": {
-        "название": "Договор ТЭО",
-        "код": "ТФ-СПК-001",
-        "роль": "Заказчик",
-        "маркеры": ["исполнитель", "заказчик", "услуги", "вагон", "перевозка"],
-        "пункты": {
-            "предоплата": {"эталон": "Предоплата не более 30%", "паттерн": r"предоплат\w*.*?(?:[4-9]\d|100)\s*%", "критичность": "красный"},
-            "срок_оплаты": {"эталон": "Оплата в течение 5 рабочих дней", "паттерн": r"оплат\w*.*?(?:1|2|3)\s*(?:рабоч|календарн|банковск)", "критичность": "жёлтый"},
-            "неустойка": {"эталон": "Неустойка не более 0.1% в день", "паттерн": r"неустойк\w*.*?(?:0[,.]?[3-9]|[1-9])\s*%", "критичность": "красный"},
-            "штраф_простой": {"эталон": "Штраф за простой не более 2500 руб/сутки", "паттерн": r"(?:штраф|простой).*?(?:[3-9]\d{3}|[1-9]\d{4,})\s*(?:руб|₽)", "критичность": "красный"},
-            "штраф_конфиденциальность": {"эталон": "Штраф за конфиденциальность не более 3 млн", "паттерн": r"(?:штраф|конфиденциальност).*?(?:[5-9]|[1-9]\d)\s*(?:000\s*000|млн)", "критичность": "красный"},
-            "все_риски": {"эталон": "Риски распределяются между сторонами", "паттерн": r"заказчик.*?(?:несёт|принимает).*?(?:все|любые|полн)\w*\s*риск", "критичность": "красный"},
-            "одностороннее_изменение": {"эталон": "Изменение цены по соглашению сторон", "паттерн": r"односторонн\w+.*?(?:изменен|повыш)\w*.*?(?:цен|тариф)", "критичность": "красный"},
-            "молчание_согласие": {"эталон": "Услуги приняты после подписания акта", "паттерн": r"молчани\w*.*?(?:согласи|акцепт|принят)", "критичность": "жёлтый"},
-            "без_ограничения": {"эталон": "Неустойка с ограничением 10%", "паттерн": r"без\s*(?:ограничен|лимит|предел)", "критичность": "жёлтый"},
-        }
-    },
-    "поставка": {
-        "название": "Договор поставки",
-        "код": "ТФ-СПК-002",
-        "роль": "Покупатель",
-        "маркеры": ["поставщик", "покупатель", "товар", "поставка"],
-        "пункты": {
-            "предоплата": {"эталон": "Предоплата не более 30%", "паттерн": r"предоплат\w*.*?(?:[4-9]\d|100)\s*%", "критичность": "красный"},
-            "гарантия": {"эталон": "Гарантия не менее 12 месяцев", "паттерн": r"гарантия.*?(?:[1-6])\s*месяц", "критичность": "жёлтый"},
-        }
-    },
-}
-
-ДЕМО_ДОГОВОР = """ДОГОВОР ОКАЗАНИЯ УСЛУГ № 2025/ТЭО-001
-
-г. Москва                                           «15» января 2025 г.
-
-ООО «ТрансЛогистик» (ИНН 7707999888), именуемое «Исполнитель», и
-АО «СПК» (ИНН 7701234567), именуемое «Заказчик», заключили договор:
-
-1. ПРЕДМЕТ ДОГОВОРА
-1.1. Исполнитель оказывает услуги по предоставлению вагонов для перевозки грузов.
-
-2. СТОИМОСТЬ И РАСЧЁТЫ
-2.1. Стоимость: 8 500 000 рублей.
-2.2. Предоплата 50% в течение 5 дней.
-2.3. Оплата в течение 3 календарных дней после счёта.
-2.4. Исполнитель вправе в одностороннем порядке изменять тарифы.
-
-3. ПРИЁМКА
-3.1. Молчание Заказчика более 3 дней считается согласием с актом.
-
-4. ОТВЕТСТВЕННОСТЬ
-4.1. Штраф за простой 5000 рублей за вагоно-сутки.
-4.2. Неустойка 0,5% за день без ограничения.
-4.3. Заказчик несёт все риски по вагонам.
-
-5. КОНФИДЕНЦИАЛЬНОСТЬ
-5.1. Штраф за нарушение: 15 000 000 рублей.
-
-РЕКВИЗИТЫ:
-Заказчик: АО «СПК», ИНН 7701234567
-Исполнитель: ООО «ТрансЛогистик», ИНН 7707999888
-"""
+# Экспорт метрик AI для Prometheus: один сервер на процесс, переживает перезапуски скрипта.
+# Слушает 127.0.0.1; другой интерфейс — только явно, через SVETOFOR_METRICS_HOST
+if os.environ.get("SVETOFOR_METRICS_PORT"):
+    запустить_экспорт_метрик(int(os.environ["SVETOFOR_METRICS_PORT"]),
+                             os.environ.get("SVETOFOR_METRICS_HOST") or "127.0.0.1")
 
 # ============================================================================
 # СТИЛИ В СТИЛЕ НПК (СВЕТЛЫЙ, КРАСНЫЙ АКЦЕНТ)
@@ -590,307 +500,28 @@ def применить_стили():
 </style>
 """, unsafe_allow_html=True)
 
-# ============================================================================
-# ЭКСТРАКТОР ДАННЫХ
-# ============================================================================
-
-def извлечь_дату(текст: str):
-    месяцы = {'января':1,'февраля':2,'марта':3,'апреля':4,'мая':5,'июня':6,
-              'июля':7,'августа':8,'сентября':9,'октября':10,'ноября':11,'декабря':12}
-    m = re.search(r'«?(\d{1,2})»?\s*([а-яё]+)\s*(\d{4})', текст.lower())
-    if m:
-        try:
-            return date(int(m.group(3)), месяцы.get(m.group(2), 1), int(m.group(1)))
-        except:
-            pass
-    m = re.search(r'(\d{1,2})\.(\d{1,2})\.(\d{4})', текст)
-    if m:
-        try:
-            return date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
-        except:
-            pass
-    return None
-
-
-def извлечь_номер(текст: str):
-    m = re.search(r'№\s*([A-Za-zА-Яа-я0-9\-/]+)', текст[:500])
-    if m and len(m.group(1).strip()) >= 3:
-        return m.group(1).strip()
-    return None
-
-
-def извлечь_сумму(текст: str):
-    m = re.search(r'(\d[\d\s]*\d)\s*(?:\([^)]+\))?\s*руб', текст.lower())
-    if m:
-        try:
-            return float(re.sub(r'\s', '', m.group(1)))
-        except:
-            pass
-    return None
-
-
-def извлечь_контрагента(текст: str):
-    юрлица = re.findall(r'((?:ООО|ОАО|ЗАО|ПАО|АО)\s*[«"]([^»"]+)[»"])', текст)
-    for полное, название in юрлица:
-        if 'СПК' not in название.upper() and 'СТАРАЯ' not in название.upper():
-            return полное
-    return None
-
-
-def определить_тип_документа(текст: str):
-    текст_l = текст[:2000].lower()
-    if "договор" in текст_l or "контракт" in текст_l:
-        if "услуг" in текст_l and ("вагон" in текст_l or "перевоз" in текст_l):
-            return {"тип": "услуги_тэо", "название": "Договор ТЭО", "это_договор": True}
-        elif "поставк" in текст_l:
-            return {"тип": "поставка", "название": "Договор поставки", "это_договор": True}
-        return {"тип": "иной", "название": "Договор", "это_договор": True}
-    if "счёт" in текст_l or "счет" in текст_l:
-        return {"тип": "счёт", "название": "Счёт на оплату", "это_договор": False}
-    if "акт" in текст_l[:200]:
-        return {"тип": "акт", "название": "Акт", "это_договор": False}
-    return {"тип": "неизвестно", "название": "Документ", "это_договор": False}
-
-
-def извлечь_все_данные(текст: str):
-    return {
-        "тип_док": определить_тип_документа(текст),
-        "дата": извлечь_дату(текст),
-        "номер": извлечь_номер(текст),
-        "сумма": извлечь_сумму(текст),
-        "контрагент": извлечь_контрагента(текст),
-    }
-
-
-# ============================================================================
-# RAG АНАЛИЗАТОР
-# ============================================================================
-
-def анализ_rag(текст: str, код_тф: str):
-    результат = {
-        "успех": False, "название_тф": "", "нарушения": [],
-        "красных": 0, "жёлтых": 0, "соответствие": 100, "вердикт": "", "резюме": ""
-    }
-    
-    все_тф = {**ТИПОВЫЕ_ФОРМЫ, **st.session_state.get("пользовательские_тф", {})}
-    if код_тф not in все_тф:
-        результат["резюме"] = "Типовая форма не найдена"
-        return результат
-    
-    тф = все_тф[код_тф]
-    результат["название_тф"] = тф.get("название", "")
-    результат["успех"] = True
-    текст_l = текст.lower()
-    
-    for название, данные in тф.get("пункты", {}).items():
-        паттерн = данные.get("паттерн", "")
-        if not паттерн:
-            continue
-        try:
-            match = re.search(паттерн, текст_l, re.IGNORECASE | re.DOTALL)
-            if match:
-                start = max(0, match.start() - 50)
-                end = min(len(текст), match.end() + 80)
-                контекст = текст[start:end].replace('\n', ' ').strip()
-                текст_до = текст[max(0, match.start()-100):match.start()]
-                пункт_m = re.search(r'(\d+\.\d+)', текст_до)
-                результат["нарушения"].append({
-                    "название": название,
-                    "эталон": данные.get("эталон", ""),
-                    "критичность": данные.get("критичность", "жёлтый"),
-                    "пункт": пункт_m.group(1) if пункт_m else None,
-                    "контекст": f"...{контекст}..."
-                })
-        except:
-            pass
-    
-    результат["красных"] = sum(1 for н in результат["нарушения"] if н["критичность"] == "красный")
-    результат["жёлтых"] = sum(1 for н in результат["нарушения"] if н["критичность"] == "жёлтый")
-    штраф = результат["красных"] * 15 + результат["жёлтых"] * 5
-    результат["соответствие"] = max(0, 100 - штраф)
-    
-    if результат["красных"] == 0 and результат["жёлтых"] <= 2:
-        результат["вердикт"] = "СООТВЕТСТВУЕТ"
-        результат["резюме"] = f"Договор соответствует ТФ ({результат['соответствие']}%)"
-    elif результат["красных"] <= 2:
-        результат["вердикт"] = "ЧАСТИЧНО"
-        результат["резюме"] = f"Частичное соответствие ({результат['соответствие']}%)"
-    else:
-        результат["вердикт"] = "НЕ_СООТВЕТСТВУЕТ"
-        результат["резюме"] = f"Не соответствует ТФ ({результат['соответствие']}%)"
-    
-    return результат
-
-
-# ============================================================================
-# ОПРЕДЕЛЕНИЕ ЗОНЫ
-# ============================================================================
-
-def определить_зону(сумма: float, форма: str, тип_сделки: str):
-    пороги = st.session_state.get("пороги", DEFAULT_THRESHOLDS)
-    
-    if тип_сделки in КРАСНАЯ_ЗОНА:
-        return {"зона": "красная", "причина": f"Тип сделки: {тип_сделки}", "юд": True, "срок": 10}
-    if сумма > пороги.get("жёлтая_макс", 5_000_000):
-        return {"зона": "красная", "причина": f"Сумма превышает {пороги['жёлтая_макс']:,}₽", "юд": True, "срок": 10}
-    if тип_сделки in ЖЁЛТАЯ_ЗОНА:
-        return {"зона": "жёлтая", "причина": f"Тип сделки: {тип_сделки}", "юд": True, "срок": 5}
-    if форма == "Типовая форма (ТФ)":
-        if сумма > пороги.get("зелёная_тф_макс", 100_000):
-            return {"зона": "жёлтая", "причина": f"ТФ свыше {пороги['зелёная_тф_макс']:,}₽", "юд": True, "срок": 5}
-    else:
-        if сумма > пороги.get("зелёная_нетф_макс", 50_000):
-            return {"зона": "жёлтая", "причина": f"Нетиповая форма свыше {пороги['зелёная_нетф_макс']:,}₽", "юд": True, "срок": 5}
-    return {"зона": "зелёная", "причина": "Зелёный коридор (п. 4.1 Регламента)", "юд": False, "срок": 0}
-
-# ============================================================================
-# AI КЛИЕНТ
-# ============================================================================
-
-def ai_анализ(текст: str, извлечённые: dict, rag: dict):
-    api_ключи = st.session_state.get("api_ключи", {})
-    орг = st.session_state.get("орг", DEFAULT_ORG)
-    
-    провайдер = None
-    ключ = ""
-    for pid in ["openai", "anthropic", "yandexgpt"]:
-        if api_ключи.get(pid):
-            провайдер = pid
-            ключ = api_ключи[pid]
-            break
-    
-    if not провайдер:
-        return False, "Не настроен AI-провайдер"
-    
-    тип_док = извлечённые.get("тип_док", {})
-    нарушения_текст = ""
-    for i, н in enumerate(rag.get("нарушения", [])[:8], 1):
-        emoji = "🔴" if н["критичность"] == "красный" else "🟡"
-        пункт = f"п.{н['пункт']}" if н.get("пункт") else ""
-        нарушения_текст += f"\n{i}. {emoji} [{пункт}] {н['эталон']}\n   Контекст: {н.get('контекст', '')[:100]}"
-    
-    промпт = f"""Ты — корпоративный юрист {орг.get('short_name', 'АО СПК')}.
-
-ДОКУМЕНТ: {тип_док.get('название', 'Договор')}
-Контрагент: {извлечённые.get('контрагент', '—')}
-Сумма: {извлечённые.get('сумма', 0):,.0f}₽
-
-ТЕКСТ:
-{текст[:5000]}
-
-НАРУШЕНИЯ:
-{нарушения_текст if нарушения_текст else "Не выявлено"}
-
-{'Это НЕ договор. Опиши что это.' if not тип_док.get('это_договор') else '''
-ЗАДАНИЕ — детальный анализ:
-
-## 1. ЧТО ЭТО
-Кратко: тип договора, стороны, предмет, сумма.
-
-## 2. КРИТИЧЕСКИЕ ПУНКТЫ
-Для каждого:
-- **Пункт X.X** — проблема
-- Текст: "цитата"
-- ❌ Риск: пояснение
-- ✅ Исправить: "готовая формулировка"
-
-## 3. ЗАМЕЧАНИЯ
-Аналогично.
-
-## 4. РЕКОМЕНДАЦИЯ
-Одно из: ✅ СОГЛАСОВАТЬ / ⚠️ С ЗАМЕЧАНИЯМИ / 🔄 ДОРАБОТАТЬ / ❌ ОТКЛОНИТЬ
-
-Указывай НОМЕРА пунктов и ГОТОВЫЕ формулировки.
-'''}"""
-
-    try:
-        if провайдер == "openai":
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={"Authorization": f"Bearer {ключ}", "Content-Type": "application/json"},
-                json={"model": "gpt-4o-mini", "messages": [{"role": "user", "content": промпт}], "max_tokens": 3000, "temperature": 0.3},
-                timeout=90
-            )
-            if response.status_code == 200:
-                return True, response.json()["choices"][0]["message"]["content"]
-            return False, f"Ошибка: {response.status_code}"
-        
-        elif провайдер == "anthropic":
-            response = requests.post(
-                "https://api.anthropic.com/v1/messages",
-                headers={"x-api-key": ключ, "Content-Type": "application/json", "anthropic-version": "2023-06-01"},
-                json={"model": "claude-3-haiku-20240307", "max_tokens": 3000, "messages": [{"role": "user", "content": промпт}]},
-                timeout=90
-            )
-            if response.status_code == 200:
-                return True, response.json()["content"][0]["text"]
-            return False, f"Ошибка: {response.status_code}"
-        
-        elif провайдер == "yandexgpt":
-            folder = st.session_state.get("yandex_folder", "")
-            if not folder:
-                return False, "Укажите Folder ID"
-            response = requests.post(
-                "https://llm.api.cloud.yandex.net/foundationModels/v1/completion",
-                headers={"Authorization": f"Api-Key {ключ}", "Content-Type": "application/json"},
-                json={"modelUri": f"gpt://{folder}/yandexgpt-lite", "completionOptions": {"maxTokens": 3000}, "messages": [{"role": "user", "text": промпт}]},
-                timeout=90
-            )
-            if response.status_code == 200:
-                return True, response.json()["result"]["alternatives"][0]["message"]["text"]
-            return False, f"Ошибка: {response.status_code}"
-        
-        return False, "Неизвестный провайдер"
-    except requests.exceptions.Timeout:
-        return False, "Таймаут"
-    except Exception as e:
-        return False, str(e)
-
-
 # ============================================================================
 # ВСПОМОГАТЕЛЬНЫЕ
 # ============================================================================
 
-def загрузить_файл(f):
-    if not f:
-        return False, ""
-    try:
-        content = f.read()
-        name = f.name.lower()
-        
-        if name.endswith('.txt'):
-            for enc in ['utf-8', 'cp1251', 'cp866']:
-                try:
-                    return True, content.decode(enc)
-                except:
-                    pass
-            return True, content.decode('utf-8', errors='replace')
-        
-        elif name.endswith('.docx') and DOCX_AVAILABLE:
-            doc = DocxDocument(io.BytesIO(content))
-            text = '\n'.join([p.text for p in doc.paragraphs if p.text.strip()])
-            return (True, text) if text else (False, "Пустой документ")
-        
-        elif name.endswith('.pdf') and PDF_AVAILABLE:
-            reader = PdfReader(io.BytesIO(content))
-            text = '\n'.join([p.extract_text() or '' for p in reader.pages])
-            return (True, text) if text.strip() else (False, "Не удалось извлечь")
-        
-        return False, "Неподдерживаемый формат"
-    except Exception as e:
-        return False, str(e)
 
 
 def это_админ():
     return st.session_state.get("роль", "") == РОЛЬ_АДМИН
 
 
+def владелец_архива():
+    # Чужие записи архива видит только администратор; остальным — свои
+    return None if это_админ() else (st.session_state.пользователь or {}).get("имя", "")
+
+
 def инициализация():
     defaults = {
         "авторизован": False, "пользователь": None, "роль": РОЛЬ_ЮЗЕР,
         "текст": "", "извлечённые": None, "зона": None, "rag": None, "ai": "",
-        "история": [], "орг": DEFAULT_ORG.copy(), "пороги": DEFAULT_THRESHOLDS.copy(),
+        "архив_записи": {}, "похожие": {}, "орг": DEFAULT_ORG.copy(), "пороги": DEFAULT_THRESHOLDS.copy(),
         "api_ключи": {}, "yandex_folder": "", "пользовательские_тф": {},
+        "ai_задачи": {}, "ai_ошибка": "",
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -1103,16 +734,34 @@ def вкладка_анализа():
         st.rerun()
     
     if файл:
-        ok, текст = загрузить_файл(файл)
-        if ok and текст != st.session_state.текст:
-            st.session_state.текст = текст[:300000]
-            st.session_state.извлечённые = извлечь_все_данные(текст)
+        загрузка = разобрать_загрузку(файл)
+        текст = загрузка["текст"]
+        страницы = загрузка.get("страницы")
+        память = загрузка.get("память")
+        сводка = []
+        if память:
+            сводка.append(f"файл {память['файл_мб']} МБ" + (
+                f", память процесса +{память['прирост_мб']} МБ" if память.get("прирост_мб") is not None else ""))
+        if страницы:
+            долгая = max(страницы, key=lambda с: с["мс"])
+            сводка.append(f"PDF: прочитано страниц {len(страницы)} за {sum(с['мс'] for с in страницы) / 1000:.1f} с "
+                          f"(до {МАКС_СИМВОЛОВ_ДОКУМЕНТА:,} символов), дольше всех — стр. {долгая['страница']}: {долгая['мс']:.0f} мс")
+        if сводка:
+            st.caption("Загрузка: " + "; ".join(сводка))
+        if загрузка["ok"] and текст[:МАКС_СИМВОЛОВ_ДОКУМЕНТА] != st.session_state.текст:
+            st.session_state.текст = текст[:МАКС_СИМВОЛОВ_ДОКУМЕНТА]
+            st.session_state.извлечённые = загрузка["извлечённые"]
             st.success(f"Загружено: {len(текст):,} символов")
             st.rerun()
-        elif not ok:
+        elif not загрузка["ok"]:
             st.error(текст)
     
-    if показать_текст:
+    if показать_текст and len(st.session_state.текст) > ПРЕВЬЮ_ТЕКСТА:
+        # Мегабайты текста в виджете пересылаются браузеру на каждом перезапуске
+        st.text_area("Текст договора:", value=st.session_state.текст[:ПРЕВЬЮ_ТЕКСТА], height=150, disabled=True)
+        st.caption(f"Показано начало: {ПРЕВЬЮ_ТЕКСТА:,} из {len(st.session_state.текст):,} символов. "
+                   f"Длинный документ правится в файле и загружается заново.")
+    elif показать_текст:
         новый = st.text_area("Текст договора:", value=st.session_state.текст, height=150)
         if st.button("Применить"):
             if len(новый) > 50:
@@ -1147,6 +796,17 @@ def вкладка_анализа():
             </div>
             ''', unsafe_allow_html=True)
         
+        # Повторная присылка: предложить прежний анализ похожего договора
+        if not st.session_state.rag and not st.session_state.ai:
+            похожий = найти_похожий(st.session_state.текст)
+            if похожий:
+                st.info(f"♻️ Похожий договор уже анализировался: {похожий['контрагент'] or 'Н/Д'} от "
+                        f"{datetime.fromtimestamp(похожий['создан']).strftime('%d.%m.%Y')} "
+                        f"(сходство {похожий['сходство']:.0%}). Можно взять его результаты и перепроверить только изменённые пункты.")
+                if st.button("Использовать прежний анализ"):
+                    применить_прежний_анализ(похожий["id"])
+                    st.rerun()
+        
         # Извлечённые данные
         st.markdown('<div class="npk-section-title">Извлечённые данные</div>', unsafe_allow_html=True)
         st.markdown(f'''
@@ -1190,7 +850,7 @@ def вкладка_анализа():
         if тип_сделки == "— Обычный —":
             тип_сделки = ""
         
-        st.session_state.текущие = {"контрагент": контрагент, "сумма": сумма}
+        st.session_state.текущие = {"контрагент": контрагент, "сумма": сумма, "форма": форма, "тип_сделки": тип_сделки}
         
         st.markdown("---")
         
@@ -1201,7 +861,8 @@ def вкладка_анализа():
         
         with c1:
             if st.button("🚦 Определить зону", type="primary", use_container_width=True):
-                st.session_state.зона = определить_зону(сумма, форма, тип_сделки)
+                st.session_state.зона = определить_зону(сумма, форма, тип_сделки, st.session_state.get("пороги"))
+                сохранить_в_архив()
                 st.rerun()
         
         with c2:
@@ -1219,7 +880,12 @@ def вкладка_анализа():
         with c3:
             if st.button("📊 RAG-сличение", type="primary", use_container_width=True):
                 if код_тф and код_тф in все_тф:
-                    st.session_state.rag = анализ_rag(st.session_state.текст, код_тф)
+                    st.session_state.rag = анализ_rag(
+                        st.session_state.текст, код_тф,
+                        правила=набор_правил(st.session_state.get("пользовательские_тф", {})),
+                        макс_охват=ОХВАТ_ПРАВИЛА, бюджет_мс=БЮДЖЕТ_ПРАВИЛА_МС,
+                    )
+                    сохранить_в_архив()
                     st.rerun()
                 else:
                     st.error("Выберите типовую форму")
@@ -1229,24 +895,48 @@ def вкладка_анализа():
         есть_ai = any(api.get(p) for p in AI_ПРОВАЙДЕРЫ)
         
         if есть_ai:
+            rag_оценки = st.session_state.get("rag") or {"нарушения": []}
+            целиком = st.checkbox("Весь договор по фрагментам", key="ai_целиком",
+                                  help="По умолчанию AI получает только ключевые пункты в пределах бюджета токенов")
+            оценка = оценка_ai(извл, rag_оценки, [p for p in AI_ПРОВАЙДЕРЫ if api.get(p)], целиком)
+            st.caption(" · ".join(
+                f"{AI_ПРОВАЙДЕРЫ[p]['название']}: ≈{о['токенов']:,} ток."
+                + (f" в {о['запросов']} запросах" if о["запросов"] > 1 else "")
+                + (f", ≈{о['стоимость']:.4f}{о['валюта']} (до {о['стоимость_макс']:.4f}{о['валюта']} с ответом)" if о["валюта"] else "")
+                for p, о in оценка.items()
+            ))
+            очередь_к = []
+            for p, о in оценка.items():
+                ожидание = ограничитель_ai().оценка_ожидания(p, о["токенов"] // о["запросов"] + о["ответ_макс"] // о["запросов"])
+                if ожидание["место"] > 1 or ожидание["ожидание_с"] >= 1:
+                    очередь_к.append(f"{AI_ПРОВАЙДЕРЫ[p]['название']}: {ожидание['место']}-е место, ≈{ожидание['ожидание_с']:.0f} с")
+            if очередь_к:
+                st.caption("⏳ Очередь к провайдерам (лимиты запросов): " + " · ".join(очередь_к))
+            
             if st.button("🤖 AI-экспертиза", type="primary", use_container_width=True):
-                placeholder = st.empty()
-                placeholder.markdown('''
-                <div class="loading-train">
-                    <div class="train">🚂🚃🚃🚃</div>
-                    <div class="text">AI анализирует договор...</div>
-                </div>
-                ''', unsafe_allow_html=True)
-                
-                rag = st.session_state.get("rag") or {"нарушения": []}
-                ok, результат = ai_анализ(st.session_state.текст, извл, rag)
-                placeholder.empty()
-                
-                if ok:
-                    st.session_state.ai = результат
-                    st.rerun()
-                else:
-                    st.error(результат)
+                # Задача уходит в общий пул процесса; сессия хранит только её id
+                текст = st.session_state.текст
+                метка = метка_текста(текст)
+                st.session_state.ai_задачи[метка] = очередь_ai().отправить(
+                    ai_анализ_поток, текст, извл, st.session_state.get("rag") or {"нарушения": []},
+                    api_ключи=dict(st.session_state.get("api_ключи", {})),
+                    орг=dict(st.session_state.get("орг", DEFAULT_ORG)),
+                    yandex_folder=st.session_state.get("yandex_folder", ""),
+                    целиком=целиком,
+                    название=f"{извл.get('тип_док', {}).get('название', 'Документ')} — {извл.get('контрагент') or 'без контрагента'}",
+                    владелец=(st.session_state.пользователь or {}).get("имя", ""),
+                    метка=метка,
+                )
+                st.session_state.ai = ""
+                st.rerun()
+            
+            id_задачи = st.session_state.ai_задачи.get(метка_текста(st.session_state.текст))
+            if id_задачи:
+                показать_ai_задачу(id_задачи)
+            if st.session_state.ai_ошибка:
+                st.error(st.session_state.ai_ошибка)
+                st.session_state.ai_ошибка = ""
+            список_ai_задач()
         else:
             st.info("Для AI-анализа добавьте API-ключ в Настройках")
         
@@ -1263,6 +953,7 @@ def вкладка_анализа():
                 <h3>{emoji} {название}</h3>
                 <p>{з["причина"]}</p>
                 <p><strong>Требуется ЮД:</strong> {"Да" if з["юд"] else "Нет"} | <strong>Срок:</strong> {з["срок"]} дн.</p>
+                {экспозиция_контрагента()}
             </div>
             ''', unsafe_allow_html=True)
         
@@ -1276,6 +967,191 @@ def вкладка_анализа():
             st.markdown(f'<div class="ai-result">{st.session_state.ai}</div>', unsafe_allow_html=True)
 
 
+def метка_текста(текст: str) -> str:
+    # Хеш документа считается один раз: метка хранится в сессии вместе с самим текстом
+    запомнено = st.session_state.get("метка_текста")
+    if запомнено and запомнено[0] is текст:
+        return запомнено[1]
+    метка = hashlib.sha256(текст.encode("utf-8")).hexdigest()[:16]
+    st.session_state.метка_текста = (текст, метка)
+    return метка
+
+
+def оценка_ai(извл: dict, rag: dict, провайдеры: list, целиком: bool) -> dict:
+    # Оценка строит те же промпты, что уйдут провайдеру, — пересчитывается, только когда
+    # меняются документ, результат RAG, организация, провайдеры или режим
+    орг = st.session_state.get("орг", DEFAULT_ORG)
+    ключ = (метка_текста(st.session_state.текст), tuple(провайдеры), целиком, tuple(орг.items()))
+    запомнено = st.session_state.get("оценка_ai")
+    if запомнено and запомнено[0] == ключ and запомнено[1] is st.session_state.get("rag"):
+        return запомнено[2]
+    оценка = оценка_анализа(st.session_state.текст, извл, rag, орг=орг, провайдеры=провайдеры, целиком=целиком)
+    st.session_state.оценка_ai = (ключ, st.session_state.get("rag"), оценка)
+    return оценка
+
+
+def сохранить_в_архив():
+    # Одна запись архива на договор в сессии: зона, RAG и AI дописываются в неё по мере готовности
+    текст = st.session_state.текст
+    if not текст:
+        return
+    метка = метка_текста(текст)
+    текущие = st.session_state.get("текущие") or {}
+    запись = запись_анализа(
+        текст, st.session_state.извлечённые,
+        пользователь=(st.session_state.пользователь or {}).get("имя", ""),
+        контрагент=текущие.get("контрагент"), сумма=текущие.get("сумма"),
+        форма=текущие.get("форма", ""), тип_сделки=текущие.get("тип_сделки", ""),
+        зона=st.session_state.зона, rag=st.session_state.rag, ai=st.session_state.ai,
+        инн_организации=st.session_state.get("орг", DEFAULT_ORG).get("inn", ""),
+    )
+    try:
+        st.session_state.архив_записи[метка] = архив().записать(запись, st.session_state.архив_записи.get(метка))
+    except Exception as e:
+        st.warning(f"История не сохранена: {e}")
+
+
+def экспозиция_контрагента() -> str:
+    # Сводка ведётся архивом при каждой записи — здесь только чтение одной строки.
+    # Она общая для организации: договоры всех пользователей, без их текстов
+    извл = st.session_state.извлечённые or {}
+    инн = извл.get("инн")
+    if инн == st.session_state.get("орг", DEFAULT_ORG).get("inn"):
+        инн = None
+    контрагент = (st.session_state.get("текущие") or {}).get("контрагент") or извл.get("контрагент")
+    try:
+        с = архив().контрагент(инн, контрагент)
+    except Exception:
+        return ""
+    if not с:
+        return ""
+    инн = f" (ИНН {с['инн']})" if с["инн"] else ""
+    return (f'<p><strong>Контрагент{инн}:</strong> '
+            f'{с["договоров"]} договор(ов) в архиве организации на {с["сумма"]:,.0f} ₽ | '
+            f'🔴 {с["красных_зон"]} · 🟡 {с["жёлтых_зон"]} зон | '
+            f'нарушений: {с["нарушений_красных"]} критических, {с["нарушений_жёлтых"]} замечаний</p>')
+
+
+def найти_похожий(текст: str):
+    # Подпись длинного текста — десятки мс, поэтому результат запоминается на договор
+    метка = метка_текста(текст)
+    if метка not in st.session_state.похожие:
+        try:
+            свой = st.session_state.архив_записи.get(метка)
+            найдено = [з for з in архив().похожие(текст, пользователь=владелец_архива()) if з["id"] != свой]
+        except Exception:
+            найдено = []
+        st.session_state.похожие[метка] = найдено[0] if найдено else None
+    return st.session_state.похожие[метка]
+
+
+def применить_прежний_анализ(id_: int):
+    запись = архив().получить(id_)
+    владелец = владелец_архива()
+    if not запись or (владелец is not None and запись["пользователь"] != владелец):
+        return
+    прежний_текст = архив().текст(id_)
+    if прежний_текст is None:
+        return
+    текст = st.session_state.текст
+    результат = запись["результат"]
+    
+    прежний_rag = результат.get("rag")
+    if прежний_rag:
+        все_тф = {**ТИПОВЫЕ_ФОРМЫ, **st.session_state.get("пользовательские_тф", {})}
+        код_тф = next((к for к, тф in все_тф.items() if тф["название"] == прежний_rag.get("название_тф")), None)
+        if код_тф:
+            st.session_state.rag = анализ_rag_изменений(
+                текст, прежний_текст, прежний_rag, код_тф,
+                правила=набор_правил(st.session_state.get("пользовательские_тф", {})),
+                макс_охват=ОХВАТ_ПРАВИЛА, бюджет_мс=БЮДЖЕТ_ПРАВИЛА_МС,
+            )
+    
+    if результат.get("ai"):
+        номера = []
+        for a, b in изменённые_пункты(прежний_текст, текст):
+            м = re.search(r'\d+\.\d+', текст[a:b])
+            if м or a == 0:
+                номера.append(м.group() if м else "вводная часть")
+        изменено = (f"Изменены пункты: {', '.join(номера)} — проверьте их или запустите AI-экспертизу заново."
+                    if номера else "Текст совпадает с прежней редакцией.")
+        st.session_state.ai = (f"> Заключение перенесено из анализа от "
+                               f"{datetime.fromtimestamp(запись['создан']).strftime('%d.%m.%Y')}. {изменено}\n\n"
+                               + результат["ai"])
+    сохранить_в_архив()
+
+
+def _с_опросом(функция):
+    # st.fragment перезапускает по таймеру только свою часть страницы; без него — кнопка «Обновить»
+    фрагмент = getattr(st, "fragment", None)
+    return фрагмент(run_every=ОПРОС_ЗАДАЧ_С)(функция) if фрагмент else функция
+
+
+@_с_опросом
+def показать_ai_задачу(id_задачи: str):
+    задача = очередь_ai().статус(id_задачи)
+    if задача is None:
+        # Процесс перезапущен — задачи нет
+        st.session_state.ai_задачи = {м: i for м, i in st.session_state.ai_задачи.items() if i != id_задачи}
+        return
+    
+    if задача["статус"] in ("готово", "ошибка", "отменена"):
+        st.session_state.ai_задачи = {м: i for м, i in st.session_state.ai_задачи.items() if i != id_задачи}
+        if задача["статус"] == "готово":
+            st.session_state.ai = задача["текст"]
+            сохранить_в_архив()
+        elif задача["статус"] == "ошибка":
+            st.session_state.ai_ошибка = задача["ошибка"]
+        st.rerun()
+    
+    if задача["текст"]:
+        st.markdown(задача["текст"] + " ▌")
+    else:
+        подпись = (f"В очереди: {задача['место']}-я" if задача["статус"] == "в очереди"
+                   else "AI анализирует договор...")
+        ждут = {p: с for p, с in ограничитель_ai().состояние().items()
+                if с["в_очереди"] and st.session_state.get("api_ключи", {}).get(p)}
+        if ждут:
+            подпись += "<br>Ожидание лимита: " + ", ".join(
+                f"{AI_ПРОВАЙДЕРЫ.get(p, {}).get('название', p)} — в очереди {с['в_очереди']}"
+                + (f", пауза {с['пауза_с']:.0f} с" if с["пауза_с"] > 0 else "")
+                for p, с in ждут.items())
+        st.markdown(f'''
+        <div class="loading-train">
+            <div class="train">🚂🚃🚃🚃</div>
+            <div class="text">{подпись}</div>
+        </div>
+        ''', unsafe_allow_html=True)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Отменить AI-экспертизу", key=f"отмена_{id_задачи}", use_container_width=True):
+            очередь_ai().отменить(id_задачи)
+            st.rerun()
+    with col2:
+        if not getattr(st, "fragment", None):
+            st.button("Обновить", key=f"обновить_{id_задачи}", use_container_width=True)
+
+
+def список_ai_задач():
+    задачи = очередь_ai().задачи((st.session_state.пользователь or {}).get("имя", ""))
+    if not задачи:
+        return
+    
+    значки = {"в очереди": "⏳", "выполняется": "🔄", "готово": "✅", "ошибка": "❌", "отменена": "⛔"}
+    with st.expander(f"Фоновые AI-задачи ({sum(з['статус'] in ('в очереди', 'выполняется') for з in задачи)} в работе)"):
+        for з in задачи[:20]:
+            конец = з["завершена"] or time.time()
+            длительность = конец - (з["начата"] or конец)
+            c1, c2 = st.columns([4, 1])
+            c1.markdown(f"{значки.get(з['статус'], '')} **{з['название']}** — {з['статус']}"
+                        + (f", {длительность:.0f} с" if з["начата"] else "")
+                        + (f" — {з['ошибка']}" if з["ошибка"] else ""))
+            if з["статус"] == "готово" and c2.button("Показать", key=f"показать_{з['id']}"):
+                st.session_state.ai = з["текст"]
+                st.rerun()
+
+
 def показать_rag():
     rag = st.session_state.rag
     
@@ -1307,35 +1183,78 @@ def показать_rag():
     ''', unsafe_allow_html=True)
     
     st.markdown(f"**{rag.get('резюме', '')}**")
+    if rag.get("охват"):
+        окна = " Длинный текст проверен по частям." if rag.get("по_окнам") else ""
+        st.caption(f"Режим сличения: совпадение правила ищется в пределах {rag['охват']:,} символов — "
+                   f"нарушение, растянутое на большее расстояние, не будет найдено.{окна}")
     
-    # Нарушения
+    # Правила с ошибкой в паттерне в сличение не вошли — их тоже нужно проверить вручную
+    свои_тф = st.session_state.get("пользовательские_тф", {})
+    коды = {к for к, тф in {**ТИПОВЫЕ_ФОРМЫ, **свои_тф}.items() if тф["название"] == rag.get("название_тф")}
+    ошибки = [о for о in набор_правил(свои_тф).ошибки if о["форма"] in коды]
+    if ошибки:
+        st.warning(f"Не проверено (ошибка в паттерне правила): {', '.join(о['название'] for о in ошибки)}. "
+                   f"Подробности — в настройках, «Типовые формы».")
+    
+    if rag.get("превышен_бюджет"):
+        пропущено = ", ".join(п["эталон"] for п in rag["превышен_бюджет"])
+        st.warning(f"Не проверено (превышено время на правило): {пропущено}. Проверьте эти пункты вручную.")
+    
+    # Нарушения — одна таблица: фильтр, сортировка и страница считаются здесь, в браузер уходит только страница
     нарушения = rag.get("нарушения", [])
-    красные = [н for н in нарушения if н["критичность"] == "красный"]
-    жёлтые = [н for н in нарушения if н["критичность"] == "жёлтый"]
+    if not нарушения:
+        return
     
-    if красные:
-        st.markdown('<div class="npk-section-title" style="color:#c41e3a;">Критические несоответствия</div>', unsafe_allow_html=True)
-        for н in красные:
-            пункт = f"<strong>Пункт {н['пункт']}</strong> — " if н.get("пункт") else ""
-            st.markdown(f'''
-            <div class="risk-card red">
-                {пункт}Нарушение эталона ТФ
-                <div class="context">{н.get("контекст", "")[:250]}</div>
-                <strong style="color:#22c55e;">✅ Эталон:</strong> {н.get("эталон", "")}<br>
-                <strong style="color:#3b82f6;">➡️ Рекомендация:</strong> Изменить на формулировку из ТФ
-            </div>
-            ''', unsafe_allow_html=True)
+    st.markdown('<div class="npk-section-title">Несоответствия типовой форме</div>', unsafe_allow_html=True)
+    c1, c2, c3 = st.columns([2, 2, 1])
+    with c1:
+        критичность = st.radio("Критичность", ["Все", "Критические", "Замечания"], horizontal=True, key="rag_критичность")
+    with c2:
+        поиск = st.text_input("Поиск", placeholder="Пункт, эталон или текст", key="rag_поиск")
+    with c3:
+        сортировка = st.selectbox("Порядок", ["По критичности", "По пункту"], key="rag_порядок")
     
-    if жёлтые:
-        with st.expander(f"Замечания ({len(жёлтые)})"):
-            for н in жёлтые:
-                пункт = f"п.{н['пункт']} — " if н.get("пункт") else ""
-                st.markdown(f'''
-                <div class="risk-card yellow">
-                    <strong>{пункт}{н.get("эталон", "")}</strong><br>
-                    <small style="color:#666;">{н.get("контекст", "")[:150]}</small>
-                </div>
-                ''', unsafe_allow_html=True)
+    отбор = [н for н in нарушения
+             if критичность == "Все" or н["критичность"] == ("красный" if критичность == "Критические" else "жёлтый")]
+    if поиск.strip():
+        запрос = поиск.strip().lower()
+        отбор = [н for н in отбор
+                 if запрос in f"{н.get('пункт') or ''} {н.get('эталон', '')} {н.get('контекст', '')}".lower()]
+    
+    def номер_пункта(н):
+        # «5.10» после «5.9»; без пункта — в конце
+        return [int(ч) for ч in н["пункт"].split(".")] if н.get("пункт") else [float("inf")]
+    
+    if сортировка == "По пункту":
+        отбор.sort(key=номер_пункта)
+    else:
+        отбор.sort(key=lambda н: (н["критичность"] != "красный", номер_пункта(н)))
+    
+    if not отбор:
+        st.caption("Нет нарушений по заданному отбору")
+        return
+    
+    страниц = (len(отбор) + СТРОК_НА_СТРАНИЦЕ - 1) // СТРОК_НА_СТРАНИЦЕ
+    номер = 1
+    if страниц > 1:
+        # Ключ зависит от отбора: при смене фильтра таблица начинается с первой страницы
+        номер = st.number_input(f"Страница (из {страниц}, всего {len(отбор)})", 1, страниц, 1,
+                                key=f"rag_страница_{критичность}_{поиск}_{сортировка}_{len(отбор)}")
+    страница = отбор[(номер - 1) * СТРОК_НА_СТРАНИЦЕ:номер * СТРОК_НА_СТРАНИЦЕ]
+    
+    import pandas as pd
+    st.dataframe(pd.DataFrame({
+        "": ["🔴" if н["критичность"] == "красный" else "🟡" for н in страница],
+        "Пункт": [н.get("пункт") or "—" for н in страница],
+        "Эталон ТФ": [н.get("эталон", "") for н in страница],
+        "Фрагмент договора": [н.get("контекст", "")[:250] for н in страница],
+    }), hide_index=True, use_container_width=True, column_config={
+        "Эталон ТФ": st.column_config.TextColumn(width="large"),
+        "Фрагмент договора": st.column_config.TextColumn(width="large"),
+    })
+    if any(н["критичность"] == "красный" for н in страница):
+        st.caption("➡️ Критические пункты приведите к формулировке эталона ТФ")
+
 
 # ============================================================================
 # ВКЛАДКА ИСТОРИИ
@@ -1344,24 +1263,103 @@ def показать_rag():
 def вкладка_истории():
     st.markdown('<div class="npk-title">ИСТОРИЯ</div>', unsafe_allow_html=True)
     
-    история = st.session_state.get("история", [])
+    имя = (st.session_state.пользователь or {}).get("имя", "")
+    c1, c2, c3, c4 = st.columns([2, 1, 2, 1])
+    with c1:
+        контрагент = st.text_input("Контрагент", placeholder="Начало названия", key="история_контрагент")
+    with c2:
+        зона = st.selectbox("Зона", ["Все", "зелёная", "жёлтая", "красная"], key="история_зона")
+    with c3:
+        период = st.date_input("Период", value=(), format="DD.MM.YYYY", key="история_период")
+    with c4:
+        порядок = ПОРЯДКИ_ИСТОРИИ[st.selectbox("Порядок", list(ПОРЯДКИ_ИСТОРИИ), key="история_порядок")]
+    только_мои = st.toggle("Только мои", value=True, key="история_мои") if это_админ() else True
     
-    if not история:
+    запрос = st.text_input("Поиск по текстам и нарушениям", key="история_поиск",
+                           placeholder='Слова или фраза в кавычках: "молчание заказчика" транслогистик')
+    if запрос.strip():
+        показать_найденное(запрос, имя if только_мои else None)
+        return
+    
+    фильтры = {"контрагент": контрагент.strip(), "зона": "" if зона == "Все" else зона,
+               "пользователь": имя if только_мои else None}
+    if период:
+        начало = datetime.combine(период[0], datetime.min.time())
+        конец = datetime.combine(период[-1], datetime.min.time()) + timedelta(days=1)
+        фильтры.update(с=начало.timestamp(), по=конец.timestamp())
+    
+    # Страницы по ключу: стек курсоров предыдущих страниц, сброс при смене фильтров или порядка
+    ключ = repr((порядок, sorted(фильтры.items())))
+    if st.session_state.get("история_фильтры") != ключ:
+        st.session_state.история_фильтры = ключ
+        st.session_state.история_курсоры = [None]
+    курсоры = st.session_state.история_курсоры
+    
+    try:
+        всего = архив().количество(**фильтры)
+        страница = архив().страница(после=курсоры[-1], порядок=порядок, **фильтры)
+    except Exception as e:
+        st.error(f"Архив недоступен: {e}")
+        return
+    
+    if not всего:
         st.info("История пуста")
         return
     
-    for з in история:
-        emoji = {"зелёная": "🟢", "жёлтая": "🟡", "красная": "🔴"}.get(з.get("зона", ""), "⚪")
-        st.markdown(f'''
-        <div class="npk-table-row" style="padding:15px;background:#f5f5f5;border-radius:4px;margin:10px 0;">
-            <div>{emoji} <strong>{з.get("контрагент", "Н/Д")}</strong></div>
-            <div style="color:#666;">{з.get("сумма", 0):,.0f}₽ | {з.get("дата", "")}</div>
-        </div>
-        ''', unsafe_allow_html=True)
+    номер = len(курсоры)
+    st.caption(f"Записей: {всего:,} · страница {номер} из {(всего + РАЗМЕР_СТРАНИЦЫ - 1) // РАЗМЕР_СТРАНИЦЫ}")
+    # Одна таблица на страницу: размер ответа не зависит от объёма архива
+    import pandas as pd
+    строки = страница["строки"]
+    st.dataframe(pd.DataFrame({
+        "Дата": [datetime.fromtimestamp(з["создан"]) for з in строки],
+        "Зона": [f"{ЗНАЧКИ_ЗОН.get(з['зона'] or '', '⚪')} {з['зона'] or '—'}" for з in строки],
+        "Контрагент": [з["контрагент"] or "Н/Д" for з in строки],
+        "Документ": [з["тип_документа"] or "" for з in строки],
+        "Сумма, ₽": [з["сумма"] or 0 for з in строки],
+        "Вердикт RAG": [з["вердикт"] or "" for з in строки],
+        "Пользователь": [з["пользователь"] or "" for з in строки],
+    }), hide_index=True, use_container_width=True, column_config={
+        "Дата": st.column_config.DatetimeColumn(format="DD.MM.YYYY HH:mm"),
+        "Сумма, ₽": st.column_config.NumberColumn(format="%.0f"),
+    })
     
-    if st.button("Очистить историю"):
-        st.session_state.история = []
-        st.rerun()
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        if номер > 1 and st.button("← Назад", use_container_width=True):
+            курсоры.pop()
+            st.rerun()
+    with c2:
+        if страница["следующий"] and st.button("Далее →", use_container_width=True):
+            курсоры.append(страница["следующий"])
+            st.rerun()
+    with c3:
+        if st.button("Очистить мою историю", use_container_width=True):
+            архив().удалить(имя)
+            st.session_state.архив_записи = {}
+            st.session_state.история_курсоры = [None]
+            st.rerun()
+
+
+def показать_найденное(запрос: str, пользователь):
+    try:
+        найдено = архив().найти(запрос, пользователь=пользователь)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if not найдено:
+        st.info("Ничего не найдено")
+        return
+    
+    st.caption(f"Лучшие совпадения: {len(найдено)}")
+    # Число результатов ограничено архивом — один блок разметки на весь список
+    st.markdown("\n".join(
+        f"- {ЗНАЧКИ_ЗОН.get(з['зона'] or '', '⚪')} **{з['контрагент'] or 'Н/Д'}** · "
+        f"{datetime.fromtimestamp(з['создан']).strftime('%d.%m.%Y')}"
+        + (f" · {з['вердикт']}" if з["вердикт"] else "")
+        + f"  \n  {' '.join(з['фрагмент'].split())}"
+        for з in найдено
+    ))
 
 
 # ============================================================================
@@ -1396,6 +1394,8 @@ def вкладка_настроек():
         if st.button("Сохранить", key="save_thresh"):
             st.session_state.пороги = {"зелёная_тф_макс": new_tf, "зелёная_нетф_макс": new_ntf, "жёлтая_макс": new_yellow}
             st.success("Сохранено")
+        
+        показать_симуляцию(пороги, {"зелёная_тф_макс": new_tf, "зелёная_нетф_макс": new_ntf, "жёлтая_макс": new_yellow})
     
     with tabs[2]:
         st.markdown('<div class="npk-section-title">API-ключи для AI</div>', unsafe_allow_html=True)
@@ -1418,17 +1418,130 @@ def вкладка_настроек():
         
         st.markdown("---")
         st.text_input("YandexGPT Folder ID", value=st.session_state.get("yandex_folder", ""), key="yf")
+        
+        кэш = кэш_ai()
+        if кэш is not None:
+            с = кэш.статистика()
+            st.markdown("---")
+            st.markdown('<div class="npk-section-title">Кэш AI-ответов</div>', unsafe_allow_html=True)
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Записей", с["записей"], help=f"{с['байт'] / 1024 / 1024:.1f} МБ")
+            c2.metric("Попаданий", f"{с['доля_попаданий']:.0%}", help=f"{с['попаданий']} из {с['попаданий'] + с['промахов']}")
+            c3.metric("Вытеснено", с["вытеснено"])
+            if st.button("Очистить кэш AI"):
+                кэш.очистить()
+                st.rerun()
+        
+        планировщик = планировщик_ai()
+        состояние = планировщик.состояние()
+        if состояние:
+            st.markdown("---")
+            st.markdown('<div class="npk-section-title">Провайдеры</div>', unsafe_allow_html=True)
+            значок = {"закрыт": "🟢", "проба": "🟡", "открыт": "🔴"}
+            for pid, с in состояние.items():
+                p50 = f"{с['ttft_p50_мс']:.0f}" if с["ttft_p50_мс"] is not None else "—"
+                p95 = f"{с['ttft_p95_мс']:.0f}" if с["ttft_p95_мс"] is not None else "—"
+                st.markdown(f'''
+                <div class="npk-table-row">
+                    <div class="npk-table-label">{значок[с["предохранитель"]]} {AI_ПРОВАЙДЕРЫ.get(pid, {}).get("название", pid)}</div>
+                    <div class="npk-table-value">первый токен p50 {p50} мс, p95 {p95} мс | ошибок {с["доля_ошибок"]:.0%} из {с["вызовов"]}</div>
+                </div>
+                ''', unsafe_allow_html=True)
+            st.caption(f"Хедж-запросов: {планировщик.хеджей}, из них быстрее основного: {планировщик.побед_хеджа}")
+        
+        лимиты = ограничитель_ai().состояние()
+        if лимиты:
+            st.markdown("---")
+            st.markdown('<div class="npk-section-title">Лимиты запросов</div>', unsafe_allow_html=True)
+            for pid, с in лимиты.items():
+                st.markdown(f'''
+                <div class="npk-table-row">
+                    <div class="npk-table-label">{AI_ПРОВАЙДЕРЫ.get(pid, {}).get("название", pid)}</div>
+                    <div class="npk-table-value">в очереди {с["в_очереди"]}, выполняется {с["выполняется"]} | ждали лимита {с["задержано"]} из {с["запросов"]}, всего {с["ожидание_с"]:.1f} с, макс. {с["ожидание_макс_с"]:.1f} с | отказов {с["отказов"]}, ответов 429: {с["429"]}</div>
+                </div>
+                ''', unsafe_allow_html=True)
+        st.download_button("Метрики AI (Prometheus)", метрики_prometheus(), file_name="svetofor_ai.prom", mime="text/plain")
     
     with tabs[3]:
         st.markdown('<div class="npk-section-title">Типовые формы</div>', unsafe_allow_html=True)
         
-        for код, тф in ТИПОВЫЕ_ФОРМЫ.items():
+        свои_тф = st.session_state.get("пользовательские_тф", {})
+        for код, тф in {**ТИПОВЫЕ_ФОРМЫ, **свои_тф}.items():
             st.markdown(f'''
             <div class="npk-table-row">
                 <div class="npk-table-label">{тф["название"]}</div>
-                <div class="npk-table-value">{тф["код"]} | {len(тф.get("пункты", {}))} эталонов</div>
+                <div class="npk-table-value">{тф.get("код", код)} | {len(тф.get("пункты", {}))} эталонов</div>
             </div>
             ''', unsafe_allow_html=True)
+        
+        # Паттерны, которые не компилируются, в сличении не участвуют — показываем их здесь
+        ошибки = набор_правил(свои_тф).ошибки
+        if ошибки:
+            st.warning(f"Не используются при RAG-сличении (ошибка в паттерне): {len(ошибки)}")
+            for о in ошибки:
+                st.markdown(f"- **{о['название']}** ({о['форма']}): `{о['ошибка']}`")
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def симулятор_реестра(хеш: str, _содержимое: bytes, имя: str):
+    import pandas as pd
+    
+    if имя.lower().endswith(".parquet"):
+        сделки = pd.read_parquet(io.BytesIO(_содержимое))
+    else:
+        сделки = pd.read_csv(io.BytesIO(_содержимое), encoding="utf-8-sig")
+    нет_колонок = {"сумма", "форма", "тип_сделки"} - set(сделки.columns)
+    if нет_колонок:
+        raise ValueError(f"В реестре нет колонок: {', '.join(sorted(нет_колонок))}")
+    if "ok" in сделки:
+        сделки = сделки[сделки["ok"].astype(str) == "True"]
+    return СимуляторПорогов(сделки)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def симулятор_архива(версия: tuple):
+    # Новый симулятор — только когда архив изменился; пока админ двигает пороги, версия та же
+    return СимуляторПорогов(архив().сделки())
+
+
+def показать_симуляцию(пороги: dict, новые: dict):
+    st.markdown('<div class="npk-section-title">Что изменится</div>', unsafe_allow_html=True)
+    источник = st.radio("Сделки", ["История анализов", "Реестр из файла"], horizontal=True, key="sim_источник")
+    if источник == "История анализов":
+        try:
+            симулятор = симулятор_архива(архив().версия())
+        except Exception as e:
+            st.error(f"Не удалось прочитать историю: {e}")
+            return
+        if not симулятор.сделок:
+            st.caption("В истории нет сделок с определённой зоной — загрузите реестр сделок из batch.py")
+            return
+    else:
+        реестр = st.file_uploader("Реестр сделок (CSV или Parquet из batch.py)", type=["csv", "parquet"], key="sim_registry")
+        if not реестр:
+            st.caption("Загрузите реестр сделок, чтобы увидеть, сколько сделок сменит зону при новых порогах")
+            return
+        содержимое = реестр.getvalue()
+        try:
+            симулятор = симулятор_реестра(hashlib.sha256(содержимое).hexdigest(), содержимое, реестр.name)
+        except Exception as e:
+            st.error(f"Не удалось прочитать реестр: {e}")
+            return
+    
+    итог = симулятор.сравнить(пороги, новые)
+    st.markdown(f"**Сделок: {итог['сделок']:,} | сменят зону: {итог['сменят_зону']:,}**")
+    emoji = {"зелёная": "🟢", "жёлтая": "🟡", "красная": "🔴"}
+    колонки = st.columns(3)
+    for колонка, зона in zip(колонки, ЗОНЫ):
+        колонка.metric(f"{emoji[зона]} {зона.capitalize()}", f"{итог['станет'][зона]:,}",
+                       delta=итог["станет"][зона] - итог["было"][зона], delta_color="off")
+    
+    import pandas as pd
+    st.dataframe(pd.DataFrame(
+        итог["матрица"],
+        index=[f"было: {з}" for з in ЗОНЫ],
+        columns=[f"станет: {з}" for з in ЗОНЫ],
+    ), use_container_width=True)
 
 
 # ============================================================================
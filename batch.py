@@ -0,0 +1,292 @@
+"""
+Пакетный анализ договоров Регламента Светофор.
+
+Каталог или ZIP-архив с TXT/DOCX/PDF обрабатывается в пуле процессов:
+загрузка → извлечение данных → зона → RAG-сличение. Строки реестра
+(CSV или Parquet) пишутся по мере готовности файлов, ошибка в одном
+файле — даже падение обрабатывающего процесса — не останавливает остальные.
+
+Запуск: python batch.py ДОГОВОРЫ.zip -o реестр.csv [-j 8] [--форма "Типовая форма (ТФ)"]
+"""
+
+import argparse, csv, os, sys, time, zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import core
+
+РАСШИРЕНИЯ = (".txt", ".docx", ".pdf")
+ФОРМА_ПО_УМОЛЧАНИЮ = "Форма контрагента"
+РАЗМЕР_ГРУППЫ_PARQUET = 50
+
+ПОЛЯ = [
+    "файл", "ok", "ошибка", "тип_документа", "номер", "дата", "сумма", "контрагент",
+    "форма", "тип_сделки", "зона", "причина", "юд", "срок",
+    "тф", "вердикт", "соответствие", "красных", "жёлтых", "нарушения", "время_с",
+]
+
+
+# ============================================================================
+# ИСТОЧНИКИ
+# ============================================================================
+
+def имя_в_архиве(info: zipfile.ZipInfo) -> str:
+    # Без флага UTF-8 zipfile читает имена как cp437, а Windows пишет кириллицу в cp866
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("cp866")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def найти_файлы(путь: str) -> List[Tuple[str, Optional[str], str]]:
+    """Список (путь к файлу или архиву, имя внутри архива, отображаемое имя)."""
+    файлы = []
+    if os.path.isdir(путь):
+        for корень, _, имена in os.walk(путь):
+            for имя in sorted(имена):
+                if имя.lower().endswith(РАСШИРЕНИЯ):
+                    полный = os.path.join(корень, имя)
+                    файлы.append((полный, None, os.path.relpath(полный, путь)))
+    elif zipfile.is_zipfile(путь):
+        with zipfile.ZipFile(путь) as архив:
+            for info in архив.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(РАСШИРЕНИЯ):
+                    файлы.append((путь, info.filename, имя_в_архиве(info)))
+    elif путь.lower().endswith(РАСШИРЕНИЯ):
+        файлы.append((путь, None, os.path.basename(путь)))
+    return sorted(файлы, key=lambda ф: ф[2])
+
+
+@contextmanager
+def открыть(путь: str, член: Optional[str]):
+    """Содержимое файла буфером без копии: mmap для файла на диске, член архива — кусками."""
+    if член is None:
+        with core.буфер_загрузки(путь) as буфер:
+            yield буфер
+        return
+    with zipfile.ZipFile(путь) as архив, архив.open(член) as поток, core.буфер_загрузки(поток) as буфер:
+        yield буфер
+
+
+# ============================================================================
+# ОБРАБОТКА ОДНОГО ФАЙЛА (в дочернем процессе)
+# ============================================================================
+
+def обработать(источник: Tuple[str, Optional[str], str], форма: str, тип_сделки: str,
+               пороги: Optional[Dict]) -> Dict:
+    путь, член, имя = источник
+    строка = {поле: "" for поле in ПОЛЯ}
+    строка.update({"файл": имя, "ok": False, "форма": форма, "тип_сделки": тип_сделки})
+    начало = time.perf_counter()
+    try:
+        # Файлы уже разбираются пулом процессов — PDF внутри файла читается последовательно
+        with открыть(путь, член) as буфер:
+            ok, текст = core.разобрать_содержимое(буфер, имя, процессов=1)
+        if not ok:
+            строка["ошибка"] = текст
+            return строка
+
+        извл = core.извлечь_все_данные(текст)
+        тип_док = извл["тип_док"]
+        сумма = извл.get("сумма") or 0
+        зона = core.определить_зону(сумма, форма, тип_сделки, пороги)
+        строка.update({
+            "ok": True,
+            "тип_документа": тип_док.get("название", ""),
+            "номер": извл.get("номер") or "",
+            "дата": извл["дата"].isoformat() if извл.get("дата") else "",
+            "сумма": сумма,
+            "контрагент": извл.get("контрагент") or "",
+            "зона": зона["зона"], "причина": зона["причина"], "юд": зона["юд"], "срок": зона["срок"],
+        })
+
+        правила = core.набор_правил()
+        if тип_док.get("тип") in правила.формы:
+            rag = core.анализ_rag(
+                текст, тип_док["тип"], правила=правила,
+                макс_охват=core.ОХВАТ_ПРАВИЛА, бюджет_мс=core.БЮДЖЕТ_ПРАВИЛА_МС,
+            )
+            строка.update({
+                "тф": rag["название_тф"], "вердикт": rag["вердикт"], "соответствие": rag["соответствие"],
+                "красных": rag["красных"], "жёлтых": rag["жёлтых"],
+                "нарушения": "; ".join(н["название"] for н in rag["нарушения"]),
+            })
+    except Exception as e:
+        строка["ok"] = False
+        строка["ошибка"] = f"{type(e).__name__}: {e}"
+    finally:
+        строка["время_с"] = round(time.perf_counter() - начало, 3)
+    return строка
+
+
+# ============================================================================
+# РЕЕСТР
+# ============================================================================
+
+class РеестрCSV:
+    def __init__(self, путь: str):
+        # utf-8-sig — чтобы Excel сразу открывал кириллицу
+        self._f = open(путь, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.DictWriter(self._f, fieldnames=ПОЛЯ)
+        self._writer.writeheader()
+
+    def записать(self, строка: Dict):
+        self._writer.writerow(строка)
+        self._f.flush()
+
+    def закрыть(self):
+        self._f.close()
+
+
+class РеестрParquet:
+    def __init__(self, путь: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Для реестра в формате Parquet нужен пакет pyarrow")
+        self._pa = pa
+        self._схема = pa.schema([
+            (поле, pa.bool_() if поле in ("ok", "юд") else
+                   pa.float64() if поле in ("сумма", "время_с") else
+                   pa.int64() if поле in ("срок", "соответствие", "красных", "жёлтых") else
+                   pa.string())
+            for поле in ПОЛЯ
+        ])
+        self._writer = pq.ParquetWriter(путь, self._схема)
+        self._буфер = []
+
+    def записать(self, строка: Dict):
+        self._буфер.append({п: (None if строка.get(п) == "" else строка.get(п)) for п in ПОЛЯ})
+        if len(self._буфер) >= РАЗМЕР_ГРУППЫ_PARQUET:
+            self._сбросить()
+
+    def _сбросить(self):
+        if self._буфер:
+            self._writer.write_table(self._pa.Table.from_pylist(self._буфер, schema=self._схема))
+            self._буфер = []
+
+    def закрыть(self):
+        self._сбросить()
+        self._writer.close()
+
+
+def открыть_реестр(путь: str):
+    return РеестрParquet(путь) if путь.lower().endswith(".parquet") else РеестрCSV(путь)
+
+
+# ============================================================================
+# ПАКЕТНЫЙ АНАЛИЗ
+# ============================================================================
+
+def вывести_прогресс(готово: int, всего: int, строка: Dict):
+    итог = строка["зона"] if строка["ok"] else f"ОШИБКА: {строка['ошибка']}"
+    print(f"[{готово}/{всего}] {строка['файл']} — {итог} ({строка['время_с']} с)", file=sys.stderr, flush=True)
+
+
+def строка_сбоя(источник: Tuple[str, Optional[str], str], форма: str, тип_сделки: str, e: Exception) -> Dict:
+    # Файл, на котором упал сам процесс-обработчик (например, нехватка памяти)
+    строка = {поле: "" for поле in ПОЛЯ}
+    строка.update({"файл": источник[2], "ok": False, "форма": форма,
+                   "тип_сделки": тип_сделки, "ошибка": f"{type(e).__name__}: {e}"})
+    return строка
+
+
+def обработать_в_пуле(очередь: deque, процессов: int, параметры: Tuple, учесть) -> List[Tuple]:
+    """Файлы из очереди в пуле процессов; готовые строки — в учесть(строка).
+
+    В работе не больше двух файлов на процесс. Если процесс пула падает, пул
+    уже не принимает заданий: возвращаются файлы, бывшие в работе, — один из
+    них причина сбоя, — а ещё не начатые остаются в очереди.
+    """
+    with ProcessPoolExecutor(max_workers=процессов) as пул:
+        в_работе = {}
+        while очередь or в_работе:
+            while очередь and len(в_работе) < 2 * процессов:
+                источник = очередь.popleft()
+                в_работе[пул.submit(обработать, источник, *параметры)] = источник
+            сделано, _ = wait(в_работе, return_when=FIRST_COMPLETED)
+            if any(isinstance(задача.exception(), BrokenProcessPool) for задача in сделано):
+                break
+            for задача in сделано:
+                источник = в_работе.pop(задача)
+                if задача.exception() is not None:
+                    учесть(строка_сбоя(источник, *параметры[:2], задача.exception()))
+                else:
+                    учесть(задача.result())
+        else:
+            return []
+    # Успевшие до сбоя файлы учитываются, остальные — под подозрением
+    подозрительные = []
+    for задача, источник in в_работе.items():
+        if задача.done() and задача.exception() is None:
+            учесть(задача.result())
+        else:
+            подозрительные.append(источник)
+    return подозрительные
+
+
+def пакетный_анализ(путь: str, выход: str, процессов: Optional[int] = None,
+                    форма: str = ФОРМА_ПО_УМОЛЧАНИЮ, тип_сделки: str = "",
+                    пороги: Optional[Dict] = None, прогресс=вывести_прогресс) -> Dict:
+    файлы = найти_файлы(путь)
+    итог = {"всего": len(файлы), "успешно": 0, "ошибок": 0, "зоны": {}, "время_с": 0.0}
+    начало = time.perf_counter()
+    процессов = процессов or os.cpu_count() or 1
+    параметры = (форма, тип_сделки, пороги)
+    реестр = открыть_реестр(выход)
+    готово = 0
+
+    def учесть(строка: Dict):
+        nonlocal готово
+        готово += 1
+        реестр.записать(строка)
+        if строка["ok"]:
+            итог["успешно"] += 1
+            итог["зоны"][строка["зона"]] = итог["зоны"].get(строка["зона"], 0) + 1
+        else:
+            итог["ошибок"] += 1
+        if прогресс:
+            прогресс(готово, len(файлы), строка)
+
+    очередь = deque(файлы)
+    try:
+        while очередь:
+            # Падение процесса ломает весь пул: остальные файлы идут в новом пуле,
+            # а бывшие в работе перепроверяются по одному, чтобы найти виновника
+            for источник in обработать_в_пуле(очередь, процессов, параметры, учесть):
+                if обработать_в_пуле(deque([источник]), 1, параметры, учесть):
+                    учесть(строка_сбоя(источник, форма, тип_сделки,
+                                       BrokenProcessPool("процесс-обработчик аварийно завершился на этом файле")))
+    finally:
+        реестр.закрыть()
+    итог["время_с"] = round(time.perf_counter() - начало, 2)
+    return итог
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетный анализ договоров (Регламент Светофор)")
+    parser.add_argument("путь", help="каталог, ZIP-архив или отдельный файл TXT/DOCX/PDF")
+    parser.add_argument("-o", "--выход", default="реестр.csv", help="реестр результатов: .csv или .parquet")
+    parser.add_argument("-j", "--процессов", type=int, default=None, help="размер пула (по умолчанию — число ядер)")
+    parser.add_argument("--форма", default=ФОРМА_ПО_УМОЛЧАНИЮ, choices=core.ФОРМЫ_ДОКУМЕНТА)
+    parser.add_argument("--тип", default="", choices=[""] + core.КРАСНАЯ_ЗОНА + core.ЖЁЛТАЯ_ЗОНА,
+                        help="тип сделки для всех файлов пакета")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.путь):
+        parser.error(f"не найден: {args.путь}")
+    итог = пакетный_анализ(args.путь, args.выход, args.процессов, args.форма, args.тип)
+    зоны = ", ".join(f"{з}: {n}" for з, n in sorted(итог["зоны"].items())) or "—"
+    print(f"Готово: {итог['успешно']} из {итог['всего']}, ошибок {итог['ошибок']}, "
+          f"{итог['время_с']} с. Зоны — {зоны}. Реестр: {args.выход}", file=sys.stderr)
+    return 0 if итог["ошибок"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
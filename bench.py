@@ -0,0 +1,355 @@
+"""
+Замеры производительности Регламента Светофор.
+
+Запуск: python bench.py [rag] [охват] [импорт] [зоны] [симуляция] [промпт] [docx] [pdf] [загрузка] [окна]
+"""
+
+import importlib.util, io, os, random, statistics, subprocess, sys, tempfile, time, zipfile
+from xml.sax.saxutils import escape
+
+import core
+
+
+АБЗАЦЫ = [
+    "{n}. Стороны обязуются соблюдать условия договора, оказывать услуги по перевозке грузов "
+    "в вагонах надлежащего качества и в согласованные сроки.",
+    "{n}. Заказчик обязан своевременно предоставлять документы, а Исполнитель — отчёты о ходе оказания услуг.",
+    "{n}. Стороны несут ответственность в соответствии с законодательством Российской Федерации.",
+]
+
+
+def синтетический_договор(символов: int = 300_000, seed: int = 0, с_нарушениями: bool = True) -> str:
+    # Длинный договор: типовые абзацы, а в конце — демо-договор с нарушениями
+    rnd = random.Random(seed)
+    части, n, длина = [], 0, 0
+    while длина < символов:
+        n += 1
+        абзац = rnd.choice(АБЗАЦЫ).format(n=f"{n // 10 + 6}.{n % 10}")
+        части.append(абзац)
+        длина += len(абзац) + 1
+    хвост = core.ДЕМО_ДОГОВОР if с_нарушениями else ""
+    return "\n".join(части)[:max(0, символов - len(хвост))] + "\n" + хвост
+
+
+def замер(f, повторов: int = 10) -> float:
+    f()
+    t0 = time.perf_counter()
+    for _ in range(повторов):
+        f()
+    return (time.perf_counter() - t0) / повторов * 1000
+
+
+def бенчмарк_rag(символов: int = 300_000, код_тф: str = "услуги_тэо"):
+    текст = синтетический_договор(символов)
+    правила = core.набор_правил()
+    форма = правила.формы[код_тф]
+
+    def по_правилам():
+        # Прежняя схема: каждый паттерн отдельно сканирует весь текст
+        текст_l = текст.lower()
+        return [п["regex"].search(текст_l) for п in форма["правила"]]
+
+    def сканер():
+        текст_l = текст.lower()
+        позиции = форма["сканер"].позиции(текст_l)
+        return [core.найти_правило(п, текст_l, позиции) for п in форма["правила"]]
+
+    до = [m and m.span() for m in по_правилам()]
+    после = [m and m.span() for m in сканер()]
+    assert до == после, "результаты сканера расходятся с re.search"
+
+    t_до, t_после = замер(по_правилам), замер(сканер)
+    print(f"RAG {код_тф}, {len(текст):,} символов, {len(форма['правила'])} правил")
+    print(f"  re.search по каждому правилу: {t_до:8.1f} мс")
+    print(f"  однопроходный сканер:         {t_после:8.1f} мс  (x{t_до / t_после:.1f})")
+
+
+def бенчмарк_охвата(символов: int = 300_000, код_тф: str = "услуги_тэо"):
+    # Договор без нарушений: «заказчик» встречается сотни раз, а «несёт … риск» — нигде,
+    # поэтому ленивое .*? без ограничения охвата даёт квадратичный перебор
+    текст = синтетический_договор(символов, с_нарушениями=False)
+    print(f"RAG {код_тф}, {len(текст):,} символов без нарушений")
+    for подпись, параметры in [
+        ("без ограничений", {"окно": None}),
+        (f"охват {core.ОХВАТ_ПРАВИЛА} симв.", {"макс_охват": core.ОХВАТ_ПРАВИЛА}),
+        ("в пределах пункта", {"в_пределах_пункта": True, "окно": None}),
+        ("без ограничений, бюджет 100 мс", {"бюджет_мс": 100, "окно": None}),
+    ]:
+        t0 = time.perf_counter()
+        r = core.анализ_rag(текст, код_тф, **параметры)
+        мс = (time.perf_counter() - t0) * 1000
+        пропущено = ", ".join(п["название"] for п in r["превышен_бюджет"]) or "—"
+        print(f"  {подпись:32s} {мс:8.1f} мс  нарушений: {len(r['нарушения'])}, превышен бюджет: {пропущено}")
+
+
+def бенчмарк_импорта(повторов: int = 7):
+    # Холодный импорт ядра в отдельном процессе; streamlit и тяжёлые библиотеки не должны подтягиваться
+    код = (
+        "import sys, time; t = time.perf_counter(); import core; "
+        "print((time.perf_counter() - t) * 1000, *[m for m in ('streamlit', 'pandas', 'requests', 'docx', 'PyPDF2') if m in sys.modules])"
+    )
+    замеры, лишние = [], set()
+    for _ in range(повторов):
+        вывод = subprocess.run([sys.executable, "-c", код], capture_output=True, text=True, check=True).stdout.split()
+        замеры.append(float(вывод[0]))
+        лишние.update(вывод[1:])
+    print(f"Импорт core: медиана {statistics.median(замеры):.1f} мс, минимум {min(замеры):.1f} мс")
+    print(f"  лишние модули: {', '.join(sorted(лишние)) or 'нет'}")
+
+
+def синтетический_реестр(строк: int = 1_000_000, seed: int = 0):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    типы = np.array([""] * 6 + core.КРАСНАЯ_ЗОНА + core.ЖЁЛТАЯ_ЗОНА, dtype=object)
+    return pd.DataFrame({
+        "сумма": rng.lognormal(12, 2, строк).round(),
+        "форма": rng.choice(np.array(core.ФОРМЫ_ДОКУМЕНТА, dtype=object), строк),
+        "тип_сделки": rng.choice(типы, строк),
+    })
+
+
+def бенчмарк_зон(строк: int = 1_000_000, проверка: int = 20_000):
+    сделки = синтетический_реестр(строк)
+    мс = замер(lambda: core.определить_зоны(сделки), повторов=3)
+    зоны = core.определить_зоны(сделки)
+
+    # Построчная сверка с определить_зону на случайной выборке
+    выборка = сделки.sample(min(проверка, строк), random_state=1)
+    for i, сделка in zip(выборка.index, выборка.itertuples(index=False)):
+        ожидается = core.определить_зону(сделка.сумма, сделка.форма, сделка.тип_сделки)
+        получено = зоны.loc[i]
+        assert (получено["зона"], получено["причина"], bool(получено["юд"]), int(получено["срок"])) == (
+            ожидается["зона"], ожидается["причина"], ожидается["юд"], ожидается["срок"]), (i, ожидается)
+    print(f"Зоны: {строк:,} сделок за {мс:.0f} мс, сверено с определить_зону: {len(выборка):,} строк")
+
+
+def бенчмарк_симуляции(строк: int = 1_000_000):
+    сделки = синтетический_реестр(строк)
+    t0 = time.perf_counter()
+    симулятор = core.СимуляторПорогов(сделки)
+    мс_сборки = (time.perf_counter() - t0) * 1000
+
+    # Как при движении number_input: каждый запрос — новый порог
+    пороги = [{"зелёная_тф_макс": 100_000 + 10_000 * i} for i in range(200)]
+    t0 = time.perf_counter()
+    for новые in пороги:
+        итог = симулятор.сравнить(core.DEFAULT_THRESHOLDS, новые)
+    мс_запроса = (time.perf_counter() - t0) * 1000 / len(пороги)
+    print(f"Симуляция порогов: {строк:,} сделок, подготовка {мс_сборки:.0f} мс, "
+          f"запрос {мс_запроса:.2f} мс (сменят зону при последнем: {итог['сменят_зону']:,})")
+
+
+def бенчмарк_промпта(символов: int = 300_000, код_тф: str = "услуги_тэо"):
+    # Нарушения — в хвосте длинного договора: первые 5000 символов их не видят
+    текст = синтетический_договор(символов)
+    извл = core.извлечь_все_данные(текст)
+    rag = core.анализ_rag(текст, код_тф, макс_охват=core.ОХВАТ_ПРАВИЛА)
+    пункты = [н["пункт"] for н in rag["нарушения"] if н.get("пункт")]
+    мс = замер(lambda: core.построить_промпт(текст, извл, rag), повторов=5)
+    промпт = core.построить_промпт(текст, извл, rag)
+    первые = текст[:5000]
+    print(f"Промпт AI, {len(текст):,} символов, нарушений в пунктах: {len(пункты)}")
+    print(f"  первые 5000 символов: ≈{core.оценить_токены(первые):,} ток., пунктов с нарушениями: "
+          f"{sum(п in первые for п in пункты)}")
+    print(f"  ключевые пункты:      ≈{core.оценить_токены(промпт):,} ток. на весь промпт, пунктов с нарушениями: "
+          f"{sum(п in промпт for п in пункты)}, сборка {мс:.1f} мс")
+
+
+def синтетический_docx(символов: int = 3_000_000, строк_таблицы: int = 20) -> bytes:
+    # Минимальный DOCX без python-docx: абзацы договора и после каждых 50 — таблица ставок.
+    # К типовым абзацам добавлены случайные числа, иначе архив сжимается нереалистично сильно
+    rnd = random.Random(0)
+    абзацы = [f"{абзац} Ставка {rnd.randrange(10**6)} руб., срок {rnd.randrange(1000)} дн., код {rnd.getrandbits(40):x}."
+              for абзац in синтетический_договор(символов, с_нарушениями=True).split("\n")]
+    xml = io.StringIO()
+    xml.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+              '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>')
+    for i, абзац in enumerate(абзацы):
+        xml.write(f'<w:p><w:pPr><w:tabs><w:tab w:val="left" w:pos="720"/></w:tabs></w:pPr>'
+                  f'<w:r><w:t xml:space="preserve">{escape(абзац)}</w:t></w:r></w:p>')
+        if i % 50 == 49:
+            xml.write("<w:tbl>")
+            for r in range(строк_таблицы):
+                xml.write("<w:tr>" + "".join(
+                    f"<w:tc><w:p><w:r><w:t>{знач}</w:t></w:r></w:p></w:tc>"
+                    for знач in (f"Простой, тип {r}", f"{2500 + r * 10} руб/сутки", f"пункт 4.{r}")) + "</w:tr>")
+            xml.write("</w:tbl>")
+    xml.write("<w:sectPr/></w:body></w:document>")
+    буфер = io.BytesIO()
+    with zipfile.ZipFile(буфер, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml",
+                   '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                   '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                   '<Default Extension="xml" ContentType="application/xml"/>'
+                   '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                   '</Types>')
+        z.writestr("_rels/.rels",
+                   '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                   '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+                   '</Relationships>')
+        z.writestr("word/document.xml", xml.getvalue())
+    return буфер.getvalue()
+
+
+def бенчмарк_docx(символов: int = 3_000_000):
+    # Каждый способ — в отдельном процессе: пик RSS (VmHWM, сброшенный перед замером через
+    # /proc/self/clear_refs) включает память lxml, которую не видит tracemalloc
+    путь = os.path.join(tempfile.mkdtemp(), "большой.docx")
+    with open(путь, "wb") as f:
+        f.write(синтетический_docx(символов))
+    способы = {
+        "python-docx, только абзацы": "from docx import Document; d = Document(io.BytesIO(b)); "
+                                      "т = '\\n'.join(p.text for p in d.paragraphs if p.text.strip())",
+        "потоковый, весь документ": "т = '\\n'.join(core.читать_docx(b, макс_символов=None))",
+        f"потоковый, до {core.МАКС_СИМВОЛОВ_ДОКУМЕНТА:,} симв.": "т = '\\n'.join(core.читать_docx(b))",
+    }
+    print(f"DOCX {os.path.getsize(путь) / 2**20:.1f} МБ, ≈{символов:,} символов текста и таблицы ставок")
+    for подпись, код in способы.items():
+        if подпись.startswith("python-docx") and importlib.util.find_spec("docx") is None:
+            print(f"  {подпись:32s} python-docx не установлен")
+            continue
+        вывод = subprocess.run([sys.executable, "-c", (
+            "import io, sys, time, core; b = open(sys.argv[1], 'rb').read(); "
+            "кб = lambda к: next(int(с.split()[1]) for с in open('/proc/self/status') if с.startswith(к)); "
+            "open('/proc/self/clear_refs', 'w').write('5'); до = кб('VmRSS'); t0 = time.perf_counter(); "
+            f"{код}; мс = (time.perf_counter() - t0) * 1000; "
+            "print(мс, (кб('VmHWM') - до) / 1024, len(т), т.count(' | '))"),
+            путь], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        мс, мб, длина, ячеек = float(вывод[0]), float(вывод[1]), int(вывод[2]), int(вывод[3])
+        print(f"  {подпись:32s} {мс:8.0f} мс, пик памяти +{мб:6.1f} МБ, {длина:,} символов, разделителей ячеек: {ячеек:,}")
+
+
+def синтетический_pdf(страниц: int = 300, строк: int = 60) -> bytes:
+    # PDF с текстовым слоем без сторонних библиотек: страница — 60 строк Helvetica (латиница)
+    rnd = random.Random(0)
+    объекты = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    листы = []
+    for n in range(страниц):
+        строки_текста = " ".join(
+            f"({n + 1}.{k + 1}. Party shall pay {rnd.randrange(10**6)} RUB within {rnd.randrange(90)} days) '"
+            for k in range(строк))
+        поток = f"BT /F1 9 Tf 11 TL 40 800 Td {строки_текста} ET".encode()
+        объекты.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(поток), поток))
+        объекты.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(объекты))
+        листы.append(len(объекты))
+    объекты[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{i} 0 R" for i in листы).encode(), страниц)
+    pdf = bytearray(b"%PDF-1.4\n")
+    смещения = []
+    for i, объект in enumerate(объекты, 1):
+        смещения.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (i, объект)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(объекты) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % с for с in смещения)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(объекты) + 1, xref)
+    return bytes(pdf)
+
+
+def бенчмарк_pdf(страниц: int = 300):
+    if not core.PDF_AVAILABLE:
+        print("PDF: PyPDF2 не установлен")
+        return
+    from PyPDF2 import PdfReader
+    content = синтетический_pdf(страниц)
+    t0 = time.perf_counter()
+    весь = "\n".join(p.extract_text() or "" for p in PdfReader(io.BytesIO(content)).pages)[:core.МАКС_СИМВОЛОВ_ДОКУМЕНТА]
+    мс_прежде = (time.perf_counter() - t0) * 1000
+    print(f"PDF {страниц} стр., {len(content) / 2**20:.1f} МБ, процессоров: {os.cpu_count()}")
+    print(f"  все страницы подряд, затем [:{core.МАКС_СИМВОЛОВ_ДОКУМЕНТА:,}]: {мс_прежде:7.0f} мс")
+    for процессов in sorted({1, core.PDF_ПРОЦЕССОВ}):
+        t0 = time.perf_counter()
+        страницы = list(core.читать_pdf(content, процессов=процессов))
+        мс = (time.perf_counter() - t0) * 1000
+        текст = "\n".join(с["текст"] for с in страницы)[:core.МАКС_СИМВОЛОВ_ДОКУМЕНТА]
+        assert текст == весь, "текст расходится с извлечением всех страниц"
+        медленная = max(страницы, key=lambda с: с["мс"])
+        print(f"  с отсечкой, процессов {процессов}:{'':14s}{мс:7.0f} мс, страниц {len(страницы)} из {страниц}, "
+              f"медиана {statistics.median(с['мс'] for с in страницы):.1f} мс/стр., "
+              f"самая долгая — стр. {медленная['страница']} ({медленная['мс']:.0f} мс)")
+
+
+def бенчмарк_загрузки(мб_txt: int = 50):
+    # Пик RSS на загрузку в отдельном процессе, как в бенчмарк_docx. Прежде файл читался
+    # целиком в bytes, а TXT декодировался целиком в каждой кодировке по очереди
+    каталог = tempfile.mkdtemp()
+    договор = синтетический_договор(1_000_000, с_нарушениями=True)
+    файлы = {
+        "договор.txt": (договор * (мб_txt * 2**20 // len(договор.encode()) + 1)).encode(),
+        "договор.docx": синтетический_docx(),
+    }
+    if core.PDF_AVAILABLE:
+        файлы["договор.pdf"] = синтетический_pdf()
+    # Единственный байт не в UTF-8 в конце — прежний код декодировал файл дважды
+    файлы["договор.txt"] += "\nПодписи сторон: ООО «Ромашка»".encode("cp1251")
+    # Оба способа считают sha256 (ключ кэша разбора), извлечение данных не входит
+    прежде = ("content = open(путь, 'rb').read(); hashlib.sha256(content)\n"
+              "if путь.endswith('.txt'):\n"
+              "    for enc in ['utf-8', 'cp1251', 'cp866']:\n"
+              "        try:\n            т = content.decode(enc); break\n"
+              "        except UnicodeDecodeError:\n            pass\n"
+              "else:\n    т = core.разобрать_содержимое(content, путь)[1]")
+    теперь = ("with open(путь, 'rb') as f, core.буфер_загрузки(f) as буфер:\n"
+              "    hashlib.sha256(буфер); т = core.разобрать_содержимое(буфер, путь)[1]")
+    print("Загрузка файла: пик памяти процесса сверх исходного (VmHWM)")
+    for имя, данные in файлы.items():
+        путь = os.path.join(каталог, имя)
+        with open(путь, "wb") as f:
+            f.write(данные)
+        for подпись, код in (("прежде", прежде), ("теперь", теперь)):
+            вывод = subprocess.run([sys.executable, "-c", (
+                "import hashlib, sys, time, core\nпуть = sys.argv[1]\n"
+                "кб = lambda к: next(int(с.split()[1]) for с in open('/proc/self/status') if с.startswith(к))\n"
+                "open('/proc/self/clear_refs', 'w').write('5'); до = кб('VmRSS'); t0 = time.perf_counter()\n"
+                f"{код}\n"
+                "print((time.perf_counter() - t0) * 1000, (кб('VmHWM') - до) / 1024, len(т))"),
+                путь], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+            мс, мб, длина = float(вывод[0]), float(вывод[1]), int(вывод[2])
+            print(f"  {имя:14s} {len(данные) / 2**20:5.1f} МБ, {подпись}: {мс:7.0f} мс, пик +{мб:6.1f} МБ, "
+                  f"{длина:,} символов")
+
+
+def бенчмарк_окон(размеры=(300_000, 2_000_000, 8_000_000), код_тф: str = "услуги_тэо"):
+    # Нарушения — в приложении в самом конце договора. Пик RSS (VmHWM) — как в бенчмарк_docx,
+    # текст создаётся до сброса пика, поэтому в замер входит только сам анализ
+    print(f"RAG и экстракторы по окнам {core.ОКНО_АНАЛИЗА:,} символов, охват {core.ОХВАТ_ПРАВИЛА}")
+    for символов in размеры:
+        for подпись, окно in (("весь текст", None), ("по окнам", core.ОКНО_АНАЛИЗА)):
+            вывод = subprocess.run([sys.executable, "-c", (
+                "import sys, time, core, bench\n"
+                f"текст = bench.синтетический_договор({символов})\n"
+                # Память, освобождённая после генерации текста, — вернуть системе, чтобы не маскировала пик
+                "import ctypes; ctypes.CDLL('libc.so.6').malloc_trim(0)\n"
+                "кб = lambda к: next(int(с.split()[1]) for с in open('/proc/self/status') if с.startswith(к))\n"
+                "open('/proc/self/clear_refs', 'w').write('5'); до = кб('VmRSS'); t0 = time.perf_counter()\n"
+                "извл = core.извлечь_все_данные(текст)\n"
+                f"rag = core.анализ_rag(текст, {код_тф!r}, макс_охват=core.ОХВАТ_ПРАВИЛА, окно={окно})\n"
+                "print((time.perf_counter() - t0) * 1000, (кб('VmHWM') - до) / 1024, len(rag['нарушения']), извл['инн'])"),
+                ], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+            мс, мб, нарушений = float(вывод[0]), float(вывод[1]), int(вывод[2])
+            print(f"  {символов:>10,} символов, {подпись:10s}: {мс:7.0f} мс, пик +{мб:6.1f} МБ, "
+                  f"нарушений {нарушений}, ИНН контрагента {вывод[3]}")
+
+
+БЕНЧМАРКИ = {
+    "rag": бенчмарк_rag,
+    "охват": бенчмарк_охвата,
+    "импорт": бенчмарк_импорта,
+    "зоны": бенчмарк_зон,
+    "симуляция": бенчмарк_симуляции,
+    "промпт": бенчмарк_промпта,
+    "docx": бенчмарк_docx,
+    "pdf": бенчмарк_pdf,
+    "загрузка": бенчмарк_загрузки,
+    "окна": бенчмарк_окон,
+}
+
+
+if __name__ == "__main__":
+    for имя in sys.argv[1:] or БЕНЧМАРКИ:
+        БЕНЧМАРКИ[имя]()
@@ -0,0 +1,2878 @@
+"""
+Регламент Светофор — ядро без интерфейса.
+
+Извлечение данных, RAG-сличение с типовыми формами, определение зоны,
+AI-экспертиза и разбор файлов. Streamlit не нужен: настройки передаются
+параметрами, тяжёлые библиотеки (PyPDF2, requests) импортируются
+только при первом использовании.
+"""
+
+import re, os, json, hashlib, io, time, threading, bisect, functools
+from array import array
+import importlib.util
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, List, Tuple, Optional
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Библиотеки
+PDF_AVAILABLE = importlib.util.find_spec("PyPDF2") is not None
+REQUESTS_AVAILABLE = importlib.util.find_spec("requests") is not None
+
+# ============================================================================
+# КОНСТАНТЫ
+# ============================================================================
+
+DEFAULT_ORG = {
+    "full_name": 'АО «Старая перевозочная компания»',
+    "short_name": 'АО «СПК»',
+    "inn": "7701234567",
+}
+
+DEFAULT_THRESHOLDS = {
+    "зелёная_тф_макс": 100_000,
+    "зелёная_нетф_макс": 50_000,
+    "жёлтая_макс": 5_000_000,
+}
+
+AI_ПРОВАЙДЕРЫ = {
+    "openai": {"название": "OpenAI GPT-4", "url": "https://platform.openai.com/api-keys", "цена": "$0.15/1M"},
+    "anthropic": {"название": "Anthropic Claude", "url": "https://console.anthropic.com/settings/keys", "цена": "$0.25/1M"},
+    "gigachat": {"название": "GigaChat", "url": "https://developers.sber.ru/portal/products/gigachat-api", "цена": "Бесплатно"},
+    "yandexgpt": {"название": "YandexGPT", "url": "https://console.cloud.yandex.ru/", "цена": "1.2₽/1000"},
+}
+
+# Каталог для кэшей и архива; SVETOFOR_DATA_DIR переопределяет
+КАТАЛОГ_ДАННЫХ = os.environ.get("SVETOFOR_DATA_DIR") or os.path.join(os.path.expanduser("~"), ".svetofor")
+
+
+def путь_данных(имя: str) -> str:
+    os.makedirs(КАТАЛОГ_ДАННЫХ, exist_ok=True)
+    return os.path.join(КАТАЛОГ_ДАННЫХ, имя)
+
+
+КРАСНАЯ_ЗОНА = ["Аренда вагонов", "Лизинг вагонов", "Покупка вагонов", "Договор с РЖД", "Кредит", "Займ"]
+ЖЁЛТАЯ_ЗОНА = ["Договор ТЭО", "Рамочный договор", "Единственный поставщик"]
+ФОРМЫ_ДОКУМЕНТА = ["Типовая форма (ТФ)", "Форма контрагента", "Свободная форма"]
+
+# ============================================================================
+# ТИПОВЫЕ ФОРМЫ
+# ============================================================================
+
+ТИПОВЫЕ_ФОРМЫ = {
+    "услуги_тэо": {
+        "название": "Договор ТЭО",
+        "код": "ТФ-СПК-001",
+        "роль": "Заказчик",
+        "маркеры": ["исполнитель", "заказчик", "услуги", "вагон", "перевозка"],
+        "пункты": {
+            "предоплата": {"эталон": "Предоплата не более 30%", "паттерн": r"предоплат\w*.*?(?:[4-9]\d|100)\s*%", "критичность": "красный"},
+            "срок_оплаты": {"эталон": "Оплата в течение 5 рабочих дней", "паттерн": r"оплат\w*.*?(?:1|2|3)\s*(?:рабоч|календарн|банковск)", "критичность": "жёлтый"},
+            "неустойка": {"эталон": "Неустойка не более 0.1% в день", "паттерн": r"неустойк\w*.*?(?:0[,.]?[3-9]|[1-9])\s*%", "критичность": "красный"},
+            "штраф_простой": {"эталон": "Штраф за простой не более 2500 руб/сутки", "паттерн": r"(?:штраф|простой).*?(?:[3-9]\d{3}|[1-9]\d{4,})\s*(?:руб|₽)", "критичность": "красный"},
+            "штраф_конфиденциальность": {"эталон": "Штраф за конфиденциальность не более 3 млн", "паттерн": r"(?:штраф|конфиденциальност).*?(?:[5-9]|[1-9]\d)\s*(?:000\s*000|млн)", "критичность": "красный"},
+            "все_риски": {"эталон": "Риски распределяются между сторонами", "паттерн": r"заказчик.*?(?:несёт|принимает).*?(?:все|любые|полн)\w*\s*риск", "критичность": "красный"},
+            "одностороннее_изменение": {"эталон": "Изменение цены по соглашению сторон", "паттерн": r"односторонн\w+.*?(?:изменен|повыш)\w*.*?(?:цен|тариф)", "критичность": "красный"},
+            "молчание_согласие": {"эталон": "Услуги приняты после подписания акта", "паттерн": r"молчани\w*.*?(?:согласи|акцепт|принят)", "критичность": "жёлтый"},
+            "без_ограничения": {"эталон": "Неустойка с ограничением 10%", "паттерн": r"без\s*(?:ограничен|лимит|предел)", "критичность": "жёлтый"},
+        }
+    },
+    "поставка": {
+        "название": "Договор поставки",
+        "код": "ТФ-СПК-002",
+        "роль": "Покупатель",
+        "маркеры": ["поставщик", "покупатель", "товар", "поставка"],
+        "пункты": {
+            "предоплата": {"эталон": "Предоплата не более 30%", "паттерн": r"предоплат\w*.*?(?:[4-9]\d|100)\s*%", "критичность": "красный"},
+            "гарантия": {"эталон": "Гарантия не менее 12 месяцев", "паттерн": r"гарантия.*?(?:[1-6])\s*месяц", "критичность": "жёлтый"},
+        }
+    },
+}
+
+ДЕМО_ДОГОВОР = """ДОГОВОР ОКАЗАНИЯ УСЛУГ № 2025/ТЭО-001
+
+г. Москва                                           «15» января 2025 г.
+
+ООО «ТрансЛогистик» (ИНН 7707999888), именуемое «Исполнитель», и
+АО «СПК» (ИНН 7701234567), именуемое «Заказчик», заключили договор:
+
+1. ПРЕДМЕТ ДОГОВОРА
+1.1. Исполнитель оказывает услуги по предоставлению вагонов для перевозки грузов.
+
+2. СТОИМОСТЬ И РАСЧЁТЫ
+2.1. Стоимость: 8 500 000 рублей.
+2.2. Предоплата 50% в течение 5 дней.
+2.3. Оплата в течение 3 календарных дней после счёта.
+2.4. Исполнитель вправе в одностороннем порядке изменять тарифы.
+
+3. ПРИЁМКА
+3.1. Молчание Заказчика более 3 дней считается согласием с актом.
+
+4. ОТВЕТСТВЕННОСТЬ
+4.1. Штраф за простой 5000 рублей за вагоно-сутки.
+4.2. Неустойка 0,5% за день без ограничения.
+4.3. Заказчик несёт все риски по вагонам.
+
+5. КОНФИДЕНЦИАЛЬНОСТЬ
+5.1. Штраф за нарушение: 15 000 000 рублей.
+
+РЕКВИЗИТЫ:
+Заказчик: АО «СПК», ИНН 7701234567
+Исполнитель: ООО «ТрансЛогистик», ИНН 7707999888
+"""
+
+# ============================================================================
+# ОКНА ДЛИННОГО ТЕКСТА
+# ============================================================================
+
+ОКНО_АНАЛИЗА = 200_000   # символов: длиннее — RAG идёт по перекрывающимся окнам
+ЗАПАС_ОКНА = 400         # контекст нарушения (100 символов до, 80 после) и реквизиты стороны
+
+
+def окна_текста(текст: str, окно: int = ОКНО_АНАЛИЗА, перекрытие: int = 0):
+    """Куски длинного текста: (сдвиг, кусок, начало, конец).
+
+    Ядра [начало, конец) идут подряд и покрывают весь текст, кусок — это
+    текст[сдвиг:] от ЗАПАС_ОКНА до ядра до перекрытие + ЗАПАС_ОКНА после него.
+    Совпадение не длиннее перекрытия, начатое в ядре, целиком видно в своём
+    куске; засчитывая только такие, совпадение на стыке окон берут один раз.
+    Памяти нужно на один кусок, а не на весь текст.
+    """
+    n = len(текст)
+    for начало in range(0, max(n, 1), окно):
+        конец = min(n, начало + окно)
+        сдвиг = max(0, начало - ЗАПАС_ОКНА)
+        yield сдвиг, текст[сдвиг:конец + перекрытие + ЗАПАС_ОКНА], начало, конец
+
+
+# ============================================================================
+# ЛЕКСЕР
+# ============================================================================
+
+# Виды лексем. Выражения — прежние выражения экстракторов; где экстрактор искал
+# по тексту в нижнем регистре, регистр букв не учитывается
+ЛЕКСЕМЫ = {
+    "граница": r'\n\s*\d+(?:\.\d+)*\.?\s',                          # начало пункта с номером
+    "дата_прописью": r'«?(\d{1,2})»?\s*((?i:[а-яё]+))\s*(\d{4})',
+    "дата": r'(\d{1,2})\.(\d{1,2})\.(\d{4})',
+    "номер": r'№\s*([A-Za-zА-Яа-я0-9\-/]+)',
+    "сумма": r'(\d[\d\s]*\d)\s*(?:\([^)]+\))?\s*(?i:руб)',
+    "процент": r'(\d+(?:[.,]\d+)?)\s*%',
+    "юрлицо": r'((?:ООО|ОАО|ЗАО|ПАО|АО)\s*[«"]([^»"]+)[»"])',
+    "инн": r'ИНН\s*:?\s*(\d{12}|\d{10})(?!\d)',
+}
+ЛЕКСЕМЫ_ДОКУМЕНТОВ = 8   # размеченных документов в кэше
+
+_ВИДЫ_ЛЕКСЕМ = {вид: re.compile(паттерн) for вид, паттерн in ЛЕКСЕМЫ.items()}
+# Один проход: в каждой позиции, где может начаться лексема, проверяются все виды сразу,
+# поэтому лексемы разных видов могут перекрываться (граница «\n5 » — и сумма «5 000 руб»)
+_ЛЕКСЕР = re.compile(r'(?=[\n\d«№ОЗПАИ])' + "".join(
+    f"(?:(?=(?P<{вид}>{паттерн}))|)" for вид, паттерн in ЛЕКСЕМЫ.items()))
+_ГРУППЫ_ЛЕКСЕРА = [(вид, _ЛЕКСЕР.groupindex[вид]) for вид in ЛЕКСЕМЫ]
+
+
+class Лексемы:
+    """Типизированные лексемы документа со смещениями: границы пунктов, даты, №, суммы, проценты, юрлица, ИНН.
+
+    Текст размечается одним ленивым проходом: разметка продвигается ровно
+    настолько, насколько нужно запросу, и не повторяется. Лексемы одного
+    вида не перекрываются и совпадают с finditer его выражения; хранятся
+    только начала и концы, группы восстанавливаются по запросу.
+    """
+
+    def __init__(self, текст: str):
+        self.текст = текст
+        self._проход = _ЛЕКСЕР.finditer(текст)
+        self._пройдено = 0   # все лексемы, начинающиеся раньше, уже найдены
+        self._начала = {вид: array("q") for вид in ЛЕКСЕМЫ}
+        self._концы = {вид: array("q") for вид in ЛЕКСЕМЫ}
+        self._lock = threading.Lock()
+
+    def _дочитать(self, вид: str, i: int, до: Optional[int]):
+        # Размечать, пока у вида нет i-й лексемы и проход не дошёл до позиции до
+        начала, концы = self._начала, self._концы
+        нужные = начала[вид]
+        if len(нужные) > i or (до is not None and self._пройдено >= до):
+            return
+        for m in self._проход:
+            for в, группа in _ГРУППЫ_ЛЕКСЕРА:
+                с = m.start(группа)
+                if с >= 0 and (not концы[в] or с >= концы[в][-1]):
+                    начала[в].append(с)
+                    концы[в].append(m.end(группа))
+            self._пройдено = m.start() + 1
+            if len(нужные) > i or (до is not None and self._пройдено >= до):
+                return
+        self._пройдено = len(self.текст) + 1
+
+    def совпадения(self, вид: str, от: int = 0, до: Optional[int] = None):
+        """Лексемы вида, начинающиеся в [от, до), по порядку — как re.Match с группами."""
+        regex = _ВИДЫ_ЛЕКСЕМ[вид]
+        начала = self._начала[вид]
+        with self._lock:
+            self._дочитать(вид, len(self.текст) + 1, от)   # всё, что начинается до от
+            i = bisect.bisect_left(начала, от)
+        while True:
+            with self._lock:
+                self._дочитать(вид, i, до)
+                if i >= len(начала) or (до is not None and начала[i] >= до):
+                    return
+                с = начала[i]
+            yield regex.match(self.текст, с)
+            i += 1
+
+    def первая(self, вид: str, от: int = 0, до: Optional[int] = None):
+        return next(self.совпадения(вид, от, до), None)
+
+    def начала(self, вид: str, от: int = 0, до: Optional[int] = None) -> List[int]:
+        with self._lock:
+            self._дочитать(вид, len(self.текст) + 1, до)
+            начала = self._начала[вид]
+            return list(начала[bisect.bisect_left(начала, от):
+                               len(начала) if до is None else bisect.bisect_left(начала, до)])
+
+
+@functools.lru_cache(maxsize=ЛЕКСЕМЫ_ДОКУМЕНТОВ)
+def лексемы(текст: str) -> Лексемы:
+    """Разметка документа, общая для экстракторов и RAG: один проход на документ."""
+    return Лексемы(текст)
+
+
+# ============================================================================
+# ЭКСТРАКТОР ДАННЫХ
+# ============================================================================
+
+def _дата_прописью(m):
+    месяцы = {'января':1,'февраля':2,'марта':3,'апреля':4,'мая':5,'июня':6,
+              'июля':7,'августа':8,'сентября':9,'октября':10,'ноября':11,'декабря':12}
+    if m:
+        try:
+            return date(int(m.group(3)), месяцы.get(m.group(2).lower(), 1), int(m.group(1)))
+        except:
+            pass
+    return None
+
+
+def _дата_цифрами(m):
+    if m:
+        try:
+            return date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+        except:
+            pass
+    return None
+
+
+def извлечь_дату(текст: str):
+    # Дата прописью в любом месте важнее даты цифрами
+    лекс = лексемы(текст)
+    return _дата_прописью(лекс.первая("дата_прописью")) or _дата_цифрами(лекс.первая("дата"))
+
+
+def извлечь_номер(текст: str):
+    m = лексемы(текст).первая("номер", 0, 500)
+    # Номер ищется в первых 500 символах — и дочитывается не дальше них
+    m = m and _ВИДЫ_ЛЕКСЕМ["номер"].match(текст, m.start(), 500)
+    if m and len(m.group(1).strip()) >= 3:
+        return m.group(1).strip()
+    return None
+
+
+def извлечь_сумму(текст: str):
+    m = лексемы(текст).первая("сумма")
+    if m:
+        try:
+            return float(re.sub(r'\s', '', m.group(1)))
+        except:
+            pass
+    return None
+
+
+def извлечь_контрагента(текст: str):
+    for m in лексемы(текст).совпадения("юрлицо"):
+        # Своя организация (АО «СПК», «Старая перевозочная компания») контрагентом не считается
+        название = m.group(2).upper()
+        if 'СПК' not in название and 'СТАРАЯ' not in название:
+            return m.group(1)
+    return None
+
+
+def извлечь_инн(текст: str, контрагент: Optional[str] = None):
+    """ИНН контрагента: первый после его названия (в реквизитах стороны), иначе None."""
+    if not контрагент:
+        return None
+    лекс = лексемы(текст)
+    начало = текст.find(контрагент)
+    while начало >= 0:
+        # ИНН стороны — до названия следующего юрлица
+        после = начало + len(контрагент)
+        следующее = лекс.первая("юрлицо", после, после + 300)
+        предел = следующее.start() if следующее else после + 300
+        m = лекс.первая("инн", после, предел)
+        if m and m.end() <= предел:
+            return m.group(1)
+        начало = текст.find(контрагент, после)
+    return None
+
+
+def определить_тип_документа(текст: str):
+    текст_l = текст[:2000].lower()
+    if "договор" in текст_l or "контракт" in текст_l:
+        if "услуг" in текст_l and ("вагон" in текст_l or "перевоз" in текст_l):
+            return {"тип": "услуги_тэо", "название": "Договор ТЭО", "это_договор": True}
+        elif "поставк" in текст_l:
+            return {"тип": "поставка", "название": "Договор поставки", "это_договор": True}
+        return {"тип": "иной", "название": "Договор", "это_договор": True}
+    if "счёт" in текст_l or "счет" in текст_l:
+        return {"тип": "счёт", "название": "Счёт на оплату", "это_договор": False}
+    if "акт" in текст_l[:200]:
+        return {"тип": "акт", "название": "Акт", "это_договор": False}
+    return {"тип": "неизвестно", "название": "Документ", "это_договор": False}
+
+
+def извлечь_все_данные(текст: str):
+    """Реквизиты документа; все экстракторы читают одну разметку (см. лексемы)."""
+    контрагент = извлечь_контрагента(текст)
+    return {
+        "тип_док": определить_тип_документа(текст),
+        "дата": извлечь_дату(текст),
+        "номер": извлечь_номер(текст),
+        "сумма": извлечь_сумму(текст),
+        "контрагент": контрагент,
+        "инн": извлечь_инн(текст, контрагент),
+    }
+
+
+# ============================================================================
+# НАБОР ПРАВИЛ
+# ============================================================================
+
+РЕЕСТР_ПРАВИЛ_МАКС_НАБОРОВ = 32
+
+
+def _префиксы(элементы):
+    """Литеральные префиксы, с одного из которых обязано начинаться любое совпадение.
+
+    None — если префикс вывести нельзя (класс символов, повтор, флаги и т.п.).
+    """
+    литерал = []
+    for оп, арг in элементы:
+        if оп == sre_parse.LITERAL:
+            литерал.append(chr(арг))
+            continue
+        if литерал:
+            break
+        if оп == sre_parse.SUBPATTERN:
+            _, доб_флаги, убр_флаги, тело = арг
+            if доб_флаги or убр_флаги:
+                return None
+            return _префиксы(тело.data)
+        if оп == sre_parse.BRANCH:
+            варианты = set()
+            for вариант in арг[1]:
+                префиксы = _префиксы(вариант.data)
+                if not префиксы:
+                    return None
+                варианты |= префиксы
+            return варианты
+        return None
+    return {"".join(литерал)} if литерал else None
+
+
+def якоря_паттерна(паттерн: str):
+    try:
+        return _префиксы(sre_parse.parse(паттерн, re.IGNORECASE | re.DOTALL).data)
+    except Exception:
+        return None
+
+
+def _доп_регистры():
+    # Символы, которые re.IGNORECASE сопоставляет сверх простого lower() (о ~ ᲂ и т.п.)
+    try:
+        from re._casefix import _EXTRA_CASES
+        return _EXTRA_CASES
+    except ImportError:
+        import sre_compile
+        return sre_compile._ignorecase_fixes
+
+
+ДОП_РЕГИСТРЫ = _доп_регистры()
+
+
+class СканерЯкорей:
+    """Однопроходный поиск позиций-кандидатов сразу для всех правил формы.
+
+    Один проход по тексту в нижнем регистре находит все вхождения якорей
+    (литеральных префиксов паттернов), после чего каждое правило проверяется
+    только в этих позициях. Перекрывающиеся якоря (оплат внутри предоплат)
+    восстанавливаются по заранее вычисленным смещениям.
+    """
+
+    def __init__(self, правила: List[Dict]):
+        литералы = {я for п in правила for я in (п["якоря"] or ())}
+        # Якорь в lower() должен остаться одним символом на символ паттерна
+        self.точные = all(len(ch.lower()) == 1 for л in литералы for ch in л)
+        self.ключи = {л: л.lower() for л in литералы}
+        нижние = sorted(set(self.ключи.values()), key=len, reverse=True)
+        self.проход = re.compile("|".join(map(re.escape, нижние))) if нижние else None
+        особые = {chr(к) for л in нижние for ch in л for к in ДОП_РЕГИСТРЫ.get(ord(ch), ())}
+        self.особые = re.compile("[" + re.escape("".join(sorted(особые))) + "]") if особые else None
+        self.внутри = {}
+        self.хвосты = {}
+        for л in нижние:
+            внутри, хвосты = [], []
+            for k in range(len(л)):
+                for м in нижние:
+                    if м == л and k == 0:
+                        continue
+                    if л.startswith(м, k):
+                        внутри.append((k, м))
+                    elif k and м.startswith(л[k:]):
+                        хвосты.append((k, м))
+            self.внутри[л] = внутри
+            self.хвосты[л] = хвосты
+
+    def позиции(self, текст_l: str) -> Optional[Dict[str, List[int]]]:
+        """Позиции вхождений по каждому якорю; None — если нужен полный поиск."""
+        if self.проход is None or not self.точные or (self.особые and self.особые.search(текст_l)):
+            return None
+        найдено = {л: [] for л in self.внутри}
+        for m in self.проход.finditer(текст_l):
+            p = m.start()
+            л = m.group()
+            точки = [(0, л)] + [(p_k, м) for p_k, м in self.внутри[л]]
+            точки += [(k, м) for k, м in self.хвосты[л] if текст_l.startswith(м, p + k)]
+            for k, м in sorted(точки):
+                найдено[м].append(p + k)
+        return {л: найдено[нижний] for л, нижний in self.ключи.items()}
+
+    @staticmethod
+    def кандидаты(правило: Dict, позиции: Dict[str, List[int]]) -> List[int]:
+        якоря = правило["якоря"]
+        if len(якоря) == 1:
+            return позиции[next(iter(якоря))]
+        return sorted({p for я in якоря for p in позиции[я]})
+
+
+class НаборПравил:
+    """Паттерны всех типовых форм, скомпилированные один раз.
+
+    Набор неизменяем: любое изменение форм даёт новый набор с новой версией.
+    """
+
+    def __init__(self, все_тф: Dict, версия: int, отпечаток: str):
+        self.версия = версия
+        self.отпечаток = отпечаток
+        self.формы = {}
+        self.ошибки = []
+        for код, тф in все_тф.items():
+            правила = []
+            for название, данные in тф.get("пункты", {}).items():
+                паттерн = данные.get("паттерн", "")
+                if not паттерн:
+                    continue
+                try:
+                    regex = re.compile(паттерн, re.IGNORECASE | re.DOTALL)
+                except re.error as e:
+                    self.ошибки.append({"форма": код, "название": название, "ошибка": str(e)})
+                    continue
+                правила.append({
+                    "название": название,
+                    "эталон": данные.get("эталон", ""),
+                    "критичность": данные.get("критичность", "жёлтый"),
+                    "паттерн": паттерн,
+                    "regex": regex,
+                    "якоря": якоря_паттерна(паттерн),
+                })
+            self.формы[код] = {"название": тф.get("название", ""), "правила": правила, "сканер": СканерЯкорей(правила)}
+
+
+class РеестрПравил:
+    """Общий для всех сессий реестр наборов правил, ключ — отпечаток содержимого форм."""
+
+    def __init__(self, макс_наборов=РЕЕСТР_ПРАВИЛ_МАКС_НАБОРОВ):
+        self.макс_наборов = макс_наборов
+        self._наборы = OrderedDict()
+        self._версия = 0
+        self._lock = threading.Lock()
+
+    def получить(self, все_тф: Dict) -> НаборПравил:
+        отпечаток = hashlib.sha256(
+            json.dumps(все_тф, sort_keys=True, ensure_ascii=False, default=str).encode()
+        ).hexdigest()
+        with self._lock:
+            набор = self._наборы.get(отпечаток)
+            if набор is not None:
+                self._наборы.move_to_end(отпечаток)
+                return набор
+            self._версия += 1
+            набор = НаборПравил(все_тф, self._версия, отпечаток)
+            self._наборы[отпечаток] = набор
+            while len(self._наборы) > self.макс_наборов:
+                self._наборы.popitem(last=False)
+            return набор
+
+
+_РЕЕСТР_ПРАВИЛ = РеестрПравил()
+
+
+def реестр_правил():
+    return _РЕЕСТР_ПРАВИЛ
+
+
+def набор_правил(пользовательские_тф: Optional[Dict] = None) -> НаборПравил:
+    return реестр_правил().получить({**ТИПОВЫЕ_ФОРМЫ, **(пользовательские_тф or {})})
+
+
+# ============================================================================
+# RAG АНАЛИЗАТОР
+# ============================================================================
+
+ОХВАТ_ПРАВИЛА = 2000
+БЮДЖЕТ_ПРАВИЛА_МС = 500
+
+
+class ПревышенБюджетПравила(Exception):
+    pass
+
+
+def найти_правило(правило: Dict, текст_l: str, позиции: Optional[Dict[str, List[int]]],
+                  макс_охват: Optional[int] = None, границы: Optional[List[int]] = None,
+                  срок: Optional[float] = None):
+    """Первое совпадение правила.
+
+    Без ограничений результат совпадает с re.search. С макс_охват/границы
+    совпадение не может выходить за N символов от начала или за конец пункта,
+    поэтому каждая попытка стоит O(охвата), а не O(длины текста). срок —
+    момент time.perf_counter(), после которого поиск прерывается.
+    """
+    regex = правило["regex"]
+    ограничен = макс_охват is not None or границы is not None
+    
+    def конец(p):
+        e = len(текст_l)
+        if макс_охват is not None:
+            e = min(e, p + макс_охват)
+        if границы is not None:
+            i = bisect.bisect_right(границы, p)
+            if i < len(границы):
+                e = min(e, границы[i])
+        return e
+    
+    def проверить_срок():
+        if срок is not None and time.perf_counter() > срок:
+            raise ПревышенБюджетПравила(правило["название"])
+    
+    if позиции is not None and правило["якоря"] is not None:
+        # Совпадение может начинаться только на якоре, поэтому первый успешный
+        # match() по кандидатам слева направо совпадает с результатом search()
+        for p in СканерЯкорей.кандидаты(правило, позиции):
+            проверить_срок()
+            match = regex.match(текст_l, p, конец(p)) if ограничен else regex.match(текст_l, p)
+            if match:
+                return match
+        return None
+    
+    if not ограничен:
+        проверить_срок()
+        return regex.search(текст_l)
+    
+    # Без якорей: поиск по окнам, в которых видно любое ограниченное совпадение
+    n = len(текст_l)
+    p = 0
+    while p < n:
+        проверить_срок()
+        до_пункта = n
+        if границы is not None:
+            i = bisect.bisect_right(границы, p)
+            до_пункта = границы[i] if i < len(границы) else n
+        окно = до_пункта if макс_охват is None else min(до_пункта, p + 2 * макс_охват)
+        следующее = окно if окно == до_пункта else p + макс_охват
+        match = regex.search(текст_l, p, окно)
+        if not match or match.start() >= следующее:
+            p = следующее
+            continue
+        точное = regex.match(текст_l, match.start(), конец(match.start()))
+        if точное:
+            return точное
+        p = match.start() + 1
+    return None
+
+
+def _найти_окнами(текст: str, тф: Dict, правила_тф: List[Dict], макс_охват: int, окно: int,
+                  в_пределах_пункта: bool = False, бюджет_мс: Optional[float] = None) -> Tuple[Dict, Dict]:
+    """Первые совпадения правил по окнам текста: ({название: нарушение}, {название: мс сверх бюджета}).
+
+    Окна перекрываются на макс_охват, совпадение засчитывается окну, в ядре
+    которого начинается, поэтому результат тот же, что у поиска по всему
+    тексту с тем же макс_охват. Совпадения длиннее макс_охват не находятся
+    ни здесь, ни там. Бюджет правила расходуется по всем окнам вместе.
+    """
+    найдено, превышено, потрачено = {}, {}, {}
+    лекс = лексемы(текст) if в_пределах_пункта else None
+    for сдвиг, кусок, начало, конец in окна_текста(текст, окно, макс_охват):
+        кусок_l = кусок.lower()
+        позиции = тф["сканер"].позиции(кусок_l)
+        границы = [p - сдвиг for p in лекс.начала("граница", сдвиг, сдвиг + len(кусок))] if лекс else None
+        for правило in правила_тф:
+            имя = правило["название"]
+            if имя in найдено or имя in превышено:
+                continue
+            старт = time.perf_counter()
+            срок = старт + (бюджет_мс - потрачено.get(имя, 0)) / 1000 if бюджет_мс else None
+            try:
+                match, превышен = найти_правило(правило, кусок_l, позиции, макс_охват, границы, срок), False
+            except ПревышенБюджетПравила:
+                match, превышен = None, True
+            потрачено[имя] = потрачено.get(имя, 0) + (time.perf_counter() - старт) * 1000
+            if превышен:
+                превышено[имя] = round(потрачено[имя])
+            elif match and match.start() + сдвиг < конец:
+                найдено[имя] = _нарушение(правило, текст, match, сдвиг)
+        if len(найдено) + len(превышено) == len(правила_тф):
+            break
+    return найдено, превышено
+
+
+def анализ_rag(текст: str, код_тф: str, правила: Optional[НаборПравил] = None,
+               макс_охват: Optional[int] = None, в_пределах_пункта: bool = False,
+               бюджет_мс: Optional[float] = None, окно: Optional[int] = ОКНО_АНАЛИЗА):
+    """RAG-сличение с типовой формой.
+
+    Текст длиннее окна проверяется по перекрывающимся окнам (см. _найти_окнами),
+    и память не растёт с длиной. Охват правила там всегда ограничен: без
+    макс_охват берётся ОХВАТ_ПРАВИЛА. Поэтому для такого текста результат
+    совпадает с поиском по всему тексту с тем же охватом, а не с поиском без
+    ограничений. Нарушение, у которого между началом и концом совпадения
+    больше охвата символов, не находится. Без ограничений текст проверяется
+    только при явном окно=None. В результате «охват» — применённое
+    ограничение (None — без него), «по_окнам» — шёл ли поиск окнами.
+    """
+    результат = {
+        "успех": False, "название_тф": "", "нарушения": [], "превышен_бюджет": [],
+        "красных": 0, "жёлтых": 0, "соответствие": 100, "вердикт": "", "резюме": ""
+    }
+    
+    if правила is None:
+        правила = набор_правил()
+    результат["версия_правил"] = правила.версия
+    if код_тф not in правила.формы:
+        результат["резюме"] = "Типовая форма не найдена"
+        return результат
+    
+    тф = правила.формы[код_тф]
+    результат["название_тф"] = тф["название"]
+    результат["успех"] = True
+    результат["по_окнам"] = bool(окно and len(текст) > окно)
+    if результат["по_окнам"] and макс_охват is None:
+        макс_охват = ОХВАТ_ПРАВИЛА
+    результат["охват"] = макс_охват
+    if результат["по_окнам"]:
+        найдено, превышено = _найти_окнами(текст, тф, тф["правила"], макс_охват, окно, в_пределах_пункта, бюджет_мс)
+        for правило in тф["правила"]:
+            имя = правило["название"]
+            if имя in превышено:
+                результат["превышен_бюджет"].append({
+                    "название": имя, "эталон": правило["эталон"],
+                    "критичность": правило["критичность"], "мс": превышено[имя],
+                })
+            elif имя in найдено:
+                результат["нарушения"].append(найдено[имя])
+        return _итог_rag(результат)
+
+    текст_l = текст.lower()
+    позиции = тф["сканер"].позиции(текст_l)
+    границы = лексемы(текст).начала("граница") if в_пределах_пункта else None
+    
+    for правило in тф["правила"]:
+        начало = time.perf_counter()
+        срок = начало + бюджет_мс / 1000 if бюджет_мс else None
+        try:
+            match = найти_правило(правило, текст_l, позиции, макс_охват, границы, срок)
+        except ПревышенБюджетПравила:
+            результат["превышен_бюджет"].append({
+                "название": правило["название"],
+                "эталон": правило["эталон"],
+                "критичность": правило["критичность"],
+                "мс": round((time.perf_counter() - начало) * 1000),
+            })
+            continue
+        if match:
+            результат["нарушения"].append(_нарушение(правило, текст, match))
+    
+    return _итог_rag(результат)
+
+
+def _нарушение(правило: Dict, текст: str, match, сдвиг: int = 0) -> Dict:
+    # сдвиг — начало куска, в котором искали, относительно текста
+    начало, конец = match.start() + сдвиг, match.end() + сдвиг
+    start = max(0, начало - 50)
+    end = min(len(текст), конец + 80)
+    контекст = текст[start:end].replace('\n', ' ').strip()
+    # Номер пункта — первый вида 4.1 в 100 символах перед нарушением
+    пункт_m = _НОМЕР_ПУНКТА.search(текст, max(0, начало - 100), начало)
+    return {
+        "название": правило["название"],
+        "эталон": правило["эталон"],
+        "критичность": правило["критичность"],
+        "пункт": пункт_m.group() if пункт_m else None,
+        "контекст": f"...{контекст}..."
+    }
+
+
+def _итог_rag(результат: Dict) -> Dict:
+    # Счётчики, процент соответствия и вердикт по списку нарушений
+    результат["красных"] = sum(1 for н in результат["нарушения"] if н["критичность"] == "красный")
+    результат["жёлтых"] = sum(1 for н in результат["нарушения"] if н["критичность"] == "жёлтый")
+    штраф = результат["красных"] * 15 + результат["жёлтых"] * 5
+    результат["соответствие"] = max(0, 100 - штраф)
+    
+    if результат["красных"] == 0 and результат["жёлтых"] <= 2:
+        результат["вердикт"] = "СООТВЕТСТВУЕТ"
+        результат["резюме"] = f"Договор соответствует ТФ ({результат['соответствие']}%)"
+    elif результат["красных"] <= 2:
+        результат["вердикт"] = "ЧАСТИЧНО"
+        результат["резюме"] = f"Частичное соответствие ({результат['соответствие']}%)"
+    else:
+        результат["вердикт"] = "НЕ_СООТВЕТСТВУЕТ"
+        результат["резюме"] = f"Не соответствует ТФ ({результат['соответствие']}%)"
+    
+    # Правило, не уложившееся в бюджет, не проверено, а не пройдено: лучший вердикт по нему
+    # не выносится. НЕ_СООТВЕТСТВУЕТ остаётся — непроверенные правила его не улучшат
+    не_проверено = len(результат.get("превышен_бюджет", []))
+    результат["неполный"] = bool(не_проверено)
+    if не_проверено and результат["вердикт"] != "НЕ_СООТВЕТСТВУЕТ":
+        результат["вердикт"] = "НЕ_ЗАВЕРШЁН"
+        результат["резюме"] = (f"Проверка не завершена: {не_проверено} правил(а) не проверено, "
+                               f"по остальным соответствие {результат['соответствие']}%")
+    
+    return результат
+
+
+def _границы_пунктов(текст: str) -> List[int]:
+    return [0] + лексемы(текст).начала("граница") + [len(текст)]
+
+
+def изменённые_пункты(прежний: str, текст: str) -> List[Tuple[int, int]]:
+    """Интервалы пунктов текста, которых нет в прежней редакции (сравнение без учёта пробелов)."""
+    было_г = _границы_пунктов(прежний)
+    было = {" ".join(прежний[a:b].split()) for a, b in zip(было_г, было_г[1:])}
+    г = _границы_пунктов(текст)
+    return [(a, b) for a, b in zip(г, г[1:]) if b > a and " ".join(текст[a:b].split()) not in было]
+
+
+def анализ_rag_изменений(текст: str, прежний_текст: str, прежний_rag: Optional[Dict], код_тф: str,
+                         правила: Optional[НаборПравил] = None, макс_охват: Optional[int] = ОХВАТ_ПРАВИЛА,
+                         бюджет_мс: Optional[float] = None, окно: Optional[int] = ОКНО_АНАЛИЗА) -> Dict:
+    """RAG повторно присланного договора: заново сканируются только изменённые пункты.
+
+    Совпадение правила не длиннее макс_охват, поэтому новое или изменённое
+    нарушение лежит не дальше охвата от изменённого пункта. Прежнее нарушение
+    остаётся, если его контекст дословно есть в новом тексте; пропавшее
+    перепроверяется по всему тексту одним правилом. Без ограничения охвата,
+    при другой версии правил или ТФ — полный анализ_rag.
+    """
+    if правила is None:
+        правила = набор_правил()
+    тф = правила.формы.get(код_тф)
+    if (not прежний_rag or тф is None or макс_охват is None or прежний_rag.get("версия_правил") != правила.версия
+            or прежний_rag.get("название_тф") != тф["название"] or прежний_rag.get("превышен_бюджет")):
+        return анализ_rag(текст, код_тф, правила, макс_охват=макс_охват, бюджет_мс=бюджет_мс, окно=окно)
+
+    # Изменённые пункты с запасом в охват правила, по границам пунктов; пересекающиеся — слиты
+    границы = _границы_пунктов(текст)
+    области = []
+    for a, b in изменённые_пункты(прежний_текст, текст):
+        a = границы[max(0, bisect.bisect_right(границы, a - макс_охват) - 1)]
+        b = границы[min(len(границы) - 1, bisect.bisect_left(границы, b + макс_охват))]
+        if области and a <= области[-1][1]:
+            области[-1] = (области[-1][0], max(b, области[-1][1]))
+        else:
+            области.append((a, b))
+
+    результат = {
+        "успех": True, "название_тф": тф["название"], "версия_правил": правила.версия,
+        "охват": макс_охват, "по_окнам": bool(окно and len(текст) > окно),
+        "нарушения": [], "превышен_бюджет": [], "пересчитано_символов": sum(b - a for a, b in области),
+    }
+    одной_строкой = текст.replace("\n", " ")
+    прежние = {н["название"]: н for н in прежний_rag.get("нарушения", [])}
+    найдено = {}
+    for a, b in области:
+        кусок_l = текст[a:b].lower()
+        позиции = тф["сканер"].позиции(кусок_l)
+        for правило in тф["правила"]:
+            if правило["название"] in найдено:
+                continue
+            срок = time.perf_counter() + бюджет_мс / 1000 if бюджет_мс else None
+            try:
+                match = найти_правило(правило, кусок_l, позиции, макс_охват, None, срок)
+            except ПревышенБюджетПравила:
+                return анализ_rag(текст, код_тф, правила, макс_охват=макс_охват, бюджет_мс=бюджет_мс, окно=окно)
+            if match:
+                найдено[правило["название"]] = _нарушение(правило, текст, match, a)
+
+    for правило in тф["правила"]:
+        имя = правило["название"]
+        старое = прежние.get(имя)
+        if имя in найдено:
+            # Первое совпадение могло сместиться в изменённый пункт — берём то, что раньше в тексте
+            новое = найдено[имя]
+            if старое and старое["контекст"].strip(".") in одной_строкой and (
+                    одной_строкой.find(старое["контекст"].strip(".")) < одной_строкой.find(новое["контекст"].strip("."))):
+                новое = старое
+            результат["нарушения"].append(новое)
+        elif старое and старое["контекст"].strip(".") in одной_строкой:
+            результат["нарушения"].append(старое)
+        elif старое:
+            if окно and len(текст) > окно:
+                нарушение = _найти_окнами(текст, тф, [правило], макс_охват, окно)[0].get(имя)
+            else:
+                match = найти_правило(правило, текст.lower(), None, макс_охват)
+                нарушение = match and _нарушение(правило, текст, match)
+            if нарушение:
+                результат["нарушения"].append(нарушение)
+    return _итог_rag(результат)
+
+
+# ============================================================================
+# ОПРЕДЕЛЕНИЕ ЗОНЫ
+# ============================================================================
+
+def определить_зону(сумма: float, форма: str, тип_сделки: str, пороги: Optional[Dict] = None):
+    пороги = пороги or DEFAULT_THRESHOLDS
+    
+    if тип_сделки in КРАСНАЯ_ЗОНА:
+        return {"зона": "красная", "причина": f"Тип сделки: {тип_сделки}", "юд": True, "срок": 10}
+    if сумма > пороги.get("жёлтая_макс", 5_000_000):
+        return {"зона": "красная", "причина": f"Сумма превышает {пороги['жёлтая_макс']:,}₽", "юд": True, "срок": 10}
+    if тип_сделки in ЖЁЛТАЯ_ЗОНА:
+        return {"зона": "жёлтая", "причина": f"Тип сделки: {тип_сделки}", "юд": True, "срок": 5}
+    if форма == "Типовая форма (ТФ)":
+        if сумма > пороги.get("зелёная_тф_макс", 100_000):
+            return {"зона": "жёлтая", "причина": f"ТФ свыше {пороги['зелёная_тф_макс']:,}₽", "юд": True, "срок": 5}
+    else:
+        if сумма > пороги.get("зелёная_нетф_макс", 50_000):
+            return {"зона": "жёлтая", "причина": f"Нетиповая форма свыше {пороги['зелёная_нетф_макс']:,}₽", "юд": True, "срок": 5}
+    return {"зона": "зелёная", "причина": "Зелёный коридор (п. 4.1 Регламента)", "юд": False, "срок": 0}
+
+
+ЗОНЫ = ["зелёная", "жёлтая", "красная"]
+
+
+def _коды_типов(сделки):
+    # Индекс типа сделки в КРАСНАЯ_ЗОНА + ЖЁЛТАЯ_ЗОНА или -1; считается по уникальным значениям
+    import numpy as np
+    import pandas as pd
+
+    типы = КРАСНАЯ_ЗОНА + ЖЁЛТАЯ_ЗОНА
+    коды, уникальные = pd.factorize(сделки["тип_сделки"])
+    индекс = np.array([типы.index(т) if т in типы else -1 for т in уникальные] + [-1], dtype=np.int16)
+    return индекс[коды]
+
+
+def ветви_зон(сделки, пороги: Optional[Dict] = None, коды_типов=None):
+    """Номер сработавшей ветви определить_зону для каждой сделки (numpy int8).
+
+    0 — красный тип, 1 — сумма выше жёлтой, 2 — жёлтый тип,
+    3 — ТФ выше зелёной, 4 — нетиповая выше зелёной, 5 — зелёный коридор.
+    """
+    import numpy as np
+    import pandas as pd
+
+    пороги = пороги or DEFAULT_THRESHOLDS
+    if коды_типов is None:
+        коды_типов = _коды_типов(сделки)
+    сумма = np.asarray(сделки["сумма"], dtype=float)
+    коды_форм, формы = pd.factorize(сделки["форма"])
+    тф = np.append(np.asarray(формы == "Типовая форма (ТФ)", dtype=bool), False)[коды_форм]
+    условия = [
+        (коды_типов >= 0) & (коды_типов < len(КРАСНАЯ_ЗОНА)),
+        сумма > пороги.get("жёлтая_макс", 5_000_000),
+        коды_типов >= len(КРАСНАЯ_ЗОНА),
+        тф & (сумма > пороги.get("зелёная_тф_макс", 100_000)),
+        ~тф & (сумма > пороги.get("зелёная_нетф_макс", 50_000)),
+    ]
+    return np.select(условия, np.arange(len(условия), dtype=np.int8), default=np.int8(len(условия)))
+
+
+def определить_зоны(сделки, пороги: Optional[Dict] = None):
+    """Векторный вариант определить_зону для реестра сделок.
+
+    сделки — DataFrame с колонками сумма, форма, тип_сделки. Возвращает
+    DataFrame с колонками зона, причина (категориальные), юд, срок на том же
+    индексе; значения построчно совпадают с определить_зону. Строки
+    сравниваются только по уникальным значениям, поэтому 1 млн сделок
+    классифицируется за доли секунды.
+    """
+    import numpy as np
+    import pandas as pd
+
+    пороги = пороги or DEFAULT_THRESHOLDS
+    коды_типов = _коды_типов(сделки)
+    ветвь = ветви_зон(сделки, пороги, коды_типов)
+
+    типы = КРАСНАЯ_ЗОНА + ЖЁЛТАЯ_ЗОНА
+    причины = [f"Тип сделки: {т}" for т in типы] + [
+        f"Сумма превышает {пороги.get('жёлтая_макс', 5_000_000):,}₽",
+        f"ТФ свыше {пороги.get('зелёная_тф_макс', 100_000):,}₽",
+        f"Нетиповая форма свыше {пороги.get('зелёная_нетф_макс', 50_000):,}₽",
+        "Зелёный коридор (п. 4.1 Регламента)",
+    ]
+    код_причины = np.array([0, 0, 1, 2, 3], dtype=np.int16)[np.maximum(ветвь - 1, 0)] + len(типы)
+    по_типу = (ветвь == 0) | (ветвь == 2)
+    код_причины[по_типу] = коды_типов[по_типу]
+
+    код_зоны = np.array([2, 2, 1, 1, 1, 0], dtype=np.int8)[ветвь]
+    return pd.DataFrame({
+        "зона": pd.Categorical.from_codes(код_зоны, categories=ЗОНЫ, ordered=True),
+        "причина": pd.Categorical.from_codes(код_причины, categories=причины),
+        "юд": ветвь < 5,
+        "срок": np.array([10, 10, 5, 5, 5, 0], dtype=np.int64)[ветвь],
+    }, index=сделки.index)
+
+
+class СимуляторПорогов:
+    """Что будет с зонами истории сделок при других порогах.
+
+    Сделки один раз раскладываются на группы (красный тип, жёлтый тип, ТФ,
+    нетиповые) с отсортированными суммами. Дальше любой набор порогов
+    оценивается бинарным поиском по границам, за O(log n) на запрос, без
+    повторного прохода по сделкам.
+    """
+
+    def __init__(self, сделки):
+        import numpy as np
+        import pandas as pd
+
+        self.сделок = len(сделки)
+        коды_типов = _коды_типов(сделки)
+        сумма = np.asarray(сделки["сумма"], dtype=float)
+        # NaN не больше ни одного порога — как в определить_зону
+        сумма = np.where(np.isnan(сумма), -np.inf, сумма)
+        коды_форм, формы = pd.factorize(сделки["форма"])
+        тф = np.append(np.asarray(формы == "Типовая форма (ТФ)", dtype=bool), False)[коды_форм]
+        красный_тип = (коды_типов >= 0) & (коды_типов < len(КРАСНАЯ_ЗОНА))
+        жёлтый_тип = коды_типов >= len(КРАСНАЯ_ЗОНА)
+        обычные = ~красный_тип & ~жёлтый_тип
+        self.красный_тип = int(красный_тип.sum())
+        self.группы = {
+            "жёлтый_тип": np.sort(сумма[жёлтый_тип]),
+            "тф": np.sort(сумма[обычные & тф]),
+            "нетф": np.sort(сумма[обычные & ~тф]),
+        }
+        # Кэш на экземпляр: пока админ двигает один порог, остальные запросы повторяются
+        self._переходы = functools.lru_cache(maxsize=256)(self._посчитать_переходы)
+
+    @staticmethod
+    def _зона(s: float, группа: str, пороги: Dict) -> int:
+        # 0 — зелёная, 1 — жёлтая, 2 — красная (индексы ЗОНЫ)
+        if s > пороги.get("жёлтая_макс", 5_000_000):
+            return 2
+        if группа == "жёлтый_тип":
+            return 1
+        порог = пороги.get("зелёная_тф_макс", 100_000) if группа == "тф" else пороги.get("зелёная_нетф_макс", 50_000)
+        return 1 if s > порог else 0
+
+    def _посчитать_переходы(self, было: Tuple, станет: Tuple):
+        import numpy as np
+
+        было, станет = dict(было), dict(станет)
+        матрица = np.zeros((3, 3), dtype=np.int64)
+        матрица[2, 2] = self.красный_тип
+        for группа, суммы in self.группы.items():
+            границы = sorted({float(п) for п in (*было.values(), *станет.values())})
+            позиции = np.searchsorted(суммы, границы, side="right")
+            # Интервалы (-inf, b1], (b1, b2], …, (bk, +inf): внутри каждого зона постоянна
+            слева = 0
+            for граница, справа in zip(границы + [np.inf], list(позиции) + [len(суммы)]):
+                if справа > слева:
+                    матрица[self._зона(граница, группа, было), self._зона(граница, группа, станет)] += справа - слева
+                слева = справа
+        return матрица
+
+    def сравнить(self, было: Dict, станет: Dict) -> Dict:
+        """Матрица переходов «зона было → зона станет» и итоги по зонам."""
+        ключ = lambda п: tuple(sorted({**DEFAULT_THRESHOLDS, **(п or {})}.items()))
+        матрица = self._переходы(ключ(было), ключ(станет))
+        return {
+            "матрица": матрица.tolist(),
+            "было": dict(zip(ЗОНЫ, матрица.sum(axis=1).tolist())),
+            "станет": dict(zip(ЗОНЫ, матрица.sum(axis=0).tolist())),
+            "сменят_зону": int(матрица.sum() - матрица.trace()),
+            "сделок": self.сделок,
+        }
+
+# ============================================================================
+# AI КЛИЕНТ
+# ============================================================================
+
+ПОРЯДОК_AI = ["openai", "anthropic", "yandexgpt"]
+
+AI_МОДЕЛИ = {
+    "openai": "gpt-4o-mini",
+    "anthropic": "claude-3-haiku-20240307",
+    "yandexgpt": "yandexgpt-lite",
+}
+
+AI_АДРЕСА = {
+    "openai": "https://api.openai.com",
+    "anthropic": "https://api.anthropic.com",
+    "yandexgpt": "https://llm.api.cloud.yandex.net",
+}
+
+AI_МАКС_ТОКЕНОВ = 3000
+AI_ТАЙМАУТ = (10, 90)           # соединение, пауза между порциями ответа
+AI_РАЗМЕР_ПУЛА = 8
+AI_МЕТРИК_ХРАНИТЬ = 500
+
+
+class ОшибкаAI(Exception):
+    pass
+
+
+def адрес_провайдера(провайдер: str) -> str:
+    """Базовый адрес API; SVETOFOR_AI_URL_<ПРОВАЙДЕР> или SVETOFOR_AI_URL подменяют его (заглушка ai_stub.py)."""
+    return (os.environ.get(f"SVETOFOR_AI_URL_{провайдер.upper()}")
+            or os.environ.get("SVETOFOR_AI_URL")
+            or AI_АДРЕСА[провайдер]).rstrip("/")
+
+
+_СЕССИИ_AI: Dict[str, object] = {}
+_СЕССИИ_AI_ЗАМОК = threading.Lock()
+
+
+def сессия_провайдера(провайдер: str):
+    # Одна requests.Session на провайдера: TCP/TLS-соединения переиспользуются между вызовами
+    with _СЕССИИ_AI_ЗАМОК:
+        сессия = _СЕССИИ_AI.get(провайдер)
+        if сессия is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            сессия = requests.Session()
+            адаптер = HTTPAdapter(pool_connections=1, pool_maxsize=AI_РАЗМЕР_ПУЛА)
+            сессия.mount("https://", адаптер)
+            сессия.mount("http://", адаптер)
+            _СЕССИИ_AI[провайдер] = сессия
+        return сессия
+
+
+# ---------- Метрики вызовов ----------
+
+_МЕТРИКИ_AI = deque(maxlen=AI_МЕТРИК_ХРАНИТЬ)
+_МЕТРИКИ_AI_ЗАМОК = threading.Lock()
+
+
+def записать_метрику_ai(метрика: Dict):
+    with _МЕТРИКИ_AI_ЗАМОК:
+        _МЕТРИКИ_AI.append(метрика)
+
+
+def метрики_ai() -> List[Dict]:
+    """Последние вызовы AI: провайдер, модель, ttft_мс, всего_мс, ожидание_мс, символов, ok, ошибка, время, кэш."""
+    with _МЕТРИКИ_AI_ЗАМОК:
+        return list(_МЕТРИКИ_AI)
+
+
+# ---------- Промпт ----------
+
+AI_БЮДЖЕТ_ТОКЕНОВ = 2500         # на весь промпт, без ответа
+AI_СИМВОЛОВ_НА_ТОКЕН = 3.0       # грубая оценка для русского текста
+AI_ПРЕАМБУЛА_СИМВОЛОВ = 1500     # начало договора (стороны, предмет) берётся всегда
+
+# Разделы, где обычно сидят риски: их пункты поднимаются выше
+ВАЖНЫЕ_РАЗДЕЛЫ = ("ОТВЕТСТВЕН", "ОПЛАТ", "РАСЧЁТ", "РАСЧЕТ", "СТОИМОСТ", "ЦЕН", "ПРИЁМК", "ПРИЕМК",
+                  "РАСТОРЖ", "СРОК", "ШТРАФ", "НЕУСТОЙК", "СПОР", "ФОРС", "КОНФИДЕНЦ", "ГАРАНТ")
+
+_ПРОПУСК = "\n[…]"
+_ЗАГОЛОВОК_РАЗДЕЛА = re.compile(r'^\s*\d+\.\s+([А-ЯЁA-Z][А-ЯЁA-Z ,\-–]{2,})\s*$', re.M)
+
+
+def оценить_токены(текст: str) -> int:
+    return int(len(текст) / AI_СИМВОЛОВ_НА_ТОКЕН) + 1
+
+
+def цена_провайдера(провайдер: str) -> Tuple[float, str]:
+    """Цена за один токен и валюта из строки «цена» AI_ПРОВАЙДЕРЫ: «$0.15/1M», «1.2₽/1000», «Бесплатно»."""
+    цена = AI_ПРОВАЙДЕРЫ.get(провайдер, {}).get("цена", "")
+    m = re.match(r'\s*([$₽])?\s*([\d.,]+)\s*([$₽])?\s*/\s*([\d.,]+)\s*([MМKК])?', цена)
+    if not m:
+        return 0.0, ""
+    сумма = float(m.group(2).replace(",", "."))
+    за = float(m.group(4).replace(",", ".")) * {"M": 1e6, "М": 1e6, "K": 1e3, "К": 1e3}.get(m.group(5) or "", 1)
+    return сумма / за, m.group(1) or m.group(3) or ""
+
+
+def оценка_промпта(промпт: str, провайдеры: Optional[List[str]] = None,
+                   макс_ответ: int = AI_МАКС_ТОКЕНОВ) -> Dict[str, Dict]:
+    """Оценка входных токенов и стоимости запроса по провайдерам (по цене из AI_ПРОВАЙДЕРЫ)."""
+    токенов = оценить_токены(промпт)
+    итог = {}
+    for pid in провайдеры or ПОРЯДОК_AI:
+        за_токен, валюта = цена_провайдера(pid)
+        итог[pid] = {"токенов": токенов, "ответ_макс": макс_ответ, "валюта": валюта,
+                     "стоимость": токенов * за_токен, "стоимость_макс": (токенов + макс_ответ) * за_токен}
+    return итог
+
+
+def _нарушения_для_промпта(нарушения: List[Dict], лимит: int = 8) -> str:
+    # Красные — первыми: при лимите в промпт попадают самые серьёзные
+    упорядоченные = sorted(нарушения, key=lambda н: н["критичность"] != "красный")
+    нарушения_текст = ""
+    for i, н in enumerate(упорядоченные[:лимит], 1):
+        emoji = "🔴" if н["критичность"] == "красный" else "🟡"
+        пункт = f"п.{н['пункт']}" if н.get("пункт") else ""
+        нарушения_текст += f"\n{i}. {emoji} [{пункт}] {н['эталон']}\n   Контекст: {н.get('контекст', '')[:100]}"
+    return нарушения_текст
+
+
+def выбрать_пункты(текст: str, rag: dict, бюджет_символов: int, правила: Optional[List[Dict]] = None) -> Tuple[str, Dict]:
+    """Самые релевантные пункты договора в пределах бюджета, в порядке текста.
+
+    Вес пункта: нарушения RAG в нём, вхождения ключевых слов правил ТФ
+    (литеральные якоря паттернов) и важность раздела по заголовку.
+    Преамбула (стороны, предмет) берётся всегда. Пропуски помечаются «[…]».
+    """
+    if len(текст) <= бюджет_символов:
+        return текст, {"пунктов": 1, "выбрано": 1, "символов": len(текст), "целиком": True}
+
+    начала = [0] + лексемы(текст).начала("граница")
+    концы = начала[1:] + [len(текст)]
+    n = len(начала)
+    вес = [0.0] * n
+
+    def пункт_по_позиции(p):
+        return bisect.bisect_right(начала, p) - 1
+
+    # Нарушения RAG — по номеру пункта в начале пункта
+    номер_в_начале = re.compile(r'\s*(\d+(?:\.\d+)+)')
+    индекс_номеров = {}
+    for i, a in enumerate(начала):
+        m = номер_в_начале.match(текст, a, min(концы[i], a + 20))
+        if m:
+            индекс_номеров.setdefault(m.group(1), i)
+    for н in rag.get("нарушения", []):
+        i = индекс_номеров.get(н.get("пункт") or "")
+        if i is not None:
+            вес[i] += 10 if н["критичность"] == "красный" else 6
+
+    # Ключевые слова правил: один проход сканера по тексту
+    if правила:
+        текст_l = текст.lower()
+        якоря = {я for п in правила for я in (п.get("якоря") or ())}
+        позиции = СканерЯкорей(правила).позиции(текст_l) if якоря else {}
+        if позиции is None:
+            позиции = {я: [m.start() for m in re.finditer(re.escape(я), текст_l)] for я in якоря}
+        for список in позиции.values():
+            for i in {пункт_по_позиции(p) for p in список}:
+                вес[i] += 2
+
+    # Важные разделы по заголовкам вида «5. ОТВЕТСТВЕННОСТЬ СТОРОН»
+    заголовки = [(m.start(), any(к in m.group(1) for к in ВАЖНЫЕ_РАЗДЕЛЫ))
+                 for m in _ЗАГОЛОВОК_РАЗДЕЛА.finditer(текст)]
+    for позиция, важный in заголовки:
+        if важный:
+            конец_раздела = next((p for p, _ in заголовки if p > позиция), len(текст))
+            for i in range(пункт_по_позиции(позиция), пункт_по_позиции(max(позиция, конец_раздела - 1)) + 1):
+                вес[i] += 3
+
+    # Преамбула; слишком длинная — обрезается по бюджету. Каждый пункт оплачивает и свою отметку пропуска
+    остаток = max(0, бюджет_символов - len(_ПРОПУСК))
+    выбрано = {0: min(концы[0], начала[0] + остаток)}
+    остаток -= выбрано[0] - начала[0]
+    for i in range(1, n):
+        if концы[i] > AI_ПРЕАМБУЛА_СИМВОЛОВ or концы[i] - начала[i] > остаток:
+            break
+        выбрано[i] = концы[i]
+        остаток -= концы[i] - начала[i]
+    for i in sorted(range(n), key=lambda i: (-вес[i], i)):
+        if вес[i] <= 0:
+            break
+        длина = концы[i] - начала[i] + len(_ПРОПУСК)
+        if i not in выбрано and длина <= остаток:
+            выбрано[i] = концы[i]
+            остаток -= длина
+
+    части, предыдущий = [], -1
+    for i in sorted(выбрано):
+        if i != предыдущий + 1 or (предыдущий >= 0 and выбрано[предыдущий] < концы[предыдущий]):
+            части.append(_ПРОПУСК)
+        части.append(текст[начала[i]:выбрано[i]])
+        предыдущий = i
+    if предыдущий != n - 1 or выбрано[предыдущий] < концы[предыдущий]:
+        части.append(_ПРОПУСК)
+    выборка = "".join(части)
+    return выборка, {"пунктов": n, "выбрано": len(выбрано), "символов": len(выборка), "целиком": False}
+
+
+def построить_промпт(текст: str, извлечённые: dict, rag: dict, орг: Optional[Dict] = None,
+                     бюджет_токенов: int = AI_БЮДЖЕТ_ТОКЕНОВ, правила: Optional[List[Dict]] = None) -> str:
+    """Промпт AI-экспертизы не длиннее бюджет_токенов: текст договора — выборкой самых релевантных пунктов.
+
+    правила — правила ТФ из НаборПравил; по умолчанию берутся по типу документа.
+    """
+    орг = орг or DEFAULT_ORG
+    тип_док = извлечённые.get("тип_док", {})
+    нарушения_текст = _нарушения_для_промпта(rag.get("нарушения", []))
+    if правила is None:
+        форма = набор_правил().формы.get(тип_док.get("тип"))
+        правила = форма["правила"] if форма else []
+
+    def собрать(выборка):
+        return f"""Ты — корпоративный юрист {орг.get('short_name', 'АО СПК')}.
+
+ДОКУМЕНТ: {тип_док.get('название', 'Договор')}
+Контрагент: {извлечённые.get('контрагент', '—')}
+Сумма: {извлечённые.get('сумма', 0):,.0f}₽
+
+ТЕКСТ{'' if выборка == текст else ' (ключевые пункты, пропуски отмечены […])'}:
+{выборка}
+
+НАРУШЕНИЯ:
+{нарушения_текст if нарушения_текст else "Не выявлено"}
+
+{'Это НЕ договор. Опиши что это.' if not тип_док.get('это_договор') else '''
+ЗАДАНИЕ — детальный анализ:
+
+## 1. ЧТО ЭТО
+Кратко: тип договора, стороны, предмет, сумма.
+
+## 2. КРИТИЧЕСКИЕ ПУНКТЫ
+Для каждого:
+- **Пункт X.X** — проблема
+- Текст: "цитата"
+- ❌ Риск: пояснение
+- ✅ Исправить: "готовая формулировка"
+
+## 3. ЗАМЕЧАНИЯ
+Аналогично.
+
+## 4. РЕКОМЕНДАЦИЯ
+Одно из: ✅ СОГЛАСОВАТЬ / ⚠️ С ЗАМЕЧАНИЯМИ / 🔄 ДОРАБОТАТЬ / ❌ ОТКЛОНИТЬ
+
+Указывай НОМЕРА пунктов и ГОТОВЫЕ формулировки.
+'''}"""
+
+    # Бюджет на текст — всё, что осталось от бюджета после обвязки промпта
+    бюджет_символов = int((бюджет_токенов - оценить_токены(собрать(""))) * AI_СИМВОЛОВ_НА_ТОКЕН)
+    выборка, _ = выбрать_пункты(текст, rag, max(0, бюджет_символов), правила)
+    return собрать(выборка)
+
+
+# ---------- Ограничение частоты ----------
+
+# Лимиты на процесс (все сессии сервера вместе); подбираются под тариф аккаунта
+AI_ЛИМИТЫ = {
+    "openai": {"запросов_мин": 500, "токенов_мин": 200_000, "одновременно": 8},
+    "anthropic": {"запросов_мин": 50, "токенов_мин": 50_000, "одновременно": 5},
+    "yandexgpt": {"запросов_мин": 60, "токенов_мин": 100_000, "одновременно": 4},
+}
+AI_ЛИМИТ_ПО_УМОЛЧАНИЮ = {"запросов_мин": 60, "токенов_мин": 60_000, "одновременно": 4}
+AI_ОЧЕРЕДЬ_МАКС = 100           # ожидающих запросов на провайдера
+AI_ОЖИДАНИЕ_МАКС_С = 120.0
+AI_ПАУЗА_429_С = 20.0           # если провайдер не прислал Retry-After
+
+
+class _Ведро:
+    # Маркерное ведро: ёмкость — минутный лимит, пополняется равномерно
+    def __init__(self, в_минуту: float):
+        self.ёмкость = float(в_минуту)
+        self.скорость = в_минуту / 60.0
+        self.уровень = self.ёмкость
+        self.время = time.monotonic()
+
+    def _пополнить(self, сейчас: float):
+        self.уровень = min(self.ёмкость, self.уровень + (сейчас - self.время) * self.скорость)
+        self.время = сейчас
+
+    def ждать(self, n: float, сейчас: float, по_ёмкости: bool = True) -> float:
+        # Запрос крупнее ёмкости ждёт полного ведра, а не вечно
+        self._пополнить(сейчас)
+        return max(0.0, ((min(n, self.ёмкость) if по_ёмкости else n) - self.уровень) / self.скорость)
+
+    def взять(self, n: float):
+        self.уровень -= min(n, self.ёмкость)
+
+
+class _Ожидающий:
+    __slots__ = ("токенов",)
+
+    def __init__(self, токенов: int):
+        self.токенов = токенов
+
+
+class ОграничительAI:
+    """Общий на процесс ограничитель исходящих вызовов AI.
+
+    На провайдера — два маркерных ведра (запросы/мин и токены/мин), предел
+    одновременных запросов и очередь FIFO не длиннее AI_ОЧЕРЕДЬ_МАКС.
+    Ответ 429 ставит провайдера на паузу по Retry-After.
+    """
+
+    def __init__(self, лимиты: Optional[Dict[str, Dict]] = None):
+        self.лимиты = лимиты if лимиты is not None else AI_ЛИМИТЫ
+        self._условие = threading.Condition()
+        self._провайдеры: Dict[str, Dict] = {}
+
+    def _состояние(self, провайдер: str) -> Dict:
+        с = self._провайдеры.get(провайдер)
+        if с is None:
+            лимит = self.лимиты.get(провайдер, AI_ЛИМИТ_ПО_УМОЛЧАНИЮ)
+            с = self._провайдеры[провайдер] = {
+                "запросы": _Ведро(лимит["запросов_мин"]), "токены": _Ведро(лимит["токенов_мин"]),
+                "одновременно": лимит["одновременно"], "занято": 0, "очередь": deque(), "пауза_до": 0.0,
+                "запросов": 0, "задержано": 0, "ожидание_с": 0.0, "ожидание_макс_с": 0.0, "отказов": 0, "429": 0,
+            }
+        return с
+
+    def _ждать(self, с: Dict, токенов: int, сейчас: float) -> float:
+        return max(с["пауза_до"] - сейчас, с["запросы"].ждать(1, сейчас), с["токены"].ждать(токенов, сейчас))
+
+    def занять(self, провайдер: str, токенов: int, отмена: Optional[threading.Event] = None,
+               таймаут: float = AI_ОЖИДАНИЕ_МАКС_С) -> float:
+        """Дождаться своей очереди и лимитов; возвращает время ожидания, с. После запроса — освободить()."""
+        начало = time.monotonic()
+        with self._условие:
+            с = self._состояние(провайдер)
+            if len(с["очередь"]) >= AI_ОЧЕРЕДЬ_МАКС:
+                с["отказов"] += 1
+                raise ОшибкаAI("очередь запросов переполнена, повторите позже")
+            я = _Ожидающий(токенов)
+            с["очередь"].append(я)
+            try:
+                while True:
+                    if отмена is not None and отмена.is_set():
+                        raise ОшибкаAI("Отменено")
+                    сейчас = time.monotonic()
+                    пауза = None
+                    if с["очередь"][0] is я and с["занято"] < с["одновременно"]:
+                        пауза = self._ждать(с, токенов, сейчас)
+                        if пауза <= 0:
+                            с["запросы"].взять(1)
+                            с["токены"].взять(токенов)
+                            с["занято"] += 1
+                            break
+                    осталось = начало + таймаут - сейчас
+                    if осталось <= 0:
+                        raise ОшибкаAI("Превышено время ожидания лимита запросов")
+                    # Короткие паузы — чтобы вовремя заметить отмену
+                    self._условие.wait(min(пауза if пауза is not None else 0.25, 0.25, осталось))
+            finally:
+                с["очередь"].remove(я)
+                self._условие.notify_all()
+            ожидание = time.monotonic() - начало
+            с["запросов"] += 1
+            if ожидание > 0.001:
+                с["задержано"] += 1
+                с["ожидание_с"] += ожидание
+                с["ожидание_макс_с"] = max(с["ожидание_макс_с"], ожидание)
+            return ожидание
+
+    def освободить(self, провайдер: str):
+        with self._условие:
+            self._состояние(провайдер)["занято"] -= 1
+            self._условие.notify_all()
+
+    def пауза(self, провайдер: str, секунд: float):
+        with self._условие:
+            с = self._состояние(провайдер)
+            с["пауза_до"] = max(с["пауза_до"], time.monotonic() + секунд)
+            с["429"] += 1
+
+    def оценка_ожидания(self, провайдер: str, токенов: int) -> Dict:
+        """Место нового запроса в очереди и ожидаемое ожидание с учётом стоящих впереди."""
+        with self._условие:
+            с = self._состояние(провайдер)
+            сейчас = time.monotonic()
+            впереди = list(с["очередь"])
+            нужно_токенов = токенов + sum(о.токенов for о in впереди)
+            ожидание = max(с["пауза_до"] - сейчас,
+                           с["запросы"].ждать(len(впереди) + 1, сейчас, по_ёмкости=False),
+                           с["токены"].ждать(нужно_токенов, сейчас, по_ёмкости=False))
+            return {"место": len(впереди) + 1, "ожидание_с": max(0.0, ожидание)}
+
+    def состояние(self) -> Dict[str, Dict]:
+        with self._условие:
+            сейчас = time.monotonic()
+            return {п: {"в_очереди": len(с["очередь"]), "выполняется": с["занято"], "запросов": с["запросов"],
+                        "задержано": с["задержано"], "ожидание_с": с["ожидание_с"],
+                        "ожидание_макс_с": с["ожидание_макс_с"], "отказов": с["отказов"], "429": с["429"],
+                        "пауза_с": max(0.0, с["пауза_до"] - сейчас)}
+                    for п, с in self._провайдеры.items()}
+
+
+_ОГРАНИЧИТЕЛЬ_AI = ОграничительAI()
+
+
+def ограничитель_ai() -> ОграничительAI:
+    return _ОГРАНИЧИТЕЛЬ_AI
+
+
+def метрики_prometheus() -> str:
+    """Метрики AI в текстовом формате Prometheus: ограничитель, планировщик, кэш."""
+    строки = []
+
+    def метрика(имя, тип, справка, значения):
+        строки.append(f"# HELP {имя} {справка}")
+        строки.append(f"# TYPE {имя} {тип}")
+        for метки, значение in значения:
+            строки.append(f"{имя}{{{метки}}} {значение}" if метки else f"{имя} {значение}")
+
+    огр = ограничитель_ai().состояние()
+    for ключ, имя, тип, справка in [
+        ("запросов", "svetofor_ai_requests_total", "counter", "Запросы, прошедшие ограничитель"),
+        ("задержано", "svetofor_ai_throttled_total", "counter", "Запросы, ждавшие лимита"),
+        ("ожидание_с", "svetofor_ai_throttle_seconds_total", "counter", "Суммарное ожидание лимита, с"),
+        ("ожидание_макс_с", "svetofor_ai_throttle_seconds_max", "gauge", "Максимальное ожидание лимита, с"),
+        ("отказов", "svetofor_ai_queue_rejected_total", "counter", "Отказы из-за переполненной очереди"),
+        ("429", "svetofor_ai_rate_limited_total", "counter", "Ответы 429 от провайдера"),
+        ("в_очереди", "svetofor_ai_queue_length", "gauge", "Запросы в очереди ограничителя"),
+        ("выполняется", "svetofor_ai_in_flight", "gauge", "Выполняющиеся запросы"),
+    ]:
+        метрика(имя, тип, справка, [(f'provider="{п}"', round(с[ключ], 3)) for п, с in огр.items()])
+
+    план = планировщик_ai().состояние()
+    метрика("svetofor_ai_ttft_ms", "gauge", "Время до первого токена, мс",
+            [(f'provider="{п}",quantile="{q}"', round(с[к], 1))
+             for п, с in план.items() for q, к in (("0.5", "ttft_p50_мс"), ("0.95", "ttft_p95_мс")) if с[к] is not None])
+    метрика("svetofor_ai_error_ratio", "gauge", "Доля ошибок в окне планировщика",
+            [(f'provider="{п}"', round(с["доля_ошибок"], 3)) for п, с in план.items()])
+    кэш = кэш_ai()
+    if кэш is not None:
+        с = кэш.статистика()
+        метрика("svetofor_ai_cache_hits_total", "counter", "Попадания в кэш AI", [("", с["попаданий"])])
+        метрика("svetofor_ai_cache_misses_total", "counter", "Промахи кэша AI", [("", с["промахов"])])
+    return "\n".join(строки) + "\n"
+
+
+_ЭКСПОРТ_МЕТРИК = None
+
+
+def запустить_экспорт_метрик(порт: int, хост: str = "127.0.0.1"):
+    """HTTP /metrics для Prometheus в фоновом потоке; повторный вызов ничего не делает.
+
+    По умолчанию слушает только локальный интерфейс; наружу — явным хост.
+    """
+    global _ЭКСПОРТ_МЕТРИК
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    with _СЕССИИ_AI_ЗАМОК:
+        if _ЭКСПОРТ_МЕТРИК is not None:
+            return _ЭКСПОРТ_МЕТРИК
+
+        class Обработчик(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                тело = метрики_prometheus().encode("utf-8")
+                self.send_response(200 if self.path.startswith("/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(тело)))
+                self.end_headers()
+                self.wfile.write(тело)
+
+        сервер = ThreadingHTTPServer((хост, порт), Обработчик)
+        сервер.daemon_threads = True
+        threading.Thread(target=сервер.serve_forever, daemon=True).start()
+        _ЭКСПОРТ_МЕТРИК = сервер
+        return сервер
+
+
+# ---------- Потоковые ответы провайдеров ----------
+
+def _события_sse(response):
+    # Строки «data: …» потока Server-Sent Events; iter_lines(chunk_size=None) отдаёт порции по мере прихода
+    for строка in response.iter_lines(chunk_size=None):
+        if строка.startswith(b"data:"):
+            yield строка[5:].strip().decode("utf-8")
+
+
+def _поток_openai(response):
+    for данные in _события_sse(response):
+        if данные == "[DONE]":
+            return
+        событие = json.loads(данные)
+        for выбор in событие.get("choices", []):
+            кусок = (выбор.get("delta") or {}).get("content")
+            if кусок:
+                yield кусок
+
+
+def _поток_anthropic(response):
+    for данные in _события_sse(response):
+        событие = json.loads(данные)
+        тип = событие.get("type")
+        if тип == "content_block_delta":
+            кусок = событие.get("delta", {}).get("text")
+            if кусок:
+                yield кусок
+        elif тип == "message_stop":
+            return
+        elif тип == "error":
+            raise ОшибкаAI(событие.get("error", {}).get("message", "Ошибка потока Anthropic"))
+
+
+def _поток_yandexgpt(response):
+    # YandexGPT в режиме stream присылает JSON-объекты построчно, текст в каждом — накопленный
+    отдано = 0
+    for строка in response.iter_lines(chunk_size=None):
+        if not строка.strip():
+            continue
+        событие = json.loads(строка)
+        if "error" in событие:
+            raise ОшибкаAI(событие["error"].get("message", "Ошибка потока YandexGPT"))
+        текст = событие["result"]["alternatives"][0]["message"]["text"]
+        if len(текст) > отдано:
+            yield текст[отдано:]
+            отдано = len(текст)
+
+
+class Отмена(threading.Event):
+    """Событие отмены с действиями: set() сразу выполняет зарегистрированные при_отмене.
+
+    Отменённый запрос так закрывает ответ провайдера и отдаёт место в
+    ограничителе сразу, а не на следующем куске или по таймауту.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._действия = []
+        self._замок = threading.Lock()
+
+    def при_отмене(self, действие):
+        with self._замок:
+            if not self.is_set():
+                self._действия.append(действие)
+                return
+        # Уже отменено — выполняется сразу
+        действие()
+
+    def set(self):
+        with self._замок:
+            super().set()
+            действия, self._действия = self._действия, []
+        for действие in действия:
+            try:
+                действие()
+            except Exception:
+                pass
+
+
+def _прервать_ответ(response):
+    # close() ждёт поток, который читает ответ; shutdown сокета сразу будит это чтение
+    import socket
+
+    сокет = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if сокет is not None:
+        try:
+            сокет.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def поток_провайдера(провайдер: str, ключ: str, промпт: str, yandex_folder: str = "",
+                     макс_токенов: int = AI_МАКС_ТОКЕНОВ, отмена: Optional[threading.Event] = None,
+                     метрика: Optional[Dict] = None):
+    """Генератор кусков ответа провайдера. Ошибки — ОшибкаAI; метрика пишется в любом случае.
+
+    Запрос сначала проходит ограничитель_ai(); отмена прерывает ожидание в
+    его очереди. Если отмена — Отмена, её set() сразу закрывает ответ и
+    освобождает место в ограничителе. Переданный словарь метрика заполняется
+    по ходу вызова.
+    """
+    if not REQUESTS_AVAILABLE:
+        raise ОшибкаAI("Не установлен пакет requests")
+    import requests
+
+    модель = AI_МОДЕЛИ.get(провайдер, "")
+    адрес = адрес_провайдера(провайдер) if провайдер in AI_АДРЕСА else ""
+    if провайдер == "openai":
+        запрос = {
+            "url": f"{адрес}/v1/chat/completions",
+            "headers": {"Authorization": f"Bearer {ключ}", "Content-Type": "application/json"},
+            "json": {"model": модель, "messages": [{"role": "user", "content": промпт}],
+                     "max_tokens": макс_токенов, "temperature": 0.3, "stream": True},
+        }
+        разбор = _поток_openai
+    elif провайдер == "anthropic":
+        запрос = {
+            "url": f"{адрес}/v1/messages",
+            "headers": {"x-api-key": ключ, "Content-Type": "application/json", "anthropic-version": "2023-06-01"},
+            "json": {"model": модель, "max_tokens": макс_токенов,
+                     "messages": [{"role": "user", "content": промпт}], "stream": True},
+        }
+        разбор = _поток_anthropic
+    elif провайдер == "yandexgpt":
+        if not yandex_folder:
+            raise ОшибкаAI("Укажите Folder ID")
+        запрос = {
+            "url": f"{адрес}/foundationModels/v1/completion",
+            "headers": {"Authorization": f"Api-Key {ключ}", "Content-Type": "application/json"},
+            "json": {"modelUri": f"gpt://{yandex_folder}/{модель}",
+                     "completionOptions": {"maxTokens": макс_токенов, "stream": True},
+                     "messages": [{"role": "user", "text": промпт}]},
+        }
+        разбор = _поток_yandexgpt
+    else:
+        raise ОшибкаAI("Неизвестный провайдер")
+
+    метрика = метрика if метрика is not None else {}
+    метрика.update({"провайдер": провайдер, "модель": модель, "ttft_мс": None, "всего_мс": None,
+                    "ожидание_мс": 0.0, "символов": 0, "ok": False, "ошибка": "", "время": time.time(),
+                    "кэш": False})
+    начало = time.perf_counter()
+    ограничитель = ограничитель_ai()
+    занято = []
+    замок = threading.Lock()
+
+    def освободить():
+        # Место освобождает либо отмена из другого потока, либо finally — ровно один раз
+        with замок:
+            if занято:
+                занято.clear()
+                ограничитель.освободить(провайдер)
+
+    при_отмене = getattr(отмена, "при_отмене", None)
+    try:
+        метрика["ожидание_мс"] = round(ограничитель.занять(
+            провайдер, оценить_токены(промпт) + макс_токенов, отмена) * 1000, 1)
+        занято.append(True)
+        if при_отмене:
+            при_отмене(освободить)
+        # TTFT — от отправки запроса, без ожидания в очереди ограничителя
+        начало = time.perf_counter()
+        with сессия_провайдера(провайдер).post(**запрос, stream=True, timeout=AI_ТАЙМАУТ) as response:
+            if при_отмене:
+                при_отмене(lambda: _прервать_ответ(response))
+            if response.status_code == 429:
+                try:
+                    пауза = float(response.headers.get("Retry-After") or AI_ПАУЗА_429_С)
+                except ValueError:
+                    пауза = AI_ПАУЗА_429_С
+                ограничитель.пауза(провайдер, пауза)
+            if response.status_code != 200:
+                raise ОшибкаAI(f"Ошибка: {response.status_code}")
+            for кусок in разбор(response):
+                if метрика["ttft_мс"] is None:
+                    метрика["ttft_мс"] = round((time.perf_counter() - начало) * 1000, 1)
+                метрика["символов"] += len(кусок)
+                yield кусок
+        метрика["ok"] = True
+    except requests.exceptions.Timeout:
+        метрика["ошибка"] = "Таймаут"
+        raise ОшибкаAI("Таймаут")
+    except requests.exceptions.RequestException as e:
+        метрика["ошибка"] = str(e)
+        raise ОшибкаAI(str(e))
+    except (ValueError, KeyError, IndexError) as e:
+        метрика["ошибка"] = f"Некорректный ответ: {e}"
+        raise ОшибкаAI(метрика["ошибка"])
+    except ОшибкаAI as e:
+        метрика["ошибка"] = str(e)
+        raise
+    finally:
+        освободить()
+        if not метрика["ok"] and (not метрика["ошибка"] or (отмена is not None and отмена.is_set())):
+            метрика["ошибка"] = "Прервано"
+        метрика["всего_мс"] = round((time.perf_counter() - начало) * 1000, 1)
+        записать_метрику_ai(dict(метрика))
+
+
+# ---------- Планировщик провайдеров ----------
+
+AI_ОКНО_СТАТИСТИКИ = 50         # последних вызовов на провайдера
+AI_ХЕДЖ_КВАНТИЛЬ = 0.95
+AI_ХЕДЖ_ПО_УМОЛЧАНИЮ_С = 3.0    # пока замеров мало
+AI_ХЕДЖ_МИН_С = 0.5
+AI_ХЕДЖ_МАКС_С = 15.0
+AI_ОПРОС_ОТМЕНЫ_С = 0.2          # как часто ожидающий ответа поток_ai проверяет отмену
+AI_ПРЕДОХРАНИТЕЛЬ_ОШИБОК = 3    # подряд
+AI_ПРЕДОХРАНИТЕЛЬ_С = 60.0
+
+
+def _квантиль(значения, q: float) -> float:
+    упорядоченные = sorted(значения)
+    return упорядоченные[min(len(упорядоченные) - 1, int(q * len(упорядоченные)))]
+
+
+class ПланировщикAI:
+    """Скользящая статистика провайдеров: время до первого токена, доля ошибок, предохранитель.
+
+    Порядок — сначала доступные с меньшей медианой TTFT; после
+    AI_ПРЕДОХРАНИТЕЛЬ_ОШИБОК неудач подряд провайдер выключается на
+    AI_ПРЕДОХРАНИТЕЛЬ_С, затем пропускается один пробный запрос.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ttft = {}
+        self._исходы = {}
+        self._подряд = {}
+        self._открыт_до = {}
+        self._проба = set()
+        self.хеджей = 0
+        self.побед_хеджа = 0
+
+    def учесть(self, провайдер: str, ok: bool, ttft_мс: Optional[float] = None):
+        with self._lock:
+            self._исходы.setdefault(провайдер, deque(maxlen=AI_ОКНО_СТАТИСТИКИ)).append(ok)
+            self._проба.discard(провайдер)
+            if ok:
+                self._подряд[провайдер] = 0
+                self._открыт_до.pop(провайдер, None)
+                if ttft_мс is not None:
+                    self._ttft.setdefault(провайдер, deque(maxlen=AI_ОКНО_СТАТИСТИКИ)).append(ttft_мс)
+            else:
+                self._подряд[провайдер] = self._подряд.get(провайдер, 0) + 1
+                if self._подряд[провайдер] >= AI_ПРЕДОХРАНИТЕЛЬ_ОШИБОК:
+                    self._открыт_до[провайдер] = time.monotonic() + AI_ПРЕДОХРАНИТЕЛЬ_С
+
+    def занять(self, провайдер: str) -> bool:
+        """Можно ли сейчас отправить запрос; в полуоткрытом состоянии — только один пробный."""
+        with self._lock:
+            до = self._открыт_до.get(провайдер)
+            if до is None:
+                return True
+            if time.monotonic() < до or провайдер in self._проба:
+                return False
+            self._проба.add(провайдер)
+            return True
+
+    def отпустить(self, провайдер: str):
+        # Пробный запрос отменён без результата — следующий снова может стать пробным
+        with self._lock:
+            self._проба.discard(провайдер)
+
+    def отметить_хедж(self, победил: bool = False):
+        with self._lock:
+            if победил:
+                self.побед_хеджа += 1
+            else:
+                self.хеджей += 1
+
+    def порядок(self, провайдеры: List[str]) -> List[str]:
+        with self._lock:
+            сейчас = time.monotonic()
+
+            def оценка(п):
+                исходы = self._исходы.get(п) or ()
+                доля_ошибок = исходы.count(False) / len(исходы) if исходы else 0.0
+                ttft = self._ttft.get(п)
+                return (self._открыт_до.get(п, 0) > сейчас, доля_ошибок > 0.5,
+                        _квантиль(ttft, 0.5) if ttft else 0.0, ПОРЯДОК_AI.index(п) if п in ПОРЯДОК_AI else 99)
+
+            return sorted(провайдеры, key=оценка)
+
+    def задержка_хеджа(self, провайдер: str) -> float:
+        """Через сколько секунд без первого токена запускать запрос ко второму провайдеру."""
+        with self._lock:
+            ttft = self._ttft.get(провайдер)
+            if not ttft or len(ttft) < 5:
+                return AI_ХЕДЖ_ПО_УМОЛЧАНИЮ_С
+            return min(AI_ХЕДЖ_МАКС_С, max(AI_ХЕДЖ_МИН_С, _квантиль(ttft, AI_ХЕДЖ_КВАНТИЛЬ) / 1000))
+
+    def состояние(self) -> Dict[str, Dict]:
+        with self._lock:
+            сейчас = time.monotonic()
+            итог = {}
+            for п in sorted(set(self._исходы) | set(self._ttft), key=lambda п: (п not in ПОРЯДОК_AI, п)):
+                исходы = self._исходы.get(п) or ()
+                ttft = self._ttft.get(п)
+                до = self._открыт_до.get(п)
+                итог[п] = {
+                    "вызовов": len(исходы),
+                    "доля_ошибок": исходы.count(False) / len(исходы) if исходы else 0.0,
+                    "ttft_p50_мс": _квантиль(ttft, 0.5) if ttft else None,
+                    "ttft_p95_мс": _квантиль(ttft, AI_ХЕДЖ_КВАНТИЛЬ) if ttft else None,
+                    "предохранитель": ("закрыт" if до is None else "открыт" if до > сейчас else "проба"),
+                }
+            return итог
+
+
+_ПЛАНИРОВЩИК_AI = ПланировщикAI()
+
+
+def планировщик_ai() -> ПланировщикAI:
+    return _ПЛАНИРОВЩИК_AI
+
+
+def провайдеры_с_ключами(api_ключи: Optional[Dict], yandex_folder: str = "") -> List[str]:
+    api_ключи = api_ключи or {}
+    провайдеры = [pid for pid in ПОРЯДОК_AI if api_ключи.get(pid)]
+    if not провайдеры:
+        raise ОшибкаAI("Не настроен AI-провайдер")
+    # Без Folder ID YandexGPT недоступен; ошибка — только если других ключей нет
+    if "yandexgpt" in провайдеры and not yandex_folder:
+        if провайдеры == ["yandexgpt"]:
+            raise ОшибкаAI("Укажите Folder ID")
+        провайдеры.remove("yandexgpt")
+    return провайдеры
+
+
+class _Попытка(threading.Thread):
+    # Запрос к одному провайдеру в фоне: куски складываются в общую очередь
+    def __init__(self, провайдер, ключ, промпт, yandex_folder, очередь):
+        super().__init__(daemon=True)
+        self.провайдер = провайдер
+        self.отмена = Отмена()
+        self._аргументы = (провайдер, ключ, промпт, yandex_folder)
+        self._очередь = очередь
+
+    def run(self):
+        п = self.провайдер
+        планировщик = планировщик_ai()
+        метрика = {}
+        поток = поток_провайдера(*self._аргументы, отмена=self.отмена, метрика=метрика)
+        try:
+            for кусок in поток:
+                if self.отмена.is_set():
+                    поток.close()
+                    планировщик.отпустить(п)
+                    return
+                self._очередь.put(("кусок", п, кусок))
+        except Exception as e:
+            if not self.отмена.is_set():
+                планировщик.учесть(п, False)
+            else:
+                планировщик.отпустить(п)
+            self._очередь.put(("ошибка", п, e))
+            return
+        if self.отмена.is_set():
+            планировщик.отпустить(п)
+        else:
+            планировщик.учесть(п, True, метрика.get("ttft_мс"))
+        self._очередь.put(("конец", п, None))
+
+
+def поток_ai(промпт: str, api_ключи: Optional[Dict] = None, yandex_folder: str = "",
+             с_кэшем: bool = True, хедж: bool = True, задержка_хеджа: Optional[float] = None,
+             отмена: Optional[threading.Event] = None):
+    """Ответ на промпт от самого быстрого здорового провайдера, по кускам.
+
+    Если первый провайдер молчит дольше задержки хеджа (p95 его TTFT),
+    параллельно запрашивается следующий; побеждает тот, кто раньше прислал
+    первый кусок, второй запрос отменяется. Ошибка до первого куска —
+    переход к следующему провайдеру. Установленная отмена (или закрытие
+    генератора) останавливает все запросы: их потоки закрывают ответы
+    провайдеров на следующем куске.
+    """
+    import queue
+
+    планировщик = планировщик_ai()
+    провайдеры = планировщик.порядок(провайдеры_с_ключами(api_ключи, yandex_folder))
+
+    кэш = кэш_ai() if с_кэшем else None
+    if кэш is not None:
+        for п in провайдеры:
+            ответ = кэш.получить(п, AI_МОДЕЛИ.get(п, ""), промпт)
+            if ответ is not None:
+                записать_метрику_ai({"провайдер": п, "модель": AI_МОДЕЛИ.get(п, ""), "ttft_мс": 0.0,
+                                     "всего_мс": 0.0, "символов": len(ответ), "ok": True, "ошибка": "",
+                                     "время": time.time(), "кэш": True})
+                yield ответ
+                return
+
+    очередь = queue.Queue()
+    ожидают = list(провайдеры)
+    попытки: Dict[str, _Попытка] = {}
+    ошибки = []
+    победитель = None
+    части = []
+
+    def запустить_следующую() -> bool:
+        while ожидают:
+            п = ожидают.pop(0)
+            if планировщик.занять(п):
+                попытки[п] = _Попытка(п, api_ключи[п], промпт, yandex_folder, очередь)
+                попытки[п].start()
+                return True
+            ошибки.append(f"{AI_ПРОВАЙДЕРЫ[п]['название']}: временно отключён после ошибок")
+        return False
+
+    try:
+        if not запустить_следующую():
+            raise ОшибкаAI("; ".join(ошибки) or "Нет доступных AI-провайдеров")
+        первый = next(iter(попытки))
+        срок_хеджа = time.monotonic() + (задержка_хеджа if задержка_хеджа is not None
+                                          else планировщик.задержка_хеджа(первый))
+        while True:
+            if отмена is not None and отмена.is_set():
+                return
+            таймаут = None
+            хеджировать = победитель is None and хедж and ожидают and len(попытки) == 1
+            if хеджировать:
+                таймаут = max(0.0, срок_хеджа - time.monotonic())
+            if отмена is not None:
+                таймаут = AI_ОПРОС_ОТМЕНЫ_С if таймаут is None else min(таймаут, AI_ОПРОС_ОТМЕНЫ_С)
+            try:
+                событие, п, данные = очередь.get(timeout=таймаут)
+            except queue.Empty:
+                # Пустая очередь — либо пора хеджировать, либо пора проверить отмену
+                if хеджировать and time.monotonic() >= срок_хеджа and запустить_следующую():
+                    планировщик.отметить_хедж()
+                continue
+
+            if победитель is None and событие == "кусок":
+                победитель = п
+                if п != первый:
+                    планировщик.отметить_хедж(победил=True)
+                for другой, попытка in попытки.items():
+                    if другой != п:
+                        попытка.отмена.set()
+            if победитель is not None and п != победитель:
+                continue
+
+            if событие == "кусок":
+                части.append(данные)
+                yield данные
+            elif событие == "конец":
+                if победитель is None:
+                    # Пустой ответ без ошибки — считаем его ответом
+                    победитель = п
+                break
+            else:
+                if победитель == п:
+                    raise данные if isinstance(данные, ОшибкаAI) else ОшибкаAI(str(данные))
+                ошибки.append(f"{AI_ПРОВАЙДЕРЫ[п]['название']}: {данные}")
+                del попытки[п]
+                if not попытки and not запустить_следующую():
+                    raise ОшибкаAI(ошибки[0] if len(ошибки) == 1 else "; ".join(ошибки))
+    finally:
+        # Потребитель прекратил чтение или всё закончилось — оставшиеся запросы больше не нужны
+        for попытка in попытки.values():
+            попытка.отмена.set()
+
+    if кэш is not None and победитель is not None:
+        кэш.положить(победитель, AI_МОДЕЛИ.get(победитель, ""), промпт, "".join(части))
+
+
+# ---------- Длинный договор: анализ по фрагментам ----------
+
+AI_ФРАГМЕНТ_СИМВОЛОВ = 6000
+AI_ПАРАЛЛЕЛЬНО = 8
+
+# По возрастанию строгости: итог — самая строгая из рекомендаций фрагментов
+РЕКОМЕНДАЦИИ_AI = ["✅ СОГЛАСОВАТЬ", "⚠️ С ЗАМЕЧАНИЯМИ", "🔄 ДОРАБОТАТЬ", "❌ ОТКЛОНИТЬ"]
+
+_ЗАДАНИЕ_ФРАГМЕНТА = '''
+## КРИТИЧЕСКИЕ ПУНКТЫ
+Для каждого:
+- **Пункт X.X** — проблема
+- Текст: "цитата"
+- ❌ Риск: пояснение
+- ✅ Исправить: "готовая формулировка"
+
+## ЗАМЕЧАНИЯ
+Аналогично. Если нет — «Нет».
+
+## РЕКОМЕНДАЦИЯ
+Одно из: ✅ СОГЛАСОВАТЬ / ⚠️ С ЗАМЕЧАНИЯМИ / 🔄 ДОРАБОТАТЬ / ❌ ОТКЛОНИТЬ
+
+Указывай НОМЕРА пунктов и ГОТОВЫЕ формулировки.
+'''
+
+_ЗАГОЛОВОК_ОТВЕТА = re.compile(r'^#{1,4}\s*(?:\d+\.\s*)?(.+?)\s*$', re.M)
+_ПУСТОЙ_РАЗДЕЛ = re.compile(r'^(?:нет|не выявлено|замечаний нет|критических пунктов нет)\.?$', re.I)
+_НОМЕР_ПУНКТА = re.compile(r'\d+\.\d+')
+
+
+def разбить_на_фрагменты(текст: str, макс_символов: int = AI_ФРАГМЕНТ_СИМВОЛОВ) -> List[Dict]:
+    """Фрагменты по границам пунктов: {"текст", "начало", "пункты": (первый, последний)}.
+
+    Соседние пункты склеиваются, пока помещаются в макс_символов; пункт
+    длиннее лимита режется по строкам, в крайнем случае — по длине.
+    """
+    лекс = лексемы(текст)
+    границы = [0] + лекс.начала("граница") + [len(текст)]
+    куски = []
+    for a, b in zip(границы, границы[1:]):
+        while b - a > макс_символов:
+            разрез = текст.rfind("\n", a + 1, a + макс_символов)
+            разрез = разрез if разрез > a else a + макс_символов
+            куски.append((a, разрез))
+            a = разрез
+        if b > a:
+            куски.append((a, b))
+
+    фрагменты = []
+    начало = конец = None
+    for a, b in куски:
+        if начало is not None and b - начало > макс_символов:
+            фрагменты.append((начало, конец))
+            начало = None
+        if начало is None:
+            начало = a
+        конец = b
+    if начало is not None:
+        фрагменты.append((начало, конец))
+
+    итог = []
+    for a, b in фрагменты:
+        номера = _НОМЕР_ПУНКТА.findall(текст, a, b)
+        итог.append({"текст": текст[a:b], "начало": a,
+                     "пункты": (номера[0], номера[-1]) if номера else None})
+    return итог
+
+
+def _подпись_фрагмента(фрагмент: Dict, i: int, n: int) -> str:
+    пункты = фрагмент["пункты"]
+    return f"фрагмент {i} из {n}" + (f", пп. {пункты[0]}–{пункты[1]}" if пункты else "")
+
+
+def построить_промпт_фрагмента(фрагмент: Dict, i: int, n: int, извлечённые: dict,
+                                нарушения: List[Dict], орг: Optional[Dict] = None) -> str:
+    орг = орг or DEFAULT_ORG
+    тип_док = извлечённые.get("тип_док", {})
+    нарушения_текст = _нарушения_для_промпта(нарушения)
+    что_это = "\n## ЧТО ЭТО\nКратко: тип договора, стороны, предмет, сумма.\n" if i == 1 else ""
+
+    return f"""Ты — корпоративный юрист {орг.get('short_name', 'АО СПК')}.
+
+ДОКУМЕНТ: {тип_док.get('название', 'Договор')}
+Контрагент: {извлечённые.get('контрагент', '—')}
+Сумма: {извлечённые.get('сумма', 0):,.0f}₽
+
+Это {_подпись_фрагмента(фрагмент, i, n)}. Остальные фрагменты проверяются отдельно — оценивай только этот текст.
+
+ТЕКСТ ФРАГМЕНТА:
+{фрагмент['текст']}
+
+НАРУШЕНИЯ В ЭТОМ ФРАГМЕНТЕ:
+{нарушения_текст if нарушения_текст else "Не выявлено"}
+
+ЗАДАНИЕ — детальный анализ фрагмента:
+{что_это}{_ЗАДАНИЕ_ФРАГМЕНТА}"""
+
+
+def разобрать_ответ_фрагмента(ответ: str) -> Dict:
+    """Разделы ответа: что, критические, замечания, рекомендация (индекс в РЕКОМЕНДАЦИИ_AI или None)."""
+    разделы = {"что": "", "критические": "", "замечания": "", "рекомендация": None}
+    заголовки = list(_ЗАГОЛОВОК_ОТВЕТА.finditer(ответ))
+    if not заголовки:
+        разделы["замечания"] = ответ.strip()
+        return разделы
+    for m, следующий in zip(заголовки, заголовки[1:] + [None]):
+        тело = ответ[m.end():следующий.start() if следующий else len(ответ)].strip()
+        заголовок = m.group(1).upper()
+        if "РЕКОМЕНД" in заголовок:
+            for уровень in range(len(РЕКОМЕНДАЦИИ_AI) - 1, -1, -1):
+                if РЕКОМЕНДАЦИИ_AI[уровень].split(" ", 1)[1] in тело.upper():
+                    разделы["рекомендация"] = уровень
+                    break
+            continue
+        if not тело or _ПУСТОЙ_РАЗДЕЛ.match(тело):
+            continue
+        ключ = ("критические" if "КРИТИЧ" in заголовок else
+                "что" if "ЧТО ЭТО" in заголовок else "замечания")
+        разделы[ключ] = (разделы[ключ] + "\n\n" + тело).strip()
+    return разделы
+
+
+def _нарушения_фрагментов(фрагменты: List[Dict], нарушения: List[Dict]) -> List[List[Dict]]:
+    # Нарушение — во фрагмент, где начинается его пункт; без номера пункта — в первый
+    по_фрагментам = [[] for _ in фрагменты]
+    for н in нарушения:
+        индекс = 0
+        if н.get("пункт"):
+            шаблон = re.compile(r'(?<![\d.])' + re.escape(н["пункт"]) + r'\.?\s')
+            for i, ф in enumerate(фрагменты):
+                if шаблон.search(ф["текст"]):
+                    индекс = i
+                    break
+        по_фрагментам[индекс].append(н)
+    return по_фрагментам
+
+
+def промпты_фрагментов(текст: str, извлечённые: dict, rag: dict, орг: Optional[Dict] = None,
+                       макс_символов: int = AI_ФРАГМЕНТ_СИМВОЛОВ) -> Tuple[List[Dict], List[str]]:
+    фрагменты = разбить_на_фрагменты(текст, макс_символов)
+    нарушения = _нарушения_фрагментов(фрагменты, rag.get("нарушения", []))
+    return фрагменты, [построить_промпт_фрагмента(ф, i, len(фрагменты), извлечённые, нарушения[i - 1], орг)
+                       for i, ф in enumerate(фрагменты, 1)]
+
+
+def ai_анализ_по_фрагментам(текст: str, извлечённые: dict, rag: dict, api_ключи: Optional[Dict] = None,
+                            орг: Optional[Dict] = None, yandex_folder: str = "", с_кэшем: bool = True,
+                            параллельно: int = AI_ПАРАЛЛЕЛЬНО, макс_символов: int = AI_ФРАГМЕНТ_СИМВОЛОВ):
+    """Map-reduce по всему договору: фрагменты анализируются параллельно, отчёт собирается в «## 1–4».
+
+    Раздел 2 выдаётся по мере готовности фрагментов в порядке текста,
+    разделы 3 и 4 — когда готовы все. Если потребитель закрывает генератор,
+    ещё не начатые фрагменты отменяются, а уже идущие запросы прерываются.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    провайдеры_с_ключами(api_ключи, yandex_folder)   # нет ключей — ошибка сразу, до пула
+    фрагменты, промпты = промпты_фрагментов(текст, извлечённые, rag, орг, макс_символов)
+    n = len(фрагменты)
+
+    отмена = threading.Event()
+
+    def анализ(промпт):
+        части = []
+        for кусок in поток_ai(промпт, api_ключи, yandex_folder, с_кэшем, отмена=отмена):
+            части.append(кусок)
+        if отмена.is_set():
+            raise ОшибкаAI("Анализ отменён")
+        return разобрать_ответ_фрагмента("".join(части))
+
+    пул = ThreadPoolExecutor(max_workers=max(1, параллельно))
+    try:
+        задачи = [пул.submit(анализ, п) for п in промпты]
+        результаты = []
+        сбои = []
+        for i, задача in enumerate(задачи):
+            try:
+                результаты.append(задача.result())
+            except Exception as e:
+                результаты.append(None)
+                сбои.append((i, e))
+            р = результаты[-1]
+            if i == 0:
+                тип_док = извлечённые.get("тип_док", {})
+                что = (р or {}).get("что") or (
+                    f"{тип_док.get('название', 'Договор')}, контрагент: {извлечённые.get('контрагент') or '—'}, "
+                    f"сумма: {извлечённые.get('сумма', 0):,.0f}₽.")
+                yield f"## 1. ЧТО ЭТО\n{что}\n\n_Проанализирован целиком: {n} фрагм., {len(текст):,} символов._\n\n## 2. КРИТИЧЕСКИЕ ПУНКТЫ\n"
+            if р and р["критические"]:
+                yield р["критические"] + "\n\n"
+
+        if not any(результаты):
+            raise ОшибкаAI(str(сбои[0][1]))
+        if not any(р and р["критические"] for р in результаты):
+            yield "Не выявлено.\n\n"
+
+        замечания = [р["замечания"] for р in результаты if р and р["замечания"]] + [
+            f"⚠️ {_подпись_фрагмента(фрагменты[i], i + 1, n).capitalize()} не проанализирован: {e}" for i, e in сбои]
+        уровни = [р["рекомендация"] for р in результаты if р and р["рекомендация"] is not None]
+        итог = РЕКОМЕНДАЦИИ_AI[max(уровни)] if уровни else РЕКОМЕНДАЦИИ_AI[1]
+        yield ("## 3. ЗАМЕЧАНИЯ\n" + ("\n\n".join(замечания) if замечания else "Нет.") +
+               f"\n\n## 4. РЕКОМЕНДАЦИЯ\n{итог}\n")
+    finally:
+        # Не начатые фрагменты отменяет пул, идущие запросы — событие отмены
+        отмена.set()
+        пул.shutdown(wait=False, cancel_futures=True)
+
+
+def ai_анализ_поток(текст: str, извлечённые: dict, rag: dict, api_ключи: Optional[Dict] = None,
+                    орг: Optional[Dict] = None, yandex_folder: str = "", с_кэшем: bool = True,
+                    целиком: bool = False, бюджет_токенов: int = AI_БЮДЖЕТ_ТОКЕНОВ):
+    """Потоковая AI-экспертиза: генератор кусков markdown по мере прихода токенов.
+
+    По умолчанию — один запрос с ключевыми пунктами в пределах бюджет_токенов;
+    целиком=True — весь договор по фрагментам (ai_анализ_по_фрагментам).
+    Провайдера выбирает планировщик_ai(); ответ на тот же промпт той же
+    модели берётся из кэш_ai() одним куском.
+    """
+    if по_фрагментам(текст, извлечённые, целиком):
+        yield from ai_анализ_по_фрагментам(текст, извлечённые, rag, api_ключи, орг, yandex_folder, с_кэшем)
+        return
+    промпт = построить_промпт(текст, извлечённые, rag, орг, бюджет_токенов)
+    yield from поток_ai(промпт, api_ключи, yandex_folder, с_кэшем)
+
+
+def по_фрагментам(текст: str, извлечённые: dict, целиком: bool) -> bool:
+    return целиком and len(текст) > AI_ФРАГМЕНТ_СИМВОЛОВ and bool(извлечённые.get("тип_док", {}).get("это_договор"))
+
+
+def оценка_анализа(текст: str, извлечённые: dict, rag: dict, орг: Optional[Dict] = None,
+                   провайдеры: Optional[List[str]] = None, целиком: bool = False,
+                   бюджет_токенов: int = AI_БЮДЖЕТ_ТОКЕНОВ) -> Dict[str, Dict]:
+    """Оценка токенов и стоимости AI-экспертизы до отправки: те же промпты, что уйдут провайдеру."""
+    if по_фрагментам(текст, извлечённые, целиком):
+        промпты = промпты_фрагментов(текст, извлечённые, rag, орг)[1]
+    else:
+        промпты = [построить_промпт(текст, извлечённые, rag, орг, бюджет_токенов)]
+    итог = {}
+    for промпт in промпты:
+        for pid, о in оценка_промпта(промпт, провайдеры).items():
+            сумма = итог.setdefault(pid, {"токенов": 0, "ответ_макс": 0, "валюта": о["валюта"],
+                                          "стоимость": 0.0, "стоимость_макс": 0.0, "запросов": 0})
+            for k in ("токенов", "ответ_макс", "стоимость", "стоимость_макс"):
+                сумма[k] += о[k]
+            сумма["запросов"] += 1
+    return итог
+
+
+def ai_анализ(текст: str, извлечённые: dict, rag: dict, api_ключи: Optional[Dict] = None,
+              орг: Optional[Dict] = None, yandex_folder: str = "", целиком: bool = False):
+    try:
+        return True, "".join(ai_анализ_поток(текст, извлечённые, rag, api_ключи, орг, yandex_folder,
+                                             целиком=целиком))
+    except Exception as e:
+        return False, str(e)
+
+
+# ============================================================================
+# КЭШ AI-ОТВЕТОВ
+# ============================================================================
+
+КЭШ_AI_TTL_С = 7 * 24 * 3600
+КЭШ_AI_МАКС_БАЙТ = 200 * 1024 * 1024
+
+
+def ключ_ai(провайдер: str, модель: str, промпт: str) -> str:
+    return hashlib.sha256(f"{провайдер}\n{модель}\n{промпт}".encode("utf-8")).hexdigest()
+
+
+class КэшAI:
+    """Дисковый кэш ответов AI в SQLite, ключ — (провайдер, модель, SHA-256 промпта).
+
+    Записи старше ttl_с не выдаются; при превышении макс_байт вытесняются
+    давно не запрошенные. Файл общий для всех сессий и процессов, счётчики
+    попаданий хранятся в нём же.
+    """
+
+    def __init__(self, путь: str, ttl_с: float = КЭШ_AI_TTL_С, макс_байт: int = КЭШ_AI_МАКС_БАЙТ):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.путь = путь
+        self.ttl_с = ttl_с
+        self.макс_байт = макс_байт
+        self._lock = threading.Lock()
+        with self._соединение() as бд:
+            бд.execute("PRAGMA journal_mode=WAL")
+            бд.execute("""CREATE TABLE IF NOT EXISTS ответы (
+                ключ TEXT PRIMARY KEY, провайдер TEXT, модель TEXT, ответ TEXT,
+                байт INTEGER, создан REAL, доступ REAL)""")
+            бд.execute("CREATE INDEX IF NOT EXISTS ответы_доступ ON ответы(доступ)")
+            бд.execute("CREATE TABLE IF NOT EXISTS счётчики (имя TEXT PRIMARY KEY, значение INTEGER)")
+
+    def _соединение(self):
+        # Отдельное соединение на операцию: Streamlit вызывает из разных потоков
+        return self._sqlite3.connect(self.путь, timeout=10, isolation_level=None)
+
+    @staticmethod
+    def _счётчик(бд, имя: str, n: int = 1):
+        бд.execute("INSERT INTO счётчики VALUES (?, ?) ON CONFLICT(имя) DO UPDATE SET значение = значение + ?",
+                   (имя, n, n))
+
+    def получить(self, провайдер: str, модель: str, промпт: str) -> Optional[str]:
+        ключ = ключ_ai(провайдер, модель, промпт)
+        сейчас = time.time()
+        with self._lock, self._соединение() as бд:
+            строка = бд.execute("SELECT ответ, создан FROM ответы WHERE ключ = ?", (ключ,)).fetchone()
+            if строка is None or сейчас - строка[1] > self.ttl_с:
+                if строка is not None:
+                    бд.execute("DELETE FROM ответы WHERE ключ = ?", (ключ,))
+                self._счётчик(бд, "промахов")
+                return None
+            бд.execute("UPDATE ответы SET доступ = ? WHERE ключ = ?", (сейчас, ключ))
+            self._счётчик(бд, "попаданий")
+            return строка[0]
+
+    def положить(self, провайдер: str, модель: str, промпт: str, ответ: str):
+        байт = len(ответ.encode("utf-8"))
+        if байт > self.макс_байт:
+            return
+        сейчас = time.time()
+        with self._lock, self._соединение() as бд:
+            бд.execute("INSERT OR REPLACE INTO ответы VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (ключ_ai(провайдер, модель, промпт), провайдер, модель, ответ, байт, сейчас, сейчас))
+            вытеснено = бд.execute("DELETE FROM ответы WHERE создан < ?", (сейчас - self.ttl_с,)).rowcount
+            всего = бд.execute("SELECT COALESCE(SUM(байт), 0) FROM ответы").fetchone()[0]
+            if всего > self.макс_байт:
+                # Давно не запрошенные — первыми, пока не уложимся в лимит
+                лишние = []
+                for ключ, размер in бд.execute("SELECT ключ, байт FROM ответы ORDER BY доступ"):
+                    if всего <= self.макс_байт:
+                        break
+                    лишние.append((ключ,))
+                    всего -= размер
+                бд.executemany("DELETE FROM ответы WHERE ключ = ?", лишние)
+                вытеснено += len(лишние)
+            if вытеснено:
+                self._счётчик(бд, "вытеснено", вытеснено)
+
+    def очистить(self):
+        with self._lock, self._соединение() as бд:
+            бд.execute("DELETE FROM ответы")
+            бд.execute("DELETE FROM счётчики")
+
+    def статистика(self):
+        with self._lock, self._соединение() as бд:
+            записей, байт = бд.execute("SELECT COUNT(*), COALESCE(SUM(байт), 0) FROM ответы").fetchone()
+            счётчики = dict(бд.execute("SELECT имя, значение FROM счётчики"))
+        попаданий, промахов = счётчики.get("попаданий", 0), счётчики.get("промахов", 0)
+        всего = попаданий + промахов
+        return {
+            "записей": записей, "байт": байт,
+            "попаданий": попаданий, "промахов": промахов, "вытеснено": счётчики.get("вытеснено", 0),
+            "доля_попаданий": попаданий / всего if всего else 0.0,
+        }
+
+
+_КЭШ_AI = None
+_КЭШ_AI_ЗАМОК = threading.Lock()
+
+
+def кэш_ai() -> Optional[КэшAI]:
+    """Общий кэш в каталоге данных; None, если каталог недоступен для записи — тогда AI работает без кэша."""
+    global _КЭШ_AI
+    with _КЭШ_AI_ЗАМОК:
+        if _КЭШ_AI is None:
+            try:
+                _КЭШ_AI = КэшAI(путь_данных("ai_cache.sqlite"))
+            except Exception:
+                return None
+        return _КЭШ_AI
+
+
+# ============================================================================
+# ФОНОВЫЕ AI-ЗАДАЧИ
+# ============================================================================
+
+ЗАДАЧ_AI_ПОТОКОВ = 4
+ЗАДАЧ_AI_ХРАНИТЬ = 200          # завершённых задач в памяти процесса
+ЗАДАЧ_AI_TTL_С = 24 * 3600
+
+ЗАВЕРШЁННЫЕ_СТАТУСЫ = ("готово", "ошибка", "отменена")
+
+
+class ОчередьЗадачAI:
+    """Общий на процесс пул фоновых AI-задач.
+
+    Задача — генератор кусков ответа (ai_анализ_поток); частичный текст
+    накапливается по мере прихода и доступен через статус(id). Задачи не
+    зависят от перезапусков скрипта Streamlit: сессия хранит только id.
+    """
+
+    def __init__(self, потоков: int = ЗАДАЧ_AI_ПОТОКОВ):
+        self.потоков = потоков
+        self._пул = None
+        self._задачи: "OrderedDict[str, Dict]" = OrderedDict()
+        self._отмена: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def отправить(self, функция, *args, название: str = "", владелец: str = "", метка: str = "", **kwargs) -> str:
+        import uuid
+        from concurrent.futures import ThreadPoolExecutor
+
+        id_ = uuid.uuid4().hex[:12]
+        with self._lock:
+            if self._пул is None:
+                self._пул = ThreadPoolExecutor(max_workers=self.потоков, thread_name_prefix="ai-задача")
+            self._задачи[id_] = {"id": id_, "название": название, "владелец": владелец, "метка": метка,
+                                 "статус": "в очереди", "текст": "", "ошибка": "",
+                                 "создана": time.time(), "начата": None, "завершена": None}
+            self._отмена[id_] = threading.Event()
+            self._подчистить()
+            пул = self._пул
+        пул.submit(self._выполнить, id_, функция, args, kwargs)
+        return id_
+
+    def _выполнить(self, id_, функция, args, kwargs):
+        отмена = self._отмена[id_]
+        with self._lock:
+            задача = self._задачи[id_]
+            if отмена.is_set():
+                return
+            задача.update({"статус": "выполняется", "начата": time.time()})
+        try:
+            поток = функция(*args, **kwargs)
+            for кусок in поток:
+                if отмена.is_set():
+                    поток.close()
+                    return
+                with self._lock:
+                    задача["текст"] += кусок
+            итог = {"статус": "готово"}
+        except Exception as e:
+            итог = {"статус": "ошибка", "ошибка": str(e)}
+        with self._lock:
+            if not отмена.is_set():
+                задача.update(итог, завершена=time.time())
+
+    def отменить(self, id_: str):
+        with self._lock:
+            задача = self._задачи.get(id_)
+            if задача and задача["статус"] not in ЗАВЕРШЁННЫЕ_СТАТУСЫ:
+                self._отмена[id_].set()
+                задача.update({"статус": "отменена", "завершена": time.time()})
+
+    def статус(self, id_: str) -> Optional[Dict]:
+        """Копия задачи; для ожидающих — место в очереди (1 — следующая)."""
+        with self._lock:
+            задача = self._задачи.get(id_)
+            if задача is None:
+                return None
+            копия = dict(задача)
+            if задача["статус"] == "в очереди":
+                копия["место"] = 1 + sum(1 for з in self._задачи.values()
+                                         if з["статус"] == "в очереди" and з["создана"] < задача["создана"])
+            return копия
+
+    def задачи(self, владелец: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            return [dict(з) for з in reversed(self._задачи.values())
+                    if владелец is None or з["владелец"] == владелец]
+
+    def _подчистить(self):
+        # Под self._lock: старые завершённые — вон; выполняющиеся не трогаем
+        граница = time.time() - ЗАДАЧ_AI_TTL_С
+        завершённые = [id_ for id_, з in self._задачи.items() if з["статус"] in ЗАВЕРШЁННЫЕ_СТАТУСЫ]
+        лишних = len(завершённые) - ЗАДАЧ_AI_ХРАНИТЬ
+        for i, id_ in enumerate(завершённые):
+            if i < лишних or self._задачи[id_]["завершена"] < граница:
+                del self._задачи[id_]
+                del self._отмена[id_]
+
+
+_ОЧЕРЕДЬ_AI = ОчередьЗадачAI()
+
+
+def очередь_ai() -> ОчередьЗадачAI:
+    return _ОЧЕРЕДЬ_AI
+
+
+# ============================================================================
+# КЭШ РАЗБОРА ФАЙЛОВ
+# ============================================================================
+
+КЭШ_РАЗБОРА_МАКС_СИМВОЛОВ = 50_000_000
+КЭШ_РАЗБОРА_МАКС_ЗАПИСЕЙ = 64
+
+
+class КэшРазбора:
+    """LRU-кэш разобранных файлов, ключ — SHA-256 содержимого загрузки.
+
+    Объём ограничен суммарной длиной текстов и числом записей.
+    """
+
+    def __init__(self, макс_символов=КЭШ_РАЗБОРА_МАКС_СИМВОЛОВ, макс_записей=КЭШ_РАЗБОРА_МАКС_ЗАПИСЕЙ):
+        self.макс_символов = макс_символов
+        self.макс_записей = макс_записей
+        self.записи = OrderedDict()
+        self.размер = 0
+        self.попаданий = 0
+        self.промахов = 0
+        self.вытеснено = 0
+        self._lock = threading.Lock()
+
+    def получить(self, ключ):
+        with self._lock:
+            элемент = self.записи.get(ключ)
+            if элемент is None:
+                self.промахов += 1
+                return None
+            self.записи.move_to_end(ключ)
+            self.попаданий += 1
+            return элемент[0]
+
+    def положить(self, ключ, запись):
+        размер = len(запись.get("текст") or "")
+        if размер > self.макс_символов:
+            return
+        with self._lock:
+            if ключ in self.записи:
+                self.размер -= self.записи.pop(ключ)[1]
+            self.записи[ключ] = (запись, размер)
+            self.размер += размер
+            while self.записи and (self.размер > self.макс_символов or len(self.записи) > self.макс_записей):
+                _, (_, вытесненный) = self.записи.popitem(last=False)
+                self.размер -= вытесненный
+                self.вытеснено += 1
+
+    def статистика(self):
+        with self._lock:
+            всего = self.попаданий + self.промахов
+            return {
+                "записей": len(self.записи), "символов": self.размер,
+                "попаданий": self.попаданий, "промахов": self.промахов, "вытеснено": self.вытеснено,
+                "доля_попаданий": self.попаданий / всего if всего else 0.0,
+            }
+
+
+# Один экземпляр на процесс: общий для всех сессий и переживает перезапуски скрипта
+_КЭШ_РАЗБОРА = КэшРазбора()
+
+
+def кэш_разбора():
+    return _КЭШ_РАЗБОРА
+
+
+# ============================================================================
+# ЗАГРУЗКА ФАЙЛОВ
+# ============================================================================
+
+МАКС_СИМВОЛОВ_ДОКУМЕНТА = 10_000_000   # защита от огромных файлов; длинный текст анализируется окнами
+ОБРАЗЕЦ_КОДИРОВКИ = 64 * 1024          # байт в начале TXT, по которым выбирается кодировка
+ЗАГРУЗКА_В_ПАМЯТИ = 8 * 1024 * 1024    # поток длиннее уходит во временный файл на диске
+
+# Строчные русские буквы в однобайтовых кодировках — по их доле выбирается cp1251 или cp866
+_СТРОЧНЫЕ = {
+    "cp1251": bytes(range(0xE0, 0x100)) + b"\xb8",
+    "cp866": bytes(range(0xA0, 0xB0)) + bytes(range(0xE0, 0xF0)) + b"\xf1",
+}
+_НЕ_СТРОЧНЫЕ = {кодировка: bytes(set(range(256)) - set(байты)) for кодировка, байты in _СТРОЧНЫЕ.items()}
+
+
+@contextmanager
+def буфер_загрузки(источник):
+    """memoryview содержимого без лишней копии.
+
+    bytes и загруженный файл Streamlit (BytesIO) отдаются как есть, путь и
+    открытый файл на диске отображаются в память (mmap), прочий поток
+    (член ZIP-архива) копируется кусками — до ЗАГРУЗКА_В_ПАМЯТИ в памяти,
+    дальше во временный файл, который затем тоже отображается.
+    """
+    import mmap, tempfile
+
+    отображение = файл = None
+    if isinstance(источник, (bytes, bytearray, memoryview)):
+        данные = источник
+    elif isinstance(источник, (str, os.PathLike)):
+        файл = open(источник, "rb")
+        данные = None
+    elif hasattr(источник, "getvalue"):
+        # BytesIO.getvalue() возвращает исходный bytes без копирования, getbuffer() — копирует
+        данные = источник.getvalue()
+    else:
+        try:
+            источник.fileno()
+            файл, данные = источник, None
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            данные = bytearray()
+            while len(данные) <= ЗАГРУЗКА_В_ПАМЯТИ:
+                кусок = источник.read(1024 * 1024)
+                if not кусок:
+                    break
+                данные += кусок
+            else:
+                файл = tempfile.TemporaryFile()
+                файл.write(данные)
+                данные = None
+                while кусок := источник.read(1024 * 1024):
+                    файл.write(кусок)
+                файл.flush()
+    try:
+        if данные is None:
+            файл.seek(0, os.SEEK_END)
+            if файл.tell():
+                отображение = mmap.mmap(файл.fileno(), 0, access=mmap.ACCESS_READ)
+                данные = отображение
+            else:
+                данные = b""
+        with memoryview(данные) as буфер:
+            yield буфер
+    finally:
+        if отображение is not None:
+            try:
+                отображение.close()
+            except BufferError:
+                pass   # срез буфера ещё где-то жив — отображение закроет сборщик мусора
+        if файл is not None and файл is not источник:
+            файл.close()
+
+
+class _ПотокБуфера(io.RawIOBase):
+    """Файл только для чтения поверх буфера: zipfile и PyPDF2 читают его без копии целиком.
+
+    Снаружи оборачивается в io.BufferedReader (см. _поток): PyPDF2 читает по байту,
+    и мелкие чтения должны обслуживаться буфером на C, а не методом на Python.
+    """
+
+    def __init__(self, буфер):
+        self._буфер = memoryview(буфер)
+        self._позиция = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._позиция
+
+    def seek(self, смещение, откуда=os.SEEK_SET):
+        база = {os.SEEK_SET: 0, os.SEEK_CUR: self._позиция, os.SEEK_END: len(self._буфер)}[откуда]
+        self._позиция = max(0, база + смещение)
+        return self._позиция
+
+    def read(self, размер=-1):
+        конец = len(self._буфер) if размер is None or размер < 0 else self._позиция + размер
+        кусок = self._буфер[self._позиция:конец].tobytes()
+        self._позиция += len(кусок)
+        return кусок
+
+    def readinto(self, b):
+        кусок = self._буфер[self._позиция:self._позиция + len(b)]
+        b[:len(кусок)] = кусок
+        self._позиция += len(кусок)
+        return len(кусок)
+
+    def close(self):
+        if not self.closed:
+            self._буфер.release()
+        super().close()
+
+
+def _поток(буфер) -> io.BufferedReader:
+    return io.BufferedReader(_ПотокБуфера(буфер), 64 * 1024)
+
+
+def определить_кодировку(образец: bytes) -> str:
+    """Кодировка TXT по первым байтам: UTF-8 (с BOM или без), иначе cp1251 или cp866."""
+    import codecs
+    if образец.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # Незавершённый последний символ образца — не ошибка
+        codecs.getincrementaldecoder("utf-8")().decode(образец, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    return max(_СТРОЧНЫЕ, key=lambda кодировка: len(образец.translate(None, _НЕ_СТРОЧНЫЕ[кодировка])))
+
+
+def декодировать_текст(буфер, макс_символов: Optional[int] = МАКС_СИМВОЛОВ_ДОКУМЕНТА) -> str:
+    """Текст TXT: кодировка — по образцу, лишние байты не читаются.
+
+    Если после образца UTF-8 встречаются байты не из UTF-8, текст читается
+    как cp1251, затем cp866 — как при переборе кодировок по всему файлу.
+    """
+    import codecs
+    кодировка = определить_кодировку(bytes(буфер[:ОБРАЗЕЦ_КОДИРОВКИ]))
+    if not кодировка.startswith("utf-8"):
+        return str(буфер[:макс_символов], кодировка, errors="replace")
+    # Символ UTF-8 занимает не больше четырёх байт
+    предел = len(буфер) if макс_символов is None else min(len(буфер), макс_символов * 4)
+    try:
+        # Срез может разрезать последний символ — это не ошибка
+        return codecs.getincrementaldecoder(кодировка)().decode(
+            буфер[:предел], final=предел == len(буфер))[:макс_символов]
+    except UnicodeDecodeError:
+        pass
+    for кодировка in ("cp1251", "cp866"):
+        try:
+            return str(буфер[:макс_символов], кодировка)
+        except UnicodeDecodeError:
+            pass
+    return str(буфер[:предел], "utf-8", errors="replace")[:макс_символов]
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def читать_docx(content: bytes, макс_символов: Optional[int] = МАКС_СИМВОЛОВ_ДОКУМЕНТА):
+    """Абзацы и строки таблиц DOCX в порядке документа (ячейки строки — через « | »).
+
+    word/document.xml разбирается iterparse прямо из архива, разобранные
+    элементы сразу освобождаются, поэтому память не растёт с размером
+    документа. Чтение прекращается, когда выдано макс_символов.
+    """
+    import zipfile
+    from xml.etree.ElementTree import iterparse
+
+    выдано = 0
+    глубина = 0
+    в_прогоне = 0                  # w:tab вне w:r — это позиции табуляции в свойствах абзаца
+    части: List[str] = []          # текст текущего абзаца
+    ячейки: List[List[str]] = []   # стек таблиц: ячейки текущей строки
+    ячейка: List[List[str]] = []   # стек таблиц: абзацы текущей ячейки
+    тело = None
+    with _поток(content) as поток, zipfile.ZipFile(поток) as архив, архив.open("word/document.xml") as xml:
+        for событие, элемент in iterparse(xml, events=("start", "end")):
+            тег = элемент.tag
+            if событие == "start":
+                глубина += 1
+                if тег == _W + "body":
+                    тело = элемент
+                elif тег == _W + "tbl":
+                    ячейки.append([])
+                    ячейка.append([])
+                elif тег == _W + "r":
+                    в_прогоне += 1
+                continue
+            глубина -= 1
+            строка = None
+            if тег == _W + "t":
+                части.append(элемент.text or "")
+            elif тег == _W + "r":
+                в_прогоне -= 1
+            elif тег == _W + "tab" and в_прогоне:
+                части.append("\t")
+            elif тег in (_W + "br", _W + "cr") and в_прогоне:
+                части.append("\n")
+            elif тег == _W + "p":
+                абзац = "".join(части).strip()
+                части = []
+                if ячейка:
+                    if абзац:
+                        ячейка[-1].append(абзац)
+                else:
+                    строка = абзац
+            elif тег == _W + "tc" and ячейки:
+                ячейки[-1].append(" ".join(ячейка[-1]))
+                ячейка[-1] = []
+            elif тег == _W + "tr" and ячейки:
+                строка = " | ".join(ячейки[-1]) if any(ячейки[-1]) else ""
+                ячейки[-1] = []
+            elif тег == _W + "tbl" and ячейки:
+                ячейки.pop()
+                ячейка.pop()
+            if тег in (_W + "p", _W + "tr"):
+                элемент.clear()
+            if строка and тег == _W + "tr" and len(ячейка) > 1:
+                # Вложенная таблица — её строки остаются текстом внешней ячейки
+                ячейка[-2].append(строка)
+                строка = None
+            if строка:
+                yield строка
+                выдано += len(строка) + 1
+                if макс_символов is not None and выдано >= макс_символов:
+                    return
+            if глубина == 2 and тело is not None:
+                # Закончен элемент верхнего уровня тела — выбрасываем уже прочитанное
+                тело.clear()
+
+
+PDF_ПРОЦЕССОВ = min(4, os.cpu_count() or 1)   # разумный размер пула для читать_pdf(процессов=...)
+PDF_ПАРАЛЛЕЛЬНО_ОТ_СТРАНИЦ = 16   # меньше — пул процессов дороже самого извлечения
+
+_PDF_ЧИТАТЕЛЬ = None
+
+
+def _открыть_pdf(content: bytes):
+    # Инициализатор процесса пула: документ разбирается один раз на процесс
+    global _PDF_ЧИТАТЕЛЬ
+    from PyPDF2 import PdfReader
+    _PDF_ЧИТАТЕЛЬ = PdfReader(_поток(content))
+
+
+def _страница_pdf(i: int, читатель=None) -> Tuple[str, float]:
+    начало = time.perf_counter()
+    текст = (читатель or _PDF_ЧИТАТЕЛЬ).pages[i].extract_text() or ""
+    return текст, (time.perf_counter() - начало) * 1000
+
+
+def читать_pdf(content: bytes, макс_символов: Optional[int] = МАКС_СИМВОЛОВ_ДОКУМЕНТА,
+               процессов: int = 1):
+    """Страницы PDF по порядку: {"страница", "текст", "мс"}; останавливается на макс_символов.
+
+    По умолчанию страницы читаются последовательно в текущем процессе.
+    процессов > 1 — явное согласие на пул (для CLI и бенчмарков, не для
+    многопоточного сервера): от PDF_ПАРАЛЛЕЛЬНО_ОТ_СТРАНИЦ страниц документ
+    извлекается пулом spawn-процессов, каждый получает свою копию файла.
+    Окно — два задания на процесс, поэтому после исчерпания бюджета лишние
+    страницы не разбираются.
+    """
+    from PyPDF2 import PdfReader
+
+    with _поток(content) as поток:
+        читатель = PdfReader(поток)
+        страниц = len(читатель.pages)
+        if страниц < PDF_ПАРАЛЛЕЛЬНО_ОТ_СТРАНИЦ:
+            процессов = 1
+        if процессов <= 1:
+            выдано = 0
+            for i in range(страниц):
+                текст, мс = _страница_pdf(i, читатель)
+                yield {"страница": i + 1, "текст": текст, "мс": мс}
+                выдано += len(текст) + 1
+                if макс_символов is not None and выдано >= макс_символов:
+                    return
+            return
+        del читатель
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    выдано = 0
+    # spawn, а не fork: fork многопоточного процесса может зависнуть на чужом замке.
+    # Процессам пула нужен bytes: memoryview и mmap не передаются между процессами
+    пул = ProcessPoolExecutor(процессов, mp_context=multiprocessing.get_context("spawn"),
+                              initializer=_открыть_pdf,
+                              initargs=(content if isinstance(content, bytes) else bytes(content),))
+    try:
+        в_работе = {}
+        for i in range(страниц):
+            for j in range(i + len(в_работе), min(страниц, i + 2 * процессов)):
+                в_работе[j] = пул.submit(_страница_pdf, j)
+            текст, мс = в_работе.pop(i).result()
+            yield {"страница": i + 1, "текст": текст, "мс": мс}
+            выдано += len(текст) + 1
+            if макс_символов is not None and выдано >= макс_символов:
+                return
+    finally:
+        пул.shutdown(cancel_futures=True)
+
+
+def разобрать_содержимое(content: bytes, name: str, процессов: int = 1,
+                         страницы: Optional[List[Dict]] = None):
+    """(ok, текст) не длиннее МАКС_СИМВОЛОВ_ДОКУМЕНТА.
+
+    content — bytes или буфер (см. буфер_загрузки), он не копируется. Для PDF в список страницы (если передан) пишутся замеры
+    {"страница", "символов", "мс"}; процессов — см. читать_pdf.
+    """
+    name = name.lower()
+    
+    if name.endswith('.txt'):
+        return True, декодировать_текст(content)
+    
+    elif name.endswith('.docx'):
+        text = '\n'.join(читать_docx(content))[:МАКС_СИМВОЛОВ_ДОКУМЕНТА]
+        return (True, text) if text else (False, "Пустой документ")
+    
+    elif name.endswith('.pdf') and PDF_AVAILABLE:
+        части = []
+        for стр in читать_pdf(content, процессов=процессов):
+            части.append(стр["текст"])
+            if страницы is not None:
+                страницы.append({"страница": стр["страница"], "символов": len(стр["текст"]), "мс": round(стр["мс"], 1)})
+        text = '\n'.join(части)[:МАКС_СИМВОЛОВ_ДОКУМЕНТА]
+        return (True, text) if text.strip() else (False, "Не удалось извлечь")
+    
+    return False, "Неподдерживаемый формат"
+
+
+def _rss_байт() -> Optional[int]:
+    # Резидентная память процесса из /proc/self/statm — одно чтение, микросекунды; не Linux — None
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def разобрать_загрузку(f):
+    """Разбор загруженного файла через кэш: {"ok", "текст", "извлечённые", "хеш", "страницы", "память"}.
+
+    страницы — замеры извлечения PDF по страницам (для остальных форматов пусто),
+    память — {"файл_мб", "прирост_мб"}: размер файла и прирост RSS процесса за разбор
+    (None, где RSS не читается). Прирост — то, что осталось занятым после разбора,
+    а не пик внутри него; пик меряет bench.py загрузка.
+    """
+    try:
+        with буфер_загрузки(f) as content:
+            хеш = hashlib.sha256(content).hexdigest()
+            кэш = кэш_разбора()
+            запись = кэш.получить(хеш)
+            if запись is None:
+                страницы = []
+                до = _rss_байт()
+                ok, текст = разобрать_содержимое(content, f.name, страницы=страницы)
+                после = _rss_байт()
+                прирост = round(max(0, после - до) / 2**20, 1) if до is not None and после is not None else None
+                запись = {"ok": ok, "текст": текст, "извлечённые": None, "хеш": хеш, "страницы": страницы,
+                          "память": {"файл_мб": round(len(content) / 2**20, 1), "прирост_мб": прирост}}
+                кэш.положить(хеш, запись)
+    except Exception as e:
+        return {"ok": False, "текст": str(e), "извлечённые": None, "хеш": None, "страницы": [], "память": None}
+    
+    if запись["ok"] and запись["извлечённые"] is None:
+        запись["извлечённые"] = извлечь_все_данные(запись["текст"])
+    return запись
+
+
+def загрузить_файл(f):
+    if not f:
+        return False, ""
+    запись = разобрать_загрузку(f)
+    return запись["ok"], запись["текст"]
@@ -0,0 +1,573 @@
+"""
+Архив анализов Регламента Светофор.
+
+Каждый завершённый анализ (зона, RAG-сличение, AI-заключение) хранится
+в SQLite в каталоге данных ядра и переживает выход из системы. Выборки
+для вкладки «История» — постраничные по ключу (id < последнего
+показанного), поэтому страница строится за одно обращение к индексу
+при любом объёме архива.
+
+Тексты договоров и найденные нарушения индексируются FTS5: поиск
+по словам и фразам («молчание означает согласие» транслогистик)
+без учёта регистра и ё/е.
+
+По каждому контрагенту (ключ — ИНН, без него — нормализованное имя)
+триггеры SQLite ведут сводку: число договоров, сумма, красные и жёлтые
+зоны, нарушения. Договор (хеш текста) учитывается один раз — по последнему
+анализу. Сводка общая для всей организации, а не для пользователя:
+экспозиция к контрагенту складывается из всех договоров с ним, а чужие
+тексты и нарушения через неё не видны. Карточка зоны читает её одной строкой.
+
+Для повторно присланных договоров (изменены дата или сумма) хранятся
+MinHash-подписи текстов и LSH-полосы: похожие находятся несколькими
+обращениями к индексу, без перебора архива.
+"""
+
+import hashlib, json, re, sqlite3, threading, time, zlib
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import core
+
+РАЗМЕР_СТРАНИЦЫ = 50
+
+ПОЛЯ_АРХИВА = [
+    "хеш", "пользователь", "тип_документа", "номер", "дата_договора", "контрагент", "контрагент_норм", "инн",
+    "сумма", "форма", "тип_сделки", "зона", "причина", "юд", "срок",
+    "тф", "вердикт", "соответствие", "красных", "жёлтых", "результат",
+]
+
+# Порядок страниц: поле и направление; каждому — индекс (поле, id), id разрешает равенства
+ПОРЯДКИ_АРХИВА = {
+    "новые": ("id", True),
+    "старые": ("id", False),
+    "сумма": ("сумма", True),
+    "контрагент": ("контрагент_норм", False),
+}
+
+НАЙДЕНО_МАКС = 50
+
+# MinHash: 128 хешей по шинглам из 5 слов; LSH — 16 полос по 8 хешей.
+# Вероятность попасть в кандидаты при сходстве s: 1 - (1 - s^8)^16 — 0.82 при 0.8, 0.02 при 0.5
+ШИНГЛ_СЛОВ = 5
+ПОДПИСЬ_ХЕШЕЙ = 128
+ПОЛОС_LSH = 16
+ПОРОГ_СХОДСТВА = 0.8
+КАНДИДАТОВ_МАКС = 200
+
+_ОПФ = re.compile(r'^(?:ооо|оао|зао|пао|нао|ао|ип|фгуп|гуп|муп)\s+')
+
+
+def нормализовать_контрагента(имя: Optional[str]) -> str:
+    """Ключ поиска: нижний регистр, ё→е, без кавычек и организационно-правовой формы."""
+    имя = (имя or "").lower().replace("ё", "е")
+    имя = re.sub(r'[«»"“”„\']', " ", имя)
+    имя = re.sub(r'\s+', " ", имя).strip()
+    return _ОПФ.sub("", имя)
+
+
+def ключ_контрагента(инн: Optional[str], контрагент: Optional[str]) -> Optional[str]:
+    """Ключ сводки по контрагенту: ИНН, а без него — нормализованное имя."""
+    if инн:
+        return инн
+    имя = нормализовать_контрагента(контрагент)
+    return f"имя:{имя}" if имя else None
+
+
+def _ключ_sql(строка: str) -> str:
+    # То же, что ключ_контрагента, для триггеров (строка — NEW, OLD или алиас таблицы)
+    return (f"CASE WHEN COALESCE({строка}.инн, '') != '' THEN {строка}.инн "
+            f"WHEN COALESCE({строка}.контрагент_норм, '') != '' THEN 'имя:' || {строка}.контрагент_норм END")
+
+
+def _вклад_sql(строка: str) -> str:
+    # Вклад одной записи в сводку: сумма, красная/жёлтая зона, красных/жёлтых нарушений
+    return (f"COALESCE({строка}.сумма, 0), {строка}.зона IS 'красная', {строка}.зона IS 'жёлтая', "
+            f"COALESCE({строка}.красных, 0), COALESCE({строка}.жёлтых, 0)")
+
+
+def _пересчёт_договора_sql(строка: str) -> str:
+    # Тело триггера: пара (ключ, хеш) строки NEW или OLD заменяет в сводке свой прежний вклад
+    # вкладом последнего анализа пары; пара без анализов из сводки выходит
+    ключ = _ключ_sql(строка)
+    пара = lambda т="": f"{т}ключ = ({ключ}) AND {т}хеш = {строка}.хеш"
+    return f"""
+        UPDATE контрагенты SET
+            договоров = договоров - 1, сумма = контрагенты.сумма - д.сумма,
+            красных_зон = красных_зон - д.красная, жёлтых_зон = жёлтых_зон - д.жёлтая,
+            нарушений_красных = нарушений_красных - д.красных, нарушений_жёлтых = нарушений_жёлтых - д.жёлтых
+        FROM договоры_контрагентов д WHERE {пара('д.')} AND контрагенты.ключ = д.ключ;
+        DELETE FROM договоры_контрагентов WHERE {пара()};
+        INSERT INTO договоры_контрагентов
+            SELECT ({ключ}), а.хеш, а.id, {_вклад_sql("а")} FROM анализы а
+            WHERE а.хеш = {строка}.хеш AND ({_ключ_sql("а")}) = ({ключ}) ORDER BY а.id DESC LIMIT 1;
+        INSERT INTO контрагенты (ключ, инн, название, договоров, сумма, красных_зон, жёлтых_зон,
+                                 нарушений_красных, нарушений_жёлтых, обновлён)
+            SELECT д.ключ, а.инн, а.контрагент, 1, д.сумма, д.красная, д.жёлтая, д.красных, д.жёлтых, а.обновлён
+            FROM договоры_контрагентов д JOIN анализы а ON а.id = д.id WHERE {пара('д.')}
+            ON CONFLICT (ключ) DO UPDATE SET
+                инн = COALESCE(excluded.инн, инн), название = excluded.название,
+                договоров = договоров + 1, сумма = сумма + excluded.сумма,
+                красных_зон = красных_зон + excluded.красных_зон, жёлтых_зон = жёлтых_зон + excluded.жёлтых_зон,
+                нарушений_красных = нарушений_красных + excluded.нарушений_красных,
+                нарушений_жёлтых = нарушений_жёлтых + excluded.нарушений_жёлтых,
+                обновлён = excluded.обновлён;
+        DELETE FROM контрагенты WHERE ключ = ({ключ}) AND договоров <= 0;"""
+
+
+def нормализовать_для_поиска(текст: Optional[str]) -> str:
+    # Регистр свёртывает токенизатор FTS5, а ё/е — нет
+    return (текст or "").lower().replace("ё", "е")
+
+
+_ОКОНЧАНИЕ = re.compile(r'(?:[аеиоуыэюяйь]{1,2})$')
+
+
+def запрос_fts(строка: str) -> str:
+    """Запрос пользователя → выражение FTS5: фразы в кавычках ищутся дословно,
+    отдельные слова — по основе (молчание → молчан*), все условия через И."""
+    части = []
+    for фраза, слово in re.findall(r'"([^"]*)"|([^\s"]+)', нормализовать_для_поиска(строка)):
+        слова = re.findall(r'\w+', фраза or слово)
+        if not слова:
+            continue
+        if фраза:
+            части.append('"' + " ".join(слова) + '"')
+            continue
+        for с in слова:
+            # Грубое отсечение окончания: русские словоформы отличаются в последних 1–2 буквах
+            основа = _ОКОНЧАНИЕ.sub("", с) if len(с) > 5 else с
+            части.append(f'"{основа}"*')
+    return " ".join(части)
+
+
+_MINHASH = None
+
+
+def _параметры_minhash():
+    # Фиксированное зерно: подписи должны совпадать между процессами и перезапусками
+    global _MINHASH
+    if _MINHASH is None:
+        import numpy as np
+        rng = np.random.default_rng(20250115)
+        a = rng.integers(1, 2**63, ПОДПИСЬ_ХЕШЕЙ, dtype=np.uint64) | np.uint64(1)
+        b = rng.integers(0, 2**63, ПОДПИСЬ_ХЕШЕЙ, dtype=np.uint64)
+        _MINHASH = (a[:, None], b[:, None])
+    return _MINHASH
+
+
+def подпись_minhash(текст: str) -> bytes:
+    """MinHash-подпись текста: ПОДПИСЬ_ХЕШЕЙ × uint32 по шинглам из ШИНГЛ_СЛОВ слов."""
+    import numpy as np
+    слова = re.findall(r'\w+', нормализовать_для_поиска(текст))
+    хеши_слов = np.fromiter((zlib.crc32(с.encode("utf-8")) for с in слова), dtype=np.uint64, count=len(слова))
+    if len(хеши_слов) < ШИНГЛ_СЛОВ:
+        хеши_слов = np.pad(хеши_слов, (0, ШИНГЛ_СЛОВ - len(хеши_слов)))
+    # Хеш шингла — полином от хешей слов (переполнение uint64 — это mod 2^64)
+    n = len(хеши_слов) - ШИНГЛ_СЛОВ + 1
+    шинглы = np.zeros(n, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for k in range(ШИНГЛ_СЛОВ):
+            шинглы = шинглы * np.uint64(1_000_003) + хеши_слов[k:k + n]
+        шинглы = np.unique(шинглы)
+        a, b = _параметры_minhash()
+        подпись = np.full(ПОДПИСЬ_ХЕШЕЙ, np.iinfo(np.uint32).max, dtype=np.uint64)
+        for i in range(0, len(шинглы), 4096):
+            # Умножение со сдвигом: старшие 32 бита (a·x + b) mod 2^64 — универсальный хеш
+            значения = (a * шинглы[i:i + 4096] + b) >> np.uint64(32)
+            подпись = np.minimum(подпись, значения.min(axis=1))
+    return подпись.astype(np.uint32).tobytes()
+
+
+def сходство_подписей(a: bytes, b: bytes) -> float:
+    """Оценка коэффициента Жаккара по двум подписям."""
+    import numpy as np
+    return float((np.frombuffer(a, dtype=np.uint32) == np.frombuffer(b, dtype=np.uint32)).mean())
+
+
+def полосы_lsh(подпись: bytes) -> List[int]:
+    шаг = len(подпись) // ПОЛОС_LSH
+    return [int.from_bytes(hashlib.blake2b(подпись[i:i + шаг], digest_size=8).digest(), "big", signed=True)
+            for i in range(0, len(подпись), шаг)]
+
+
+def _в_json(значение):
+    if isinstance(значение, (date, datetime)):
+        return значение.isoformat()
+    raise TypeError(type(значение).__name__)
+
+
+def запись_анализа(текст: str, извлечённые: Optional[Dict], пользователь: str = "",
+                   контрагент: Optional[str] = None, сумма: Optional[float] = None,
+                   форма: str = "", тип_сделки: str = "", зона: Optional[Dict] = None,
+                   rag: Optional[Dict] = None, ai: str = "", инн_организации: str = "") -> Dict:
+    """Строка архива из результатов анализа; контрагент и сумма — с учётом правок пользователя.
+
+    Текст договора и нарушения попадают только в полнотекстовый индекс.
+    Собственный ИНН организации контрагентом не считается.
+    """
+    извлечённые = извлечённые or {}
+    тип_док = извлечённые.get("тип_док") or {}
+    контрагент = контрагент if контрагент is not None else извлечённые.get("контрагент")
+    инн = извлечённые.get("инн")
+    запись = {
+        "хеш": hashlib.sha256(текст.encode("utf-8")).hexdigest(),
+        "пользователь": пользователь,
+        "тип_документа": тип_док.get("название", ""),
+        "номер": извлечённые.get("номер") or "",
+        "дата_договора": извлечённые["дата"].isoformat() if извлечённые.get("дата") else None,
+        "контрагент": контрагент or "",
+        "контрагент_норм": нормализовать_контрагента(контрагент),
+        "инн": инн if инн and инн != инн_организации else None,
+        "сумма": сумма if сумма is not None else (извлечённые.get("сумма") or 0),
+        "форма": форма, "тип_сделки": тип_сделки,
+    }
+    if зона:
+        запись.update({"зона": зона["зона"], "причина": зона["причина"], "юд": int(зона["юд"]), "срок": зона["срок"]})
+    if rag:
+        запись.update({"тф": rag.get("название_тф", ""), "вердикт": rag.get("вердикт", ""),
+                       "соответствие": rag.get("соответствие"), "красных": rag.get("красных"),
+                       "жёлтых": rag.get("жёлтых")})
+    запись["текст"] = текст
+    запись["нарушения"] = "\n".join(
+        f"{н.get('пункт') or ''} {н.get('название', '')} {н.get('эталон', '')} {н.get('контекст', '')}"
+        for н in (rag or {}).get("нарушения", []))
+    запись["результат"] = json.dumps({"извлечённые": извлечённые, "зона": зона, "rag": rag, "ai": ai},
+                                     ensure_ascii=False, default=_в_json)
+    return запись
+
+
+class Архив:
+    """Архив анализов в SQLite с индексами по контрагенту, дате и зоне."""
+
+    def __init__(self, путь: str):
+        self.путь = путь
+        self._lock = threading.Lock()
+        with self._соединение() as бд:
+            бд.execute("PRAGMA journal_mode=WAL")
+            бд.execute("""CREATE TABLE IF NOT EXISTS анализы (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                создан REAL NOT NULL, обновлён REAL NOT NULL,
+                хеш TEXT NOT NULL, пользователь TEXT,
+                тип_документа TEXT, номер TEXT, дата_договора TEXT,
+                контрагент TEXT, контрагент_норм TEXT, инн TEXT, сумма REAL,
+                форма TEXT, тип_сделки TEXT,
+                зона TEXT, причина TEXT, юд INTEGER, срок INTEGER,
+                тф TEXT, вердикт TEXT, соответствие INTEGER, красных INTEGER, жёлтых INTEGER,
+                результат TEXT)""")
+            self._сводка_контрагентов(бд)
+            # id растёт вместе со временем создания, поэтому (…, id) даёт и фильтр, и порядок страниц
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_контрагент ON анализы(контрагент_норм, id)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_зона ON анализы(зона, id)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_создан ON анализы(создан)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_дата_договора ON анализы(дата_договора)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_пользователь ON анализы(пользователь, id)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_хеш ON анализы(хеш)")
+            бд.execute("CREATE INDEX IF NOT EXISTS анализы_сумма ON анализы(сумма, id)")
+            # Тексты хранятся как есть, а в индекс FTS5 (external content) попадают нормализованными:
+            # ё → е не меняет границ слов, поэтому snippet() подсвечивает исходный текст
+            бд.execute("""CREATE TABLE IF NOT EXISTS тексты (
+                id INTEGER PRIMARY KEY, контрагент TEXT, текст TEXT, нарушения TEXT)""")
+            бд.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS поиск USING fts5(
+                контрагент, текст, нарушения, content='тексты', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2')""")
+            бд.execute("CREATE TABLE IF NOT EXISTS подписи (id INTEGER PRIMARY KEY, подпись BLOB NOT NULL)")
+            бд.execute("""CREATE TABLE IF NOT EXISTS полосы (
+                полоса INTEGER, ключ INTEGER, id INTEGER, PRIMARY KEY (полоса, ключ, id)) WITHOUT ROWID""")
+            бд.execute("CREATE INDEX IF NOT EXISTS полосы_id ON полосы(id)")
+
+    @staticmethod
+    def _сводка_контрагентов(бд):
+        # Сводка ведётся триггерами по различным договорам: от каждой пары (ключ, хеш) в неё
+        # входит только последний анализ, и повторный анализ того же текста её не раздувает.
+        # Изменение пары вычитает вклад прежнего последнего анализа и добавляет вклад нового;
+        # история при этом не сканируется — только анализы с тем же хешем (индекс анализы_хеш)
+        бд.execute("""CREATE TABLE IF NOT EXISTS контрагенты (
+            ключ TEXT PRIMARY KEY, инн TEXT, название TEXT,
+            договоров INTEGER NOT NULL, сумма REAL NOT NULL, красных_зон INTEGER NOT NULL, жёлтых_зон INTEGER NOT NULL,
+            нарушений_красных INTEGER NOT NULL, нарушений_жёлтых INTEGER NOT NULL, обновлён REAL)""")
+        бд.execute("""CREATE TABLE IF NOT EXISTS договоры_контрагентов (
+            ключ TEXT, хеш TEXT, id INTEGER NOT NULL, сумма REAL NOT NULL, красная INTEGER NOT NULL,
+            жёлтая INTEGER NOT NULL, красных INTEGER NOT NULL, жёлтых INTEGER NOT NULL,
+            PRIMARY KEY (ключ, хеш)) WITHOUT ROWID""")
+        бд.executescript(f"""
+            CREATE TRIGGER IF NOT EXISTS анализы_сводка_вставка AFTER INSERT ON анализы
+                BEGIN {_пересчёт_договора_sql("NEW")} END;
+            CREATE TRIGGER IF NOT EXISTS анализы_сводка_удаление AFTER DELETE ON анализы
+                BEGIN {_пересчёт_договора_sql("OLD")} END;
+            CREATE TRIGGER IF NOT EXISTS анализы_сводка_изменение
+                AFTER UPDATE OF хеш, инн, контрагент, контрагент_норм, сумма, зона, красных, жёлтых ON анализы
+                BEGIN {_пересчёт_договора_sql("OLD")} {_пересчёт_договора_sql("NEW")} END;
+        """)
+
+    def _соединение(self):
+        соединение = sqlite3.connect(self.путь, timeout=10, isolation_level=None)
+        соединение.row_factory = sqlite3.Row
+        return соединение
+
+    def записать(self, запись: Dict, id_: Optional[int] = None) -> int:
+        """Новая запись или обновление существующей (повторный анализ того же договора в сессии)."""
+        поля = {к: запись[к] for к in ПОЛЯ_АРХИВА if к in запись}
+        сейчас = time.time()
+        with self._lock, self._соединение() as бд:
+            бд.execute("BEGIN")
+            обновлено = False
+            if id_ is not None:
+                установить = ", ".join(f"{к} = ?" for к in поля)
+                обновлено = бд.execute(f"UPDATE анализы SET {установить}, обновлён = ? WHERE id = ?",
+                                       [*поля.values(), сейчас, id_]).rowcount > 0
+            if not обновлено:
+                столбцы = ", ".join(поля)
+                метки = ", ".join("?" for _ in поля)
+                создан = self._время_создания(бд, сейчас)
+                id_ = бд.execute(f"INSERT INTO анализы (создан, обновлён, {столбцы}) VALUES (?, ?, {метки})",
+                                 [создан, создан, *поля.values()]).lastrowid
+            self._проиндексировать(бд, id_, запись)
+            бд.execute("COMMIT")
+            return id_
+
+    @staticmethod
+    def _время_создания(бд, сейчас: float) -> float:
+        # Фильтр по периоду переводит создан в диапазон id (см. _условия), поэтому создан не
+        # убывает вместе с id: часы, переведённые назад, не дают записи «из прошлого»
+        последний = бд.execute("SELECT MAX(создан) FROM анализы").fetchone()[0]
+        return сейчас if последний is None else max(сейчас, последний)
+
+    @staticmethod
+    def _проиндексировать(бд, id_: int, запись: Dict):
+        if "текст" not in запись:
+            return
+        новые = (запись.get("контрагент") or "", запись["текст"], запись.get("нарушения") or "")
+        старые = бд.execute("SELECT контрагент, текст, нарушения FROM тексты WHERE id = ?", (id_,)).fetchone()
+        if старые is not None:
+            if tuple(старые) == новые:
+                # Зона и AI дописываются к той же записи — текст заново не разбирается
+                return
+            Архив._убрать_из_индекса(бд, id_, старые)
+        бд.execute("INSERT OR REPLACE INTO тексты (id, контрагент, текст, нарушения) VALUES (?, ?, ?, ?)",
+                   (id_, *новые))
+        бд.execute("INSERT INTO поиск (rowid, контрагент, текст, нарушения) VALUES (?, ?, ?, ?)",
+                   (id_, *map(нормализовать_для_поиска, новые)))
+        if старые is None or старые[1] != новые[1]:
+            подпись = подпись_minhash(новые[1])
+            бд.execute("INSERT OR REPLACE INTO подписи (id, подпись) VALUES (?, ?)", (id_, подпись))
+            бд.execute("DELETE FROM полосы WHERE id = ?", (id_,))
+            бд.executemany("INSERT INTO полосы (полоса, ключ, id) VALUES (?, ?, ?)",
+                           [(i, ключ, id_) for i, ключ in enumerate(полосы_lsh(подпись))])
+
+    @staticmethod
+    def _убрать_из_индекса(бд, id_: int, старые):
+        # External content: FTS5 удаляет токены по тем же значениям, что были проиндексированы
+        бд.execute("INSERT INTO поиск (поиск, rowid, контрагент, текст, нарушения) VALUES ('delete', ?, ?, ?, ?)",
+                   (id_, *map(нормализовать_для_поиска, старые)))
+
+    def записать_много(self, записи: List[Dict]) -> int:
+        """Пакетная вставка (импорт, тестовое наполнение). Время создания — момент вставки."""
+        with self._lock, self._соединение() as бд:
+            бд.execute("BEGIN")
+            создан = self._время_создания(бд, time.time())
+            for запись in записи:
+                поля = {к: запись[к] for к in ПОЛЯ_АРХИВА if к in запись}
+                поля.setdefault("сумма", 0)
+                id_ = бд.execute(f"INSERT INTO анализы (создан, обновлён, {', '.join(поля)}) "
+                                 f"VALUES (?, ?, {', '.join('?' for _ in поля)})",
+                                 [создан, создан, *поля.values()]).lastrowid
+                self._проиндексировать(бд, id_, запись)
+            бд.execute("COMMIT")
+        return len(записи)
+
+    def получить(self, id_: int) -> Optional[Dict]:
+        with self._соединение() as бд:
+            строка = бд.execute("SELECT * FROM анализы WHERE id = ?", (id_,)).fetchone()
+        if строка is None:
+            return None
+        запись = dict(строка)
+        запись["результат"] = json.loads(запись["результат"] or "{}")
+        return запись
+
+    @staticmethod
+    def _условия(бд, контрагент: str = "", зона: str = "", пользователь: Optional[str] = None,
+                 с: Optional[float] = None, по: Optional[float] = None):
+        условия, параметры = [], []
+        if контрагент:
+            # Префикс нормализованного имени — диапазон по индексу, без LIKE '%…%'
+            ключ = нормализовать_контрагента(контрагент)
+            условия.append("контрагент_норм >= ? AND контрагент_норм < ?")
+            параметры += [ключ, ключ + "\uffff"]
+        if зона:
+            условия.append("зона = ?")
+            параметры.append(зона)
+        if пользователь is not None:
+            условия.append("пользователь = ?")
+            параметры.append(пользователь)
+        # Период переводится в диапазон id двумя поисками по индексу создан:
+        # тогда страница идёт по первичному ключу без сортировки всего периода
+        if с is not None:
+            строка = бд.execute("SELECT id FROM анализы WHERE создан >= ? ORDER BY создан LIMIT 1", (с,)).fetchone()
+            условия.append("id >= ?")
+            параметры.append(строка[0] if строка else 2 ** 62)
+        if по is not None:
+            строка = бд.execute("SELECT id FROM анализы WHERE создан < ? ORDER BY создан DESC LIMIT 1", (по,)).fetchone()
+            условия.append("id <= ?")
+            параметры.append(строка[0] if строка else -1)
+        return условия, параметры
+
+    def страница(self, после: Optional[tuple] = None, размер: int = РАЗМЕР_СТРАНИЦЫ,
+                 порядок: str = "новые", **фильтры) -> Dict:
+        """Страница записей после курсора; {"строки", "следующий"} — курсор следующей страницы или None.
+
+        Порядок — ключ ПОРЯДКИ_АРХИВА. Фильтры: контрагент (префикс), зона, пользователь,
+        с/по (unix time создания).
+        """
+        поле, убывание = ПОРЯДКИ_АРХИВА[порядок]
+        знак, направление = ("<", "DESC") if убывание else (">", "ASC")
+        столбцы = ", ".join(["id", "создан"] + [п for п in ПОЛЯ_АРХИВА if п != "результат"])
+        with self._соединение() as бд:
+            условия, параметры = self._условия(бд, **фильтры)
+            if после is not None:
+                if поле == "id":
+                    условия.append(f"id {знак} ?")
+                    параметры.append(после[-1])
+                else:
+                    условия.append(f"({поле}, id) {знак} (?, ?)")
+                    параметры += list(после)
+            где = f"WHERE {' AND '.join(условия)}" if условия else ""
+            порядок_sql = "id" if поле == "id" else f"{поле} {направление}, id"
+            строки = [dict(с) for с in бд.execute(
+                f"SELECT {столбцы} FROM анализы {где} ORDER BY {порядок_sql} {направление} LIMIT ?",
+                [*параметры, размер + 1])]
+        следующий = None
+        if len(строки) > размер:
+            последняя = строки[размер - 1]
+            следующий = (последняя["id"],) if поле == "id" else (последняя[поле], последняя["id"])
+        return {"строки": строки[:размер], "следующий": следующий}
+
+    def количество(self, **фильтры) -> int:
+        with self._соединение() as бд:
+            условия, параметры = self._условия(бд, **фильтры)
+            где = f"WHERE {' AND '.join(условия)}" if условия else ""
+            return бд.execute(f"SELECT COUNT(*) FROM анализы {где}", параметры).fetchone()[0]
+
+    def найти(self, запрос: str, пользователь: Optional[str] = None, лимит: int = НАЙДЕНО_МАКС) -> List[Dict]:
+        """Полнотекстовый поиск по текстам, контрагентам и нарушениям; лучшие совпадения (bm25) с фрагментом."""
+        выражение = запрос_fts(запрос)
+        if not выражение:
+            return []
+        условие, параметры = ("AND а.пользователь = ?", [пользователь]) if пользователь is not None else ("", [])
+        with self._соединение() as бд:
+            try:
+                return [dict(с) for с in бд.execute(
+                    f"""SELECT а.id, а.создан, а.контрагент, а.тип_документа, а.сумма, а.зона, а.вердикт,
+                               а.пользователь, snippet(поиск, -1, '**', '**', '…', 16) AS фрагмент
+                        FROM поиск JOIN анализы а ON а.id = поиск.rowid
+                        WHERE поиск MATCH ? {условие} ORDER BY rank LIMIT ?""",
+                    [выражение, *параметры, лимит])]
+            except sqlite3.OperationalError as e:
+                raise ValueError(f"Не удалось разобрать запрос: {e}") from None
+
+    def похожие(self, текст: str, порог: float = ПОРОГ_СХОДСТВА, пользователь: Optional[str] = None,
+                лимит: int = 5) -> List[Dict]:
+        """Ранее проанализированные договоры, похожие на текст (MinHash ≥ порог), от самого похожего.
+
+        Кандидаты — записи, совпавшие с текстом хотя бы в одной LSH-полосе:
+        ПОЛОС_LSH обращений к индексу при любом объёме архива.
+        """
+        подпись = подпись_minhash(текст)
+        хеш = hashlib.sha256(текст.encode("utf-8")).hexdigest()
+        условие, параметры = ("AND а.пользователь = ?", [пользователь]) if пользователь is not None else ("", [])
+        with self._соединение() as бд:
+            кандидаты = set()
+            for i, ключ in enumerate(полосы_lsh(подпись)):
+                # Чужие записи отсеиваются здесь же, чтобы не занимать места кандидатов
+                кандидаты.update(id_ for (id_,) in бд.execute(
+                    f"""SELECT п.id FROM полосы п JOIN анализы а ON а.id = п.id
+                        WHERE п.полоса = ? AND п.ключ = ? {условие} LIMIT ?""", (i, ключ, *параметры, КАНДИДАТОВ_МАКС)))
+                if len(кандидаты) >= КАНДИДАТОВ_МАКС:
+                    break
+            if not кандидаты:
+                return []
+            метки = ", ".join("?" for _ in кандидаты)
+            строки = бд.execute(
+                f"""SELECT а.id, а.создан, а.хеш, а.контрагент, а.тип_документа, а.сумма, а.зона, а.вердикт,
+                           а.пользователь, п.подпись
+                    FROM подписи п JOIN анализы а ON а.id = п.id
+                    WHERE п.id IN ({метки}) {условие}""", [*кандидаты, *параметры]).fetchall()
+        найдено = []
+        for строка in строки:
+            запись = dict(строка)
+            подпись_записи = запись.pop("подпись")
+            запись["сходство"] = 1.0 if запись["хеш"] == хеш else сходство_подписей(подпись, подпись_записи)
+            if запись["сходство"] >= порог:
+                найдено.append(запись)
+        найдено.sort(key=lambda з: (-з["сходство"], -з["id"]))
+        return найдено[:лимит]
+
+    def контрагент(self, инн: Optional[str], контрагент: Optional[str]) -> Optional[Dict]:
+        """Сводка по контрагенту по всему архиву: договоров, сумма, красных/жёлтых зон и нарушений.
+
+        None — если анализов нет. Пользователем не ограничивается: это экспозиция организации.
+        """
+        ключ = ключ_контрагента(инн, контрагент)
+        if ключ is None:
+            return None
+        with self._соединение() as бд:
+            строка = бд.execute("SELECT * FROM контрагенты WHERE ключ = ?", (ключ,)).fetchone()
+        return dict(строка) if строка else None
+
+    def версия(self) -> tuple:
+        """Метка содержимого архива: меняется при любой записи, правке или удалении анализа."""
+        with self._соединение() as бд:
+            return tuple(бд.execute("SELECT MAX(id), COUNT(*), MAX(обновлён) FROM анализы").fetchone())
+
+    def сделки(self):
+        """Сделки с определённой зоной для симулятора порогов: DataFrame (сумма, форма, тип_сделки).
+
+        Договор (хеш текста) входит один раз — последним анализом, как в сводке контрагентов.
+        """
+        import pandas as pd
+
+        with self._соединение() as бд:
+            строки = бд.execute("""SELECT сумма, форма, тип_сделки FROM анализы WHERE id IN (
+                SELECT MAX(id) FROM анализы WHERE зона IS NOT NULL GROUP BY хеш)""").fetchall()
+        сделки = pd.DataFrame([tuple(с) for с in строки], columns=["сумма", "форма", "тип_сделки"])
+        сделки["сумма"] = pd.to_numeric(сделки["сумма"], errors="coerce").astype(float)
+        return сделки
+
+    def текст(self, id_: int) -> Optional[str]:
+        with self._соединение() as бд:
+            строка = бд.execute("SELECT текст FROM тексты WHERE id = ?", (id_,)).fetchone()
+        return строка[0] if строка else None
+
+    def удалить(self, пользователь: Optional[str] = None) -> int:
+        with self._lock, self._соединение() as бд:
+            бд.execute("BEGIN")
+            if пользователь is None:
+                бд.execute("INSERT INTO поиск (поиск) VALUES ('delete-all')")
+                бд.execute("DELETE FROM тексты")
+                бд.execute("DELETE FROM подписи")
+                бд.execute("DELETE FROM полосы")
+                удалено = бд.execute("DELETE FROM анализы").rowcount
+            else:
+                for id_, *старые in бд.execute(
+                        "SELECT id, контрагент, текст, нарушения FROM тексты "
+                        "WHERE id IN (SELECT id FROM анализы WHERE пользователь = ?)", (пользователь,)).fetchall():
+                    self._убрать_из_индекса(бд, id_, старые)
+                for таблица in ("тексты", "подписи", "полосы"):
+                    бд.execute(f"DELETE FROM {таблица} WHERE id IN (SELECT id FROM анализы WHERE пользователь = ?)",
+                               (пользователь,))
+                удалено = бд.execute("DELETE FROM анализы WHERE пользователь = ?", (пользователь,)).rowcount
+            бд.execute("COMMIT")
+            return удалено
+
+
+_АРХИВ = None
+_АРХИВ_ЗАМОК = threading.Lock()
+
+
+def архив() -> Архив:
+    """Общий архив процесса в каталоге данных ядра (SVETOFOR_DATA_DIR)."""
+    global _АРХИВ
+    with _АРХИВ_ЗАМОК:
+        if _АРХИВ is None:
+            _АРХИВ = Архив(core.путь_данных("history.sqlite"))
+        return _АРХИВ
@@ -0,0 +1,31 @@
+import os, random, sys, tempfile
+
+# Кэши и архив ядра — во временном каталоге, а не в ~/.svetofor (читается при импорте core)
+os.environ.setdefault("SVETOFOR_DATA_DIR", tempfile.mkdtemp(prefix="svetofor-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import core
+
+# Строки, на которых легко разойтись с эталоном: реквизиты, даты, номера пунктов разной глубины
+СТРОКИ = core.ДЕМО_ДОГОВОР.split("\n") + [
+    "Договор № А-17/2025 от 01.02.2025", "«3» Марта 2024 г.", "Сумма: 1 250 000 (один миллион) руб.",
+    "ООО «Вектор», ИНН: 500100732259", "ЗАО \"Ромашка\" ИНН 7701234568", "неустойка 0,1% в день",
+    "12.5.2024", "4.1.2.3. Подпункт", "цена 3 500 РУБЛЕЙ", "ПАО «СПК-Плюс» ИНН 7700000001",
+    "срок 1.02 мес.", "от 10.02.2025 г.", "5.1. Заказчик несёт все риски", "ПРЕДОПЛАТА 100%",
+]
+
+
+def случайный_договор(rnd: random.Random, символов: int, с_нарушениями: bool = False) -> str:
+    """Синтетический договор bench.py со вставленными строками СТРОКИ."""
+    import bench
+    база = bench.синтетический_договор(символов, seed=rnd.randrange(10**6), с_нарушениями=с_нарушениями).split("\n")
+    for _ in range(rnd.randrange(0, 15)):
+        база.insert(rnd.randrange(len(база) + 1), rnd.choice(СТРОКИ))
+    return "\n".join(база)
+
+
+@pytest.fixture
+def rnd():
+    return random.Random(20250115)
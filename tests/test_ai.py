@@ -0,0 +1,111 @@
+"""AI-клиент против локальной заглушки провайдеров (ai_stub.py) и дисковый кэш ответов."""
+
+import pytest
+
+import ai_stub
+import core
+
+ПРОВАЙДЕРЫ = {"openai": {"openai": "k"}, "anthropic": {"anthropic": "k"}, "yandexgpt": {"yandexgpt": "k"}}
+
+
+@pytest.fixture
+def заглушка(monkeypatch):
+    сервер = ai_stub.запустить()
+    monkeypatch.setenv("SVETOFOR_AI_URL", сервер.адрес)
+    yield сервер
+    сервер.shutdown()
+    сервер.server_close()
+
+
+@pytest.fixture
+def кэш(tmp_path, monkeypatch):
+    кэш = core.КэшAI(str(tmp_path / "ai.sqlite"))
+    monkeypatch.setattr(core, "кэш_ai", lambda: кэш)
+    return кэш
+
+
+@pytest.fixture
+def часы(monkeypatch):
+    время = [1_000_000.0]
+    monkeypatch.setattr(core.time, "time", lambda: время[0])
+    return время
+
+
+@pytest.mark.parametrize("провайдер", list(ПРОВАЙДЕРЫ))
+def test_поток_провайдера(заглушка, провайдер):
+    куски = list(core.поток_провайдера(провайдер, "k", "Промпт", yandex_folder="папка"))
+    assert len(куски) > 1
+    assert "".join(куски) == ai_stub.ОТВЕТ_ПО_УМОЛЧАНИЮ
+    метрика = core.метрики_ai()[-1]
+    assert (метрика["провайдер"], метрика["ok"], метрика["символов"]) == (провайдер, True, len(ai_stub.ОТВЕТ_ПО_УМОЛЧАНИЮ))
+    assert метрика["ttft_мс"] is not None and метрика["ttft_мс"] <= метрика["всего_мс"]
+    assert "Промпт" in str(заглушка.последний_запрос["тело"])
+    assert core.сессия_провайдера(провайдер) is core.сессия_провайдера(провайдер)
+
+
+def test_ошибка_провайдера(заглушка):
+    заглушка.настройки["ошибка"] = 500
+    with pytest.raises(core.ОшибкаAI, match="500"):
+        list(core.поток_провайдера("openai", "k", "Промпт"))
+    метрика = core.метрики_ai()[-1]
+    assert not метрика["ok"] and "500" in метрика["ошибка"]
+
+
+def test_прерванный_поток_записывает_метрику(заглушка):
+    поток = core.поток_провайдера("anthropic", "k", "Промпт")
+    next(поток)
+    поток.close()
+    assert core.метрики_ai()[-1]["ошибка"] == "Прервано"
+
+
+def test_ai_анализ(заглушка, кэш):
+    ok, ответ = core.ai_анализ(core.ДЕМО_ДОГОВОР, core.извлечь_все_данные(core.ДЕМО_ДОГОВОР), {}, ПРОВАЙДЕРЫ["openai"])
+    assert ok and ответ == ai_stub.ОТВЕТ_ПО_УМОЛЧАНИЮ
+    assert core.ai_анализ("текст", {}, {}, {})[0] is False
+    assert core.ai_анализ("текст", {}, {}, ПРОВАЙДЕРЫ["yandexgpt"]) == (False, "Укажите Folder ID")
+
+
+def test_кэш_ttl(tmp_path, часы):
+    кэш = core.КэшAI(str(tmp_path / "ai.sqlite"), ttl_с=60)
+    кэш.положить("openai", "m", "промпт", "ответ")
+    assert кэш.получить("openai", "m", "промпт") == "ответ"
+    assert кэш.получить("openai", "другая", "промпт") is None
+    часы[0] += 61
+    assert кэш.получить("openai", "m", "промпт") is None
+    статистика = кэш.статистика()
+    assert (статистика["записей"], статистика["попаданий"], статистика["промахов"]) == (0, 1, 2)
+
+
+def test_кэш_вытесняет_давно_не_запрошенные(tmp_path, часы):
+    кэш = core.КэшAI(str(tmp_path / "ai.sqlite"), макс_байт=30)
+    for промпт in "абв":
+        кэш.положить("openai", "m", промпт, "x" * 10)
+        часы[0] += 1
+    кэш.получить("openai", "m", "а")            # «а» запрошен позже «б»
+    часы[0] += 1
+    кэш.положить("openai", "m", "г", "я" * 5)   # 10 байт в UTF-8
+    assert [п for п in "абвг" if кэш.получить("openai", "m", п)] == ["а", "в", "г"]
+    кэш.положить("openai", "m", "огромный", "x" * 31)
+    assert кэш.получить("openai", "m", "огромный") is None
+    статистика = кэш.статистика()
+    assert (статистика["записей"], статистика["байт"], статистика["вытеснено"]) == (3, 30, 1)
+    # Файл общий: другой экземпляр видит те же записи и счётчики
+    assert core.КэшAI(кэш.путь).статистика() == статистика
+
+
+def test_повторный_промпт_из_кэша(заглушка, кэш):
+    аргументы = (core.ДЕМО_ДОГОВОР, core.извлечь_все_данные(core.ДЕМО_ДОГОВОР), {}, ПРОВАЙДЕРЫ["anthropic"])
+    первый = "".join(core.ai_анализ_поток(*аргументы))
+    запросов = заглушка.запросов
+    assert list(core.ai_анализ_поток(*аргументы)) == [первый]
+    assert заглушка.запросов == запросов
+    assert core.метрики_ai()[-1]["кэш"] is True
+    "".join(core.ai_анализ_поток(*аргументы, с_кэшем=False))
+    assert заглушка.запросов == запросов + 1
+
+
+def test_прерванный_ответ_не_кэшируется(заглушка, кэш):
+    поток = core.ai_анализ_поток("договор", {}, {}, ПРОВАЙДЕРЫ["openai"])
+    next(поток)
+    поток.close()
+    assert кэш.статистика()["записей"] == 0
@@ -0,0 +1,96 @@
+"""Пакетный анализ: пул процессов против последовательной обработки, падение обработчика, реестр CSV и Parquet."""
+
+import csv
+import os
+import zipfile
+
+import pytest
+
+import batch
+import core
+
+
+@pytest.fixture
+def пакет(tmp_path):
+    каталог = tmp_path / "договоры"
+    (каталог / "вложенный").mkdir(parents=True)
+    (каталог / "демо.txt").write_bytes(core.ДЕМО_ДОГОВОР.encode("cp1251"))
+    (каталог / "вложенный" / "счёт.TXT").write_text("Счёт на оплату № 17 от 01.02.2025\nИтого 12 000 руб.", encoding="utf-8")
+    (каталог / "битый.docx").write_bytes(b"not a zip")
+    (каталог / "пустой.txt").write_bytes(b"")
+    (каталог / "картинка.png").write_bytes(b"\x89PNG")
+    return каталог
+
+
+_ОБРАБОТАТЬ = batch.обработать
+
+
+def _обработать_с_падением(источник, *параметры):
+    # Процесс пула (fork) наследует подмену: на «падении» обработчик умирает, как при нехватке памяти
+    if "падение" in источник[2]:
+        os._exit(1)
+    return _ОБРАБОТАТЬ(источник, *параметры)
+
+
+def _строки(путь):
+    with open(путь, encoding="utf-8-sig", newline="") as f:
+        return {с["файл"]: с for с in csv.DictReader(f)}
+
+
+def test_найти_файлы(пакет, tmp_path):
+    assert [ф[2] for ф in batch.найти_файлы(str(пакет))] == ["битый.docx", "вложенный/счёт.TXT", "демо.txt", "пустой.txt"]
+    архив = tmp_path / "договоры.zip"
+    имя = "Договор.txt".encode("cp866")
+    with zipfile.ZipFile(архив, "w") as z:
+        z.writestr("X" * (len(имя) - 4) + ".txt", core.ДЕМО_ДОГОВОР.encode("utf-8"))
+        z.writestr("папка/", b"")
+        z.writestr("readme.md", b"")
+    # Имя в cp866 без флага UTF-8 — как пишет архиватор Windows (zipfile так записать не даёт)
+    архив.write_bytes(архив.read_bytes().replace(b"X" * (len(имя) - 4) + b".txt", имя))
+    assert [ф[2] for ф in batch.найти_файлы(str(архив))] == ["Договор.txt"]
+    with batch.открыть(*batch.найти_файлы(str(архив))[0][:2]) as буфер:
+        assert bytes(буфер) == core.ДЕМО_ДОГОВОР.encode("utf-8")
+
+
+def test_пул_как_последовательно(пакет, tmp_path):
+    выход = tmp_path / "реестр.csv"
+    прогресс = []
+    итог = batch.пакетный_анализ(str(пакет), str(выход), процессов=2,
+                                 прогресс=lambda готово, всего, строка: прогресс.append((готово, всего)))
+    строки = _строки(выход)
+    assert sorted(строки) == ["битый.docx", "вложенный/счёт.TXT", "демо.txt", "пустой.txt"]
+    assert прогресс == [(i, 4) for i in range(1, 5)]
+    for ф in batch.найти_файлы(str(пакет)):
+        ожидается = batch.обработать(ф, batch.ФОРМА_ПО_УМОЛЧАНИЮ, "", None)
+        получено = строки[ф[2]]
+        for поле in batch.ПОЛЯ:
+            if поле != "время_с":
+                assert получено[поле] == str(ожидается[поле]), (ф[2], поле)
+    assert строки["демо.txt"]["ok"] == "True" and строки["демо.txt"]["зона"] == "красная"
+    assert строки["битый.docx"]["ok"] == "False" and строки["битый.docx"]["ошибка"]
+    assert (итог["всего"], итог["успешно"], итог["ошибок"]) == (4, 3, 1)
+    assert sum(итог["зоны"].values()) == 3
+
+
+def test_реестр_parquet(пакет, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    выход = tmp_path / "реестр.parquet"
+    batch.пакетный_анализ(str(пакет), str(выход), процессов=1, прогресс=None)
+    таблица = pq.read_table(выход).to_pylist()
+    assert sorted(с["файл"] for с in таблица) == ["битый.docx", "вложенный/счёт.TXT", "демо.txt", "пустой.txt"]
+    assert {с["файл"]: с["ok"] for с in таблица}["демо.txt"] is True
+
+
+def test_падение_обработчика_не_губит_пакет(пакет, tmp_path, monkeypatch):
+    for i in range(6):
+        (пакет / f"копия{i}.txt").write_bytes(core.ДЕМО_ДОГОВОР.encode("utf-8"))
+    (пакет / "падение.txt").write_bytes(b"")
+    monkeypatch.setattr(batch, "обработать", _обработать_с_падением)
+    выход = tmp_path / "реестр.csv"
+    итог = batch.пакетный_анализ(str(пакет), str(выход), процессов=2, прогресс=None)
+    строки = _строки(выход)
+    assert len(строки) == итог["всего"] == 11
+    assert (итог["успешно"], итог["ошибок"]) == (9, 2)
+    assert "BrokenProcessPool" in строки["падение.txt"]["ошибка"]
+    assert all(строки[f"копия{i}.txt"]["ok"] == "True" for i in range(6))
+    assert строки["битый.docx"]["ok"] == "False" and "BrokenProcessPool" not in строки["битый.docx"]["ошибка"]
@@ -0,0 +1,16 @@
+"""Ядро без интерфейса: импорт не тянет Streamlit и тяжёлые зависимости."""
+
+import os
+import subprocess
+import sys
+
+КАТАЛОГ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_ядро_без_streamlit():
+    проверка = ("import sys, core; тяжёлые = {'streamlit', 'pandas', 'requests', 'docx', 'PyPDF2'} & set(sys.modules); "
+                "assert not тяжёлые, тяжёлые; "
+                "print(core.определить_зону(60_000, 'Типовая форма (ТФ)', '')['зона'])")
+    результат = subprocess.run([sys.executable, "-c", проверка], capture_output=True, text=True, cwd=КАТАЛОГ, timeout=60)
+    assert результат.returncode == 0, результат.stderr
+    assert результат.stdout.strip() == "зелёная"
@@ -0,0 +1,174 @@
+"""Разбор загруженных документов: буфер без копии, кодировка TXT, DOCX с таблицами, PDF с бюджетом символов."""
+
+import io
+import zipfile
+
+import pytest
+
+import bench
+import core
+
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+
+# Ёлочек «» в cp866 нет
+ДЕМО = core.ДЕМО_ДОГОВОР.replace("«", '"').replace("»", '"')
+ДЕМО_БАЙТЫ = {кодировка: ДЕМО.encode(кодировка) for кодировка in ("utf-8", "cp1251", "cp866")}
+
+
+class Поток(io.RawIOBase):
+    # Поток без fileno(), как член ZIP-архива
+    def __init__(self, данные):
+        self._f = io.BytesIO(данные)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._f.readinto(b)
+
+
+def test_буфер_загрузки_из_разных_источников(tmp_path, monkeypatch):
+    данные = ДЕМО_БАЙТЫ["cp1251"]
+    путь = tmp_path / "договор.txt"
+    путь.write_bytes(данные)
+    загрузка = io.BytesIO(данные)
+    with core.буфер_загрузки(загрузка) as буфер:
+        assert буфер.obj is загрузка.getvalue()          # без копии
+    with open(путь, "rb") as f:
+        источники = [данные, str(путь), f, Поток(данные)]
+        for источник in источники:
+            with core.буфер_загрузки(источник) as буфер:
+                assert bytes(буфер) == данные
+    # Длинный поток уходит во временный файл
+    monkeypatch.setattr(core, "ЗАГРУЗКА_В_ПАМЯТИ", 100)
+    with core.буфер_загрузки(Поток(данные)) as буфер:
+        assert type(буфер.obj).__name__ == "mmap" and bytes(буфер) == данные
+    (tmp_path / "пустой.txt").write_bytes(b"")
+    with core.буфер_загрузки(str(tmp_path / "пустой.txt")) as буфер:
+        assert bytes(буфер) == b""
+
+
+def test_кодировка_по_образцу():
+    assert core.определить_кодировку(ДЕМО_БАЙТЫ["utf-8"]) == "utf-8"
+    assert core.определить_кодировку(b"\xef\xbb\xbf" + ДЕМО_БАЙТЫ["utf-8"]) == "utf-8-sig"
+    assert core.определить_кодировку(ДЕМО_БАЙТЫ["cp1251"]) == "cp1251"
+    assert core.определить_кодировку(ДЕМО_БАЙТЫ["cp866"]) == "cp866"
+    # Образец обрезан посреди двухбайтового символа
+    assert core.определить_кодировку("договор".encode("utf-8")[:3]) == "utf-8"
+    for кодировка, данные in ДЕМО_БАЙТЫ.items():
+        assert core.декодировать_текст(memoryview(данные)) == ДЕМО
+        assert core.декодировать_текст(memoryview(данные), макс_символов=100) == ДЕМО[:100]
+
+
+def test_utf8_после_образца_с_чужими_байтами(monkeypatch):
+    # Начало в ASCII проходит как UTF-8, а дальше — cp1251: текст читается целиком в cp1251
+    monkeypatch.setattr(core, "ОБРАЗЕЦ_КОДИРОВКИ", 20)
+    текст = "Договор поставки" + " " * 20 + ДЕМО
+    данные = ("x" * 30).encode() + текст.encode("cp1251")
+    assert core.декодировать_текст(memoryview(данные)) == "x" * 30 + текст
+    assert "\ufffd" not in core.декодировать_текст(memoryview(("x" * 30).encode() + ДЕМО_БАЙТЫ["cp866"]))
+
+
+def test_разбор_загрузки_txt():
+    загрузка = io.BytesIO(ДЕМО_БАЙТЫ["cp866"])
+    загрузка.name = "ДОГОВОР.TXT"
+    итог = core.разобрать_загрузку(загрузка)
+    assert итог["ok"] and итог["текст"] == ДЕМО
+    assert итог["извлечённые"]["сумма"] == core.извлечь_все_данные(ДЕМО)["сумма"]
+
+
+def docx(тело: str) -> bytes:
+    буфер = io.BytesIO()
+    with zipfile.ZipFile(буфер, "w") as z:
+        z.writestr("word/document.xml", f'<?xml version="1.0" encoding="UTF-8"?><w:document {W}><w:body>'
+                                        f'{тело}<w:sectPr/></w:body></w:document>')
+    return буфер.getvalue()
+
+
+def абзац(*прогоны: str, свойства: str = "") -> str:
+    return f"<w:p>{свойства}" + "".join(f"<w:r>{п}</w:r>" for п in прогоны) + "</w:p>"
+
+
+def т(текст: str) -> str:
+    return f'<w:t xml:space="preserve">{текст}</w:t>'
+
+
+def таблица(*строки) -> str:
+    return "<w:tbl>" + "".join(
+        "<w:tr>" + "".join(f"<w:tc>{ячейка}</w:tc>" for ячейка in строка) + "</w:tr>" for строка in строки) + "</w:tbl>"
+
+
+def test_абзацы_и_таблицы_по_порядку():
+    содержимое = docx(
+        абзац(т("1.1. Предмет"), свойства='<w:pPr><w:tabs><w:tab w:val="left" w:pos="720"/></w:tabs></w:pPr>')
+        + таблица([абзац(т("Простой")), абзац(т("2 500 руб/сутки"))],
+                  [абзац(т("Штраф")), абзац(т("15 000")) + абзац(т("руб."))],
+                  [абзац(), абзац()])
+        + абзац(т("Цена"), "<w:tab/>", т("1 000"), "<w:br/>", т("без НДС"))
+        + абзац()
+    )
+    assert list(core.читать_docx(содержимое)) == [
+        "1.1. Предмет", "Простой | 2 500 руб/сутки", "Штраф | 15 000 руб.", "Цена\t1 000\nбез НДС"]
+
+
+def test_вложенная_таблица_в_ячейке():
+    вложенная = таблица([абзац(т("а")), абзац(т("б"))])
+    содержимое = docx(таблица([абзац(т("внешняя")), абзац(т("до")) + вложенная + абзац(т("после"))]) + абзац(т("конец")))
+    assert list(core.читать_docx(содержимое)) == ["внешняя | до а | б после", "конец"]
+
+
+def test_предел_символов():
+    содержимое = docx("".join(абзац(т(f"Пункт {i}. " + "текст " * 20)) for i in range(100)))
+    все = list(core.читать_docx(содержимое, макс_символов=None))
+    assert len(все) == 100
+    часть = list(core.читать_docx(содержимое, макс_символов=1000))
+    assert часть == все[:len(часть)] and sum(len(с) + 1 for с in часть[:-1]) < 1000 <= sum(len(с) + 1 for с in часть)
+
+
+def test_синтетический_docx_целиком():
+    содержимое = bench.синтетический_docx(60_000, строк_таблицы=3)
+    строки = list(core.читать_docx(содержимое, макс_символов=None))
+    таблиц = sum(1 for с in строки if с.startswith("Простой, тип 0 |"))
+    assert таблиц > 0 and sum(" | " in с for с in строки) == 3 * таблиц
+    assert any(с.startswith("Исполнитель:") for с in строки[-3:])   # хвост демо-договора дочитан
+    ok, текст = core.разобрать_содержимое(содержимое, "Договор.DOCX")
+    assert ok and len(текст) <= core.МАКС_СИМВОЛОВ_ДОКУМЕНТА and текст.startswith(строки[0])
+    assert core.разобрать_содержимое(docx(абзац()), "пустой.docx") == (False, "Пустой документ")
+
+
+@pytest.fixture(scope="module")
+def pdf():
+    pytest.importorskip("PyPDF2")
+    return bench.синтетический_pdf(страниц=20, строк=20)
+
+
+def test_pdf_по_страницам_с_бюджетом(pdf):
+    все = list(core.читать_pdf(pdf, макс_символов=None, процессов=1))
+    assert [с["страница"] for с in все] == list(range(1, 21))
+    assert all(с["текст"] and с["мс"] >= 0 for с in все)
+    бюджет = len(все[0]["текст"]) * 3
+    часть = list(core.читать_pdf(pdf, макс_символов=бюджет, процессов=1))
+    assert [с["текст"] for с in часть] == [с["текст"] for с in все[:len(часть)]]
+    assert 3 <= len(часть) < 20
+    assert sum(len(с["текст"]) + 1 for с in часть) >= бюджет > sum(len(с["текст"]) + 1 for с in часть[:-1])
+
+
+def test_pdf_пулом_как_последовательно(pdf):
+    последовательно = [с["текст"] for с in core.читать_pdf(pdf, макс_символов=None, процессов=1)]
+    assert [с["текст"] for с in core.читать_pdf(pdf, макс_символов=None, процессов=2)] == последовательно
+    # Бюджет исчерпан на первых страницах — выход из генератора гасит пул без ожидания остальных
+    часть = list(core.читать_pdf(pdf, макс_символов=len(последовательно[0]) + 1, процессов=2))
+    assert [с["текст"] for с in часть] == последовательно[:1]
+
+
+def test_разбор_pdf_с_замерами_страниц(pdf, monkeypatch):
+    import concurrent.futures
+
+    # По умолчанию — без пула процессов, даже для длинного документа
+    monkeypatch.setattr(core, "PDF_ПАРАЛЛЕЛЬНО_ОТ_СТРАНИЦ", 2)
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", None)
+    страницы = []
+    ok, текст = core.разобрать_содержимое(pdf, "скан.PDF", страницы=страницы)
+    assert ok and len(страницы) == 20
+    assert len(текст) == sum(с["символов"] for с in страницы) + 19
@@ -0,0 +1,119 @@
+"""Анализ длинного договора по фрагментам: нарезка по пунктам, разбор ответов, сборка отчёта."""
+
+import re
+import threading
+import time
+
+import pytest
+
+import core
+from conftest import случайный_договор
+
+КЛЮЧИ = {"openai": "k"}
+
+
+def test_фрагменты_покрывают_текст_по_пунктам(rnd):
+    for символов, макс in ((20_000, 6000), (9000, 1500), (3000, 200)):
+        текст = случайный_договор(rnd, символов, с_нарушениями=True)
+        фрагменты = core.разбить_на_фрагменты(текст, макс)
+        assert "".join(ф["текст"] for ф in фрагменты) == текст
+        assert all(0 < len(ф["текст"]) <= макс for ф in фрагменты)
+        границы = {0} | set(core.лексемы(текст).начала("граница"))
+        for предыдущий, ф in zip(фрагменты, фрагменты[1:]):
+            # Начало фрагмента — граница пункта или разрез длинного пункта по строке, в крайнем случае по длине
+            assert ф["начало"] in границы or текст[ф["начало"]] == "\n" or len(предыдущий["текст"]) == макс
+        if символов > макс:
+            assert len(фрагменты) > 1
+
+
+def test_короткий_текст_один_фрагмент():
+    фрагменты = core.разбить_на_фрагменты(core.ДЕМО_ДОГОВОР)
+    assert len(фрагменты) == 1 and фрагменты[0]["текст"] == core.ДЕМО_ДОГОВОР
+    assert фрагменты[0]["пункты"][0] == "1.1"
+
+
+def test_разбор_ответа_фрагмента():
+    ответ = ("## ЧТО ЭТО\nДоговор ТЭО.\n\n## КРИТИЧЕСКИЕ ПУНКТЫ\n- **Пункт 5.3** — без лимита\n\n"
+             "## ЗАМЕЧАНИЯ\nНет.\n\n## РЕКОМЕНДАЦИЯ\n🔄 ДОРАБОТАТЬ\n")
+    разделы = core.разобрать_ответ_фрагмента(ответ)
+    assert разделы == {"что": "Договор ТЭО.", "критические": "- **Пункт 5.3** — без лимита",
+                       "замечания": "", "рекомендация": 2}
+    # Ответ без заголовков не теряется — уходит в замечания
+    assert core.разобрать_ответ_фрагмента("просто текст")["замечания"] == "просто текст"
+
+
+def test_нарушения_по_фрагментам():
+    фрагменты = [{"текст": "1.1. Аванс\n"}, {"текст": "\n5.3. Ответственность\n"}]
+    нарушения = [{"пункт": "5.3"}, {"пункт": None}, {"пункт": "9.9"}]
+    assert core._нарушения_фрагментов(фрагменты, нарушения) == [[нарушения[1], нарушения[2]], [нарушения[0]]]
+
+
+@pytest.fixture
+def ответы(monkeypatch):
+    # Поддельный поток_ai: ответ по номеру фрагмента из промпта; None — сбой фрагмента
+    варианты = {}
+
+    def поток_ai(промпт, api_ключи=None, yandex_folder="", с_кэшем=True, отмена=None):
+        i = int(re.search(r"фрагмент (\d+) из", промпт).group(1))
+        if варианты.get(i) is None:
+            raise core.ОшибкаAI(f"сбой {i}")
+        yield варианты[i]
+
+    monkeypatch.setattr(core, "поток_ai", поток_ai)
+    return варианты
+
+
+def test_сборка_отчёта_из_фрагментов(rnd, ответы):
+    текст = случайный_договор(rnd, 12_000, с_нарушениями=True)
+    извлечённые = core.извлечь_все_данные(текст)
+    n = len(core.разбить_на_фрагменты(текст, 3000))
+    ответы.update({i: f"## КРИТИЧЕСКИЕ ПУНКТЫ\n- крит {i}\n\n## ЗАМЕЧАНИЯ\nНет.\n\n## РЕКОМЕНДАЦИЯ\n✅ СОГЛАСОВАТЬ"
+                   for i in range(1, n + 1)})
+    ответы[1] = "## ЧТО ЭТО\nДоговор.\n\n" + ответы[1]
+    ответы[2] = "## ЗАМЕЧАНИЯ\nзамечание 2\n\n## РЕКОМЕНДАЦИЯ\n❌ ОТКЛОНИТЬ"
+    ответы[3] = None
+    отчёт = "".join(core.ai_анализ_по_фрагментам(текст, извлечённые, {}, КЛЮЧИ, макс_символов=3000))
+    assert отчёт.startswith("## 1. ЧТО ЭТО\nДоговор.\n")
+    критические = re.findall(r"крит (\d+)", отчёт)
+    assert критические == [str(i) for i in range(1, n + 1) if i not in (2, 3)]
+    assert "замечание 2" in отчёт and "Фрагмент 3 из" in отчёт and "сбой 3" in отчёт
+    assert отчёт.rstrip().endswith("❌ ОТКЛОНИТЬ")
+
+
+def test_все_фрагменты_с_ошибкой(rnd, ответы):
+    текст = случайный_договор(rnd, 8000)
+    with pytest.raises(core.ОшибкаAI, match="сбой"):
+        "".join(core.ai_анализ_по_фрагментам(текст, {}, {}, КЛЮЧИ, макс_символов=3000))
+    with pytest.raises(core.ОшибкаAI, match="Не настроен"):
+        next(core.ai_анализ_по_фрагментам(текст, {}, {}, {}))
+
+
+def test_закрытие_отчёта_прерывает_идущие_запросы(rnd, monkeypatch):
+    # Первый фрагмент отвечает сразу, остальные — бесконечным потоком
+    начато, закрыто = [], []
+
+    def поток_провайдера(провайдер, ключ, промпт, yandex_folder="", **_):
+        if "фрагмент 1 из" in промпт:
+            yield "## ЧТО ЭТО\nДоговор."
+            return
+        начато.append(промпт)
+        try:
+            while True:
+                time.sleep(0.02)
+                yield "текст "
+        finally:
+            закрыто.append(промпт)
+
+    monkeypatch.setattr(core, "поток_провайдера", поток_провайдера)
+    monkeypatch.setattr(core, "планировщик_ai", lambda планировщик=core.ПланировщикAI(): планировщик)
+    текст = случайный_договор(rnd, 12_000)
+    отчёт = core.ai_анализ_по_фрагментам(текст, {}, {}, КЛЮЧИ, с_кэшем=False, параллельно=3, макс_символов=3000)
+    assert next(отчёт).startswith("## 1. ЧТО ЭТО\nДоговор.")
+    while len(начато) < 2:
+        time.sleep(0.01)
+    отчёт.close()
+    срок = time.monotonic() + 2
+    while len(закрыто) < len(начато) and time.monotonic() < срок:
+        time.sleep(0.01)
+    assert len(закрыто) == len(начато) >= 2
+    assert threading.active_count() < 20
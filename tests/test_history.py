@@ -0,0 +1,256 @@
+"""Архив: фильтры и страницы, FTS5, MinHash, сводка контрагентов на триггерах — против перебора и пересчёта по таблице анализов."""
+
+import re
+import sqlite3
+
+import pytest
+
+import core
+import history
+
+КОНТРАГЕНТЫ = [
+    ("ООО «Вектор»", "500100732259"), ("Вектор", None), ("ООО \"Вектор\"", None),
+    ("ЗАО «Ромашка»", "7701234568"), ("ЗАО «Ромашка»", None), ("", None), ("ИП Ёлкин", None),
+]
+ЗОНЫ = ["зелёная", "жёлтая", "красная", None]
+
+
+@pytest.fixture
+def архив(tmp_path):
+    return history.Архив(str(tmp_path / "архив.sqlite"))
+
+
+def _запись(rnd, пользователь=""):
+    контрагент, инн = rnd.choice(КОНТРАГЕНТЫ)
+    return {
+        # Часть записей — повторные анализы одних и тех же договоров
+        "хеш": rnd.choice(["д1", "д2", "д3", f"{rnd.random()}"]), "пользователь": пользователь,
+        "контрагент": контрагент, "контрагент_норм": history.нормализовать_контрагента(контрагент), "инн": инн,
+        "сумма": rnd.choice([None, 0, rnd.randrange(1, 10**7)]), "зона": rnd.choice(ЗОНЫ),
+        "красных": rnd.choice([None, 0, 1, 3]), "жёлтых": rnd.choice([None, 0, 2]),
+    }
+
+
+def test_нормализация_контрагента():
+    assert {history.нормализовать_контрагента(к) for к, _ in КОНТРАГЕНТЫ[:3]} == {"вектор"}
+    assert history.нормализовать_контрагента("ИП Ёлкин") == "елкин"
+    assert history.нормализовать_контрагента(None) == ""
+
+
+def test_запись_анализа_и_результат(архив):
+    текст = core.ДЕМО_ДОГОВОР
+    извлечённые = core.извлечь_все_данные(текст)
+    зона = core.определить_зону(извлечённые["сумма"], "Типовая форма (ТФ)", "")
+    rag = core.анализ_rag(текст, "услуги_тэо")
+    id_ = архив.записать(history.запись_анализа(текст, извлечённые, "иванов", зона=зона, rag=rag, ai="вывод"))
+    запись = архив.получить(id_)
+    assert (запись["пользователь"], запись["зона"], запись["красных"]) == ("иванов", зона["зона"], rag["красных"])
+    assert запись["результат"]["ai"] == "вывод"
+    assert запись["результат"]["извлечённые"]["дата"] == извлечённые["дата"].isoformat()
+    # Повторный анализ того же договора обновляет запись, а не добавляет новую
+    assert архив.записать({"вердикт": "ЧАСТИЧНО"}, id_) == id_
+    assert архив.получить(id_)["вердикт"] == "ЧАСТИЧНО" and архив.количество() == 1
+    assert архив.получить(id_ + 1) is None
+
+
+def test_период_и_страницы(архив, rnd, monkeypatch):
+    # Часы иногда переводятся назад, а записать_много получает чужое «создан»: создан не убывает вместе с id
+    часы = [1_000.0]
+
+    def время():
+        часы[0] += rnd.choice([0, 1, 5, -30])
+        return часы[0]
+
+    monkeypatch.setattr(history.time, "time", время)
+    for _ in range(120):
+        if rnd.random() < 0.8:
+            архив.записать(_запись(rnd, пользователь=rnd.choice("аб")))
+        else:
+            архив.записать_много([{**_запись(rnd), "создан": 0} for _ in range(3)])
+    with sqlite3.connect(архив.путь) as бд:
+        строки = бд.execute("SELECT id, создан, пользователь, контрагент_норм, зона FROM анализы ORDER BY id").fetchall()
+    assert all(a[1] <= b[1] for a, b in zip(строки, строки[1:]))
+    for _ in range(50):
+        с, по = sorted(rnd.uniform(900, часы[0] + 10) for _ in range(2))
+        фильтры = {"с": с, "по": по, "пользователь": rnd.choice([None, "а"]),
+                   "контрагент": rnd.choice(["", "вект", "ООО Ромашка"]), "зона": rnd.choice(["", "красная"])}
+        префикс = history.нормализовать_контрагента(фильтры["контрагент"])
+        ожидается = [с_[0] for с_ in строки if с <= с_[1] < по and фильтры["пользователь"] in (None, с_[2])
+                     and с_[3].startswith(префикс) and фильтры["зона"] in ("", с_[4])]
+        assert архив.количество(**фильтры) == len(ожидается)
+        получено, после = [], None
+        while True:
+            стр = архив.страница(после, размер=7, **фильтры)
+            получено += [з["id"] for з in стр["строки"]]
+            после = стр["следующий"]
+            if после is None:
+                break
+        assert получено == ожидается[::-1]
+
+
+def test_удаление_по_пользователю(архив, rnd):
+    архив.записать_много([_запись(rnd, пользователь=п) for п in "аабв"])
+    assert архив.удалить("а") == 2
+    assert архив.количество(пользователь="а") == 0 and архив.количество() == 2
+    assert архив.удалить() == 2
+
+
+@pytest.mark.parametrize("порядок", list(history.ПОРЯДКИ_АРХИВА))
+def test_порядок_страниц(архив, rnd, порядок):
+    записи = [_запись(rnd) for _ in range(60)]
+    for i, запись in enumerate(записи):
+        # Равные значения разрешаются по id
+        запись["сумма"] = 500 if i % 3 == 0 else запись["сумма"] or 0
+    архив.записать_много(записи)
+    поле, убывание = history.ПОРЯДКИ_АРХИВА[порядок]
+    with sqlite3.connect(архив.путь) as бд:
+        строки = бд.execute(f"SELECT {поле}, id FROM анализы").fetchall()
+    ожидается = [id_ for _, id_ in sorted(строки, reverse=убывание)]
+    получено, после = [], None
+    while True:
+        стр = архив.страница(после, размер=9, порядок=порядок)
+        получено += [з["id"] for з in стр["строки"]]
+        после = стр["следующий"]
+        if после is None:
+            break
+    assert получено == ожидается
+
+
+def _сводка(архив):
+    with sqlite3.connect(архив.путь) as бд:
+        return {строка[0]: строка[1:] for строка in бд.execute(
+            "SELECT ключ, договоров, сумма, красных_зон, жёлтых_зон, нарушений_красных, нарушений_жёлтых "
+            "FROM контрагенты")}
+
+
+def _пересчёт(архив):
+    # Эталон — группировка по ключ_контрагента последних анализов каждого договора (пары ключ, хеш)
+    последние = {}
+    with sqlite3.connect(архив.путь) as бд:
+        for инн, контрагент, хеш, сумма, зона, красных, жёлтых in бд.execute(
+                "SELECT инн, контрагент, хеш, сумма, зона, красных, жёлтых FROM анализы ORDER BY id"):
+            ключ = history.ключ_контрагента(инн, контрагент)
+            if ключ is not None:
+                последние[ключ, хеш] = (1, сумма or 0, зона == "красная", зона == "жёлтая", красных or 0, жёлтых or 0)
+    сводка = {}
+    for (ключ, _), вклад in последние.items():
+        было = сводка.get(ключ, (0, 0, 0, 0, 0, 0))
+        сводка[ключ] = tuple(a + b for a, b in zip(было, вклад))
+    return сводка
+
+
+def test_сводка_контрагентов_как_пересчёт(архив, rnd):
+    ids = []
+    for шаг in range(300):
+        действие = rnd.random()
+        if действие < 0.55 or not ids:
+            ids.append(архив.записать(_запись(rnd, пользователь=rnd.choice("аб"))))
+        elif действие < 0.9:
+            # Повторный анализ: меняются контрагент, сумма, зона — или только сопутствующие поля
+            запись = _запись(rnd) if rnd.random() < 0.7 else {"хеш": "повтор", "вердикт": "ЧАСТИЧНО"}
+            архив.записать(запись, rnd.choice(ids))
+        elif действие < 0.95:
+            архив.записать_много([_запись(rnd) for _ in range(rnd.randrange(1, 5))])
+        else:
+            архив.удалить(rnd.choice("аб"))
+        if шаг % 25 == 0:
+            assert _сводка(архив) == pytest.approx(_пересчёт(архив))
+    assert _сводка(архив) == pytest.approx(_пересчёт(архив))
+    # Карточка зоны: ИНН важнее имени, без ИНН — нормализованное имя
+    for контрагент, инн in КОНТРАГЕНТЫ:
+        ключ = history.ключ_контрагента(инн, контрагент)
+        карточка = архив.контрагент(инн, контрагент)
+        assert (карточка and карточка["договоров"]) == (ключ and _пересчёт(архив).get(ключ, (None,))[0])
+    архив.удалить()
+    assert _сводка(архив) == {}
+
+
+def test_повторный_анализ_договора_учитывается_один_раз(архив):
+    запись = {"хеш": "д", "контрагент": "ООО «Вектор»", "контрагент_норм": "вектор", "инн": "500100732259",
+              "сумма": 100, "зона": "жёлтая", "красных": 1}
+    первый = архив.записать(запись)
+    архив.записать({**запись, "сумма": 300, "зона": "красная"})
+    карточка = архив.контрагент("500100732259", None)
+    assert (карточка["договоров"], карточка["сумма"], карточка["красных_зон"], карточка["жёлтых_зон"]) == (1, 300, 1, 0)
+    архив.записать({**запись, "хеш": "другой"}, первый)
+    карточка = архив.контрагент("500100732259", None)
+    assert (карточка["договоров"], карточка["сумма"]) == (2, 400)
+
+
+def test_поиск_по_текстам(архив):
+    первый = архив.записать({"хеш": "1", "контрагент": "ООО «ТрансЛогистик»", "текст":
+                              "5.2. Молчание Заказчика означает согласие с актом. Штраф 15 000 рублей.",
+                              "нарушения": "5.2 молчание_согласие"})
+    второй = архив.записать({"хеш": "2", "контрагент": "АО «Ёлка»", "текст": "Поставка ёлочных игрушек.",
+                              "пользователь": "петров"})
+    найдено = lambda запрос: {з["id"] for з in архив.найти(запрос)}
+    assert найдено('"молчание заказчика означает"') == {первый}
+    assert найдено("молчания трансЛОГИСТИК") == {первый}
+    assert найдено("елка") == {второй}
+    assert найдено("поставки") == {второй}
+    assert найдено('"согласие молчание"') == set()
+    assert "**" in архив.найти("штраф")[0]["фрагмент"]
+    assert архив.найти("поставки", пользователь="иванов") == []
+    # Удаление по пользователю чистит и индекс
+    архив.удалить("петров")
+    assert найдено("поставки") == set()
+    # Новая редакция текста вытесняет прежнюю из индекса
+    архив.записать({"хеш": "1", "текст": "Оплата по факту."}, первый)
+    assert найдено("молчание") == set()
+    assert найдено("оплата") == {первый}
+    архив.удалить()
+    assert найдено("оплата") == set()
+
+
+def _жаккар(a, b):
+    шинглы = lambda т: {tuple(с[i:i + history.ШИНГЛ_СЛОВ]) for с in [re.findall(r"\w+", т.lower())]
+                        for i in range(len(с) - history.ШИНГЛ_СЛОВ + 1)}
+    a, b = шинглы(a), шинглы(b)
+    return len(a & b) / len(a | b)
+
+
+def test_похожие_договоры(архив, rnd):
+    from conftest import случайный_договор
+
+    тексты = [случайный_договор(rnd, 6000) for _ in range(20)]
+    ids = [архив.записать({"хеш": str(i), "текст": т}) for i, т in enumerate(тексты)]
+    исходный = тексты[3]
+    правка = исходный.replace("2025", "2026", 1) + "\nСумма: 1 250 000 руб."
+    assert _жаккар(исходный, правка) > 0.9
+    похожие = архив.похожие(правка)
+    assert [з["id"] for з in похожие] == [ids[3]]
+    assert abs(похожие[0]["сходство"] - _жаккар(исходный, правка)) < 0.1
+    assert архив.похожие(исходный)[0]["сходство"] == 1.0
+    assert архив.похожие("Совсем другой документ о поставке ёлочных игрушек и гирлянд") == []
+    # Пользователь видит только свои прежние анализы
+    свой = архив.записать({"хеш": "свой", "текст": исходный, "пользователь": "а"})
+    assert [з["id"] for з in архив.похожие(правка, пользователь="а")] == [свой]
+    assert архив.похожие(правка, пользователь="б") == []
+    for i in (0, 1, 2):
+        оценка = history.сходство_подписей(history.подпись_minhash(тексты[i]), history.подпись_minhash(тексты[i + 1]))
+        assert abs(оценка - _жаккар(тексты[i], тексты[i + 1])) < 0.15
+
+
+def test_симулятор_по_архиву(архив, rnd):
+    assert архив.сделки().empty and core.СимуляторПорогов(архив.сделки()).сравнить(None, None)["сделок"] == 0
+    формы = ["Типовая форма (ТФ)", "Нетиповая форма"]
+    типы = ["", core.КРАСНАЯ_ЗОНА[0], core.ЖЁЛТАЯ_ЗОНА[0]]
+    ids = []
+    for _ in range(60):
+        запись = {**_запись(rnd), "форма": rnd.choice(формы), "тип_сделки": rnd.choice(типы)}
+        запись["сумма"] = запись["сумма"] or 0
+        запись["зона"] = core.определить_зону(запись["сумма"], запись["форма"], запись["тип_сделки"])["зона"]
+        ids.append(архив.записать(запись))
+    архив.записать({"хеш": "без зоны", "сумма": 10**9})
+    версия = архив.версия()
+    # Повторный анализ меняет сумму уже сохранённой сделки — версия архива другая
+    архив.записать({"сумма": 10**8}, ids[0])
+    assert архив.версия() != версия
+    with sqlite3.connect(архив.путь) as бд:
+        последние = бд.execute("SELECT сумма, форма, тип_сделки FROM анализы WHERE id IN "
+                               "(SELECT MAX(id) FROM анализы WHERE зона IS NOT NULL GROUP BY хеш)").fetchall()
+    новые = {"зелёная_тф_макс": 500_000, "зелёная_нетф_макс": 10_000, "жёлтая_макс": 1_000_000}
+    итог = core.СимуляторПорогов(архив.сделки()).сравнить(None, новые)
+    assert итог["сделок"] == len(последние) < 61
+    станет = [core.определить_зону(с, ф, т, новые)["зона"] for с, ф, т in последние]
+    assert итог["станет"] == {з: станет.count(з) for з in core.ЗОНЫ}
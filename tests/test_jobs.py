@@ -0,0 +1,93 @@
+"""Фоновые AI-задачи: частичный текст, место в очереди, отмена, ошибки, подчистка."""
+
+import threading
+import time
+
+import core
+
+
+def ждать(очередь, id_, статусы=core.ЗАВЕРШЁННЫЕ_СТАТУСЫ, таймаут=5.0):
+    срок = time.monotonic() + таймаут
+    while time.monotonic() < срок:
+        статус = очередь.статус(id_)
+        if статус["статус"] in статусы:
+            return статус
+        time.sleep(0.01)
+    raise AssertionError(f"задача {id_}: {очередь.статус(id_)}")
+
+
+def по_сигналу(сигналы, куски, выполнено=None):
+    # Генератор-задача: каждый следующий кусок — после очередного сигнала
+    for кусок in куски:
+        сигналы.get()
+        yield кусок
+    if выполнено is not None:
+        выполнено.set()
+
+
+def test_частичный_текст_и_готово():
+    import queue
+    очередь = core.ОчередьЗадачAI(потоков=1)
+    сигналы = queue.Queue()
+    id_ = очередь.отправить(по_сигналу, сигналы, ["## 1. ", "ЧТО ЭТО"], название="д", владелец="иванов")
+    сигналы.put(1)
+    ждать(очередь, id_, ("выполняется",))
+    срок = time.monotonic() + 5
+    while очередь.статус(id_)["текст"] != "## 1. " and time.monotonic() < срок:
+        time.sleep(0.01)
+    assert очередь.статус(id_)["текст"] == "## 1. "
+    сигналы.put(1)
+    статус = ждать(очередь, id_)
+    assert (статус["статус"], статус["текст"]) == ("готово", "## 1. ЧТО ЭТО")
+    assert статус["начата"] <= статус["завершена"]
+    assert [з["id"] for з in очередь.задачи("иванов")] == [id_]
+    assert очередь.задачи("петров") == []
+
+
+def test_место_в_очереди_и_отмена():
+    import queue
+    очередь = core.ОчередьЗадачAI(потоков=1)
+    сигналы = queue.Queue()
+    выполнено = threading.Event()
+    первая = очередь.отправить(по_сигналу, сигналы, ["а", "б"])
+    вторая = очередь.отправить(по_сигналу, queue.Queue(), ["x"], выполнено=выполнено)
+    третья = очередь.отправить(lambda: iter(["в"]))
+    ждать(очередь, первая, ("выполняется",))
+    assert (очередь.статус(вторая)["место"], очередь.статус(третья)["место"]) == (1, 2)
+
+    очередь.отменить(вторая)
+    assert очередь.статус(вторая)["статус"] == "отменена"
+    assert очередь.статус(третья)["место"] == 1
+    сигналы.put(1)
+    очередь.отменить(первая)                   # выполняющаяся: остановится на следующем куске
+    сигналы.put(1)
+    assert ждать(очередь, третья)["текст"] == "в"
+    assert очередь.статус(первая)["статус"] == "отменена"
+    assert not выполнено.is_set()
+    очередь.отменить(третья)                   # завершённую отменить уже нельзя
+    assert очередь.статус(третья)["статус"] == "готово"
+
+
+def test_ошибка_задачи():
+    def сбой():
+        yield "начало"
+        raise core.ОшибкаAI("HTTP 500")
+
+    очередь = core.ОчередьЗадачAI(потоков=1)
+    статус = ждать(очередь, очередь.отправить(сбой))
+    assert (статус["статус"], статус["ошибка"], статус["текст"]) == ("ошибка", "HTTP 500", "начало")
+
+
+def test_подчистка_завершённых(monkeypatch):
+    monkeypatch.setattr(core, "ЗАДАЧ_AI_ХРАНИТЬ", 2)
+    очередь = core.ОчередьЗадачAI(потоков=1)
+    ids = []
+    for i in range(4):
+        ids.append(очередь.отправить(lambda i=i: iter([str(i)])))
+        ждать(очередь, ids[-1])
+    # Подчистка — при отправке: из трёх завершённых к моменту четвёртой остаются две последние
+    assert [з["id"] for з in очередь.задачи()] == ids[:0:-1]
+    assert очередь.статус(ids[0]) is None
+    monkeypatch.setattr(core, "ЗАДАЧ_AI_TTL_С", -1)
+    очередь.отправить(lambda: iter([]))
+    assert len(очередь.задачи()) == 1
@@ -0,0 +1,116 @@
+"""Лексер: разметка одним проходом против прежних экстракторов на отдельных выражениях."""
+
+import re
+from datetime import date
+
+import core
+from conftest import СТРОКИ, случайный_договор
+
+# Прежние экстракторы (до лексера) — эталон
+_ДАТА_ПРОПИСЬЮ = re.compile(r'«?(\d{1,2})»?\s*([а-яё]+)\s*(\d{4})')   # по тексту в нижнем регистре
+_ДАТА_ЦИФРАМИ = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+_СУММА = re.compile(r'(\d[\d\s]*\d)\s*(?:\([^)]+\))?\s*руб')             # по тексту в нижнем регистре
+_ЮРЛИЦО = re.compile(r'((?:ООО|ОАО|ЗАО|ПАО|АО)\s*[«"]([^»"]+)[»"])')
+_ИНН = re.compile(r'ИНН\s*:?\s*(\d{12}|\d{10})(?!\d)')
+_МЕСЯЦЫ = {'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5, 'июня': 6,
+           'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12}
+
+
+def _эталон_даты(текст):
+    m = _ДАТА_ПРОПИСЬЮ.search(текст.lower())
+    if m:
+        try:
+            return date(int(m.group(3)), _МЕСЯЦЫ.get(m.group(2), 1), int(m.group(1)))
+        except ValueError:
+            pass
+    m = _ДАТА_ЦИФРАМИ.search(текст)
+    if m:
+        try:
+            return date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+        except ValueError:
+            pass
+    return None
+
+
+def _эталон_данных(текст):
+    номер = re.search(r'№\s*([A-Za-zА-Яа-я0-9\-/]+)', текст[:500])
+    сумма = _СУММА.search(текст.lower())
+    контрагент = next((m.group(1) for m in _ЮРЛИЦО.finditer(текст)
+                       if 'СПК' not in m.group(2).upper() and 'СТАРАЯ' not in m.group(2).upper()), None)
+    инн = None
+    начало = текст.find(контрагент) if контрагент else -1
+    while начало >= 0 and инн is None:
+        после = начало + len(контрагент)
+        следующее = re.search(r'(?:ООО|ОАО|ЗАО|ПАО|АО)\s*[«"]', текст[после:после + 300])
+        m = _ИНН.search(текст, после, после + (следующее.start() if следующее else 300))
+        инн = m.group(1) if m else None
+        начало = текст.find(контрагент, после)
+    return {
+        "тип_док": core.определить_тип_документа(текст),
+        "дата": _эталон_даты(текст),
+        "номер": номер.group(1).strip() if номер and len(номер.group(1).strip()) >= 3 else None,
+        "сумма": float(re.sub(r'\s', '', сумма.group(1))) if сумма else None,
+        "контрагент": контрагент,
+        "инн": инн,
+    }
+
+
+def test_реквизиты_как_прежние_экстракторы(rnd):
+    тексты = [core.ДЕМО_ДОГОВОР, ""] + list(СТРОКИ) + [
+        случайный_договор(rnd, rnd.choice([600, 3000, 20000]), с_нарушениями=rnd.random() < 0.5) for _ in range(150)]
+    for текст in тексты:
+        assert core.извлечь_все_данные(текст) == _эталон_данных(текст), текст[:200]
+
+
+def test_лексемы_вида_как_finditer(rnd):
+    for _ in range(40):
+        текст = случайный_договор(rnd, 5000)
+        лекс = core.Лексемы(текст)
+        for вид, паттерн in core.ЛЕКСЕМЫ.items():
+            regex = re.compile(паттерн)
+            assert [m.span() for m in лекс.совпадения(вид)] == [m.span() for m in regex.finditer(текст)], вид
+
+
+def test_ленивая_разметка_по_частям(rnd):
+    текст = случайный_договор(rnd, 20000)
+    эталон = [m.start() for m in re.finditer(core.ЛЕКСЕМЫ["граница"], текст)]
+    лекс = core.Лексемы(текст)
+    # Запросы вразнобой не теряют и не дублируют лексемы
+    for от, до in ((5000, 6000), (0, 100), (15000, None), (2000, 12000)):
+        assert лекс.начала("граница", от, до) == [p for p in эталон if p >= от and (до is None or p < до)]
+    assert лекс.начала("граница") == эталон
+
+
+def _пункт(текст, позиция):
+    match = re.compile(".", re.DOTALL).match(текст, позиция)
+    правило = {"название": "т", "эталон": "", "критичность": "жёлтый"}
+    return core._нарушение(правило, текст, match)["пункт"]
+
+
+def test_номер_пункта_нарушения(rnd):
+    for _ in range(20):
+        текст = случайный_договор(rnd, 3000)
+        for позиция in rnd.sample(range(len(текст)), 50):
+            прежний = re.search(r'(\d+\.\d+)', текст[max(0, позиция - 100):позиция])
+            assert _пункт(текст, позиция) == (прежний.group(1) if прежний else None)
+
+
+def test_номер_пункта_как_раньше():
+    # Первое «число.число» в 100 символах перед нарушением, даже если это не номер пункта
+    текст = "срок 1.02 мес.\n2.3. Неустойка"
+    assert _пункт(текст, текст.index("Неустойка")) == "1.02"
+    текст = "от 10.02.2025 г. Неустойка"
+    assert _пункт(текст, текст.index("Неустойка")) == "10.02"
+    текст = "x" * 150 + "4.1. " + "y" * 120 + "Неустойка"
+    assert _пункт(текст, текст.index("Неустойка")) is None
+
+
+def test_метки_фрагментов(rnd):
+    for _ in range(10):
+        текст = случайный_договор(rnd, 30000)
+        фрагменты = core.разбить_на_фрагменты(текст, 4000)
+        assert "".join(ф["текст"] for ф in фрагменты) == текст
+        for ф in фрагменты:
+            номера = re.findall(r'\d+\.\d+', ф["текст"])
+            assert ф["пункты"] == ((номера[0], номера[-1]) if номера else None)
+            assert текст.startswith(ф["текст"], ф["начало"])
@@ -0,0 +1,142 @@
+"""Ограничитель AI: пополнение маркерных вёдер, предел одновременных запросов, очередь, отмена."""
+
+import threading
+import time
+
+import pytest
+
+import core
+
+
+def test_ведро_как_непрерывное_пополнение(rnd):
+    # Эталон: уровень растёт на скорость × прошедшее время и не выше ёмкости
+    ведро = core._Ведро(120)
+    сейчас = ведро.время
+    уровень = 120.0
+    for _ in range(500):
+        шаг = rnd.choice([0, 0.01, 0.3, 1, 5, 120])
+        сейчас += шаг
+        уровень = min(120.0, уровень + шаг * 2)
+        n = rnd.choice([1, 7, 60, 119, 500])
+        assert ведро.ждать(n, сейчас) == pytest.approx(max(0.0, (min(n, 120) - уровень) / 2))
+        assert ведро.ждать(n, сейчас, по_ёмкости=False) == pytest.approx(max(0.0, (n - уровень) / 2))
+        if rnd.random() < 0.5:
+            ведро.взять(n)
+            уровень -= min(n, 120)
+
+
+def test_ведро_полное_пополнение():
+    ведро = core._Ведро(60)
+    t = ведро.время
+    ведро.взять(60)
+    assert ведро.ждать(1, t) == pytest.approx(1.0)
+    assert ведро.ждать(1, t + 0.25) == pytest.approx(0.75)
+    assert ведро.ждать(30, t + 10) == pytest.approx(20.0)
+    # Сколько бы ни прошло времени, ведро не полнее ёмкости
+    assert ведро.ждать(60, t + 3600) == 0.0
+    assert ведро.ждать(61, t + 3600, по_ёмкости=False) == pytest.approx(1.0)
+
+
+def test_ожидание_токенов():
+    огр = core.ОграничительAI({"x": {"запросов_мин": 6000, "токенов_мин": 6000, "одновременно": 4}})
+    assert огр.занять("x", 6000) < 0.05
+    огр.освободить("x")
+    # Ведро пусто, 100 токенов/с: 20 токенов — через ≈0.2 с
+    assert 0.1 < огр.оценка_ожидания("x", 20)["ожидание_с"] <= 0.2
+    ожидание = огр.занять("x", 20)
+    огр.освободить("x")
+    assert 0.1 < ожидание < 1.0
+    состояние = огр.состояние()["x"]
+    assert (состояние["запросов"], состояние["задержано"], состояние["выполняется"]) == (2, 1, 0)
+
+
+def test_одновременно_и_очередь(monkeypatch):
+    monkeypatch.setattr(core, "AI_ОЧЕРЕДЬ_МАКС", 1)
+    огр = core.ОграничительAI({"x": {"запросов_мин": 10**6, "токенов_мин": 10**6, "одновременно": 1}})
+    огр.занять("x", 1)
+    занял = threading.Event()
+    поток = threading.Thread(target=lambda: (огр.занять("x", 1), занял.set()))
+    поток.start()
+    while огр.состояние()["x"]["в_очереди"] == 0:
+        time.sleep(0.01)
+    assert огр.оценка_ожидания("x", 1)["место"] == 2
+    with pytest.raises(core.ОшибкаAI):
+        огр.занять("x", 1)
+    assert not занял.wait(0.3)
+    огр.освободить("x")
+    assert занял.wait(2)
+    поток.join()
+    assert огр.состояние()["x"]["отказов"] == 1
+
+
+def test_отмена_таймаут_и_пауза():
+    огр = core.ОграничительAI({"x": {"запросов_мин": 60, "токенов_мин": 60, "одновременно": 1}})
+    огр.занять("x", 60)
+    отмена = threading.Event()
+    threading.Timer(0.1, отмена.set).start()
+    начало = time.monotonic()
+    with pytest.raises(core.ОшибкаAI, match="Отменено"):
+        огр.занять("x", 1, отмена=отмена)
+    assert time.monotonic() - начало < 1
+    with pytest.raises(core.ОшибкаAI, match="время ожидания"):
+        огр.занять("x", 1, таймаут=0.2)
+    assert огр.состояние()["x"]["в_очереди"] == 0
+    огр.освободить("x")
+    огр.пауза("x", 30)
+    assert огр.оценка_ожидания("x", 1)["ожидание_с"] > 29
+
+
+def test_экспорт_метрик_слушает_localhost(monkeypatch):
+    import urllib.request
+
+    monkeypatch.setattr(core, "_ЭКСПОРТ_МЕТРИК", None)
+    сервер = core.запустить_экспорт_метрик(0)
+    try:
+        хост, порт = сервер.server_address[:2]
+        assert хост == "127.0.0.1"
+        assert core.запустить_экспорт_метрик(0) is сервер
+        with urllib.request.urlopen(f"http://127.0.0.1:{порт}/metrics", timeout=5) as ответ:
+            assert ответ.status == 200
+            assert ответ.headers["Content-Type"].startswith("text/plain")
+    finally:
+        сервер.shutdown()
+        сервер.server_close()
+
+
+def test_отмена_сразу_освобождает_место(monkeypatch):
+    # Заглушка шлёт куски раз в 2 с: место в ограничителе должно освободиться раньше следующего куска
+    import ai_stub
+
+    сервер = ai_stub.запустить(пауза=2.0)
+    monkeypatch.setenv("SVETOFOR_AI_URL", сервер.адрес)
+    огр = core.ОграничительAI({"openai": {"запросов_мин": 10**6, "токенов_мин": 10**9, "одновременно": 1}})
+    monkeypatch.setattr(core, "ограничитель_ai", lambda: огр)
+    отмена = core.Отмена()
+    первый = threading.Event()
+
+    def читать():
+        for _ in core.поток_провайдера("openai", "k", "Промпт", отмена=отмена):
+            первый.set()
+
+    поток = threading.Thread(target=_молча, args=(читать,), daemon=True)
+    поток.start()
+    try:
+        assert первый.wait(5)
+        assert огр.состояние()["openai"]["выполняется"] == 1
+        начало = time.monotonic()
+        отмена.set()
+        assert огр.состояние()["openai"]["выполняется"] == 0
+        assert time.monotonic() - начало < 0.5
+        поток.join(1.5)
+        assert not поток.is_alive()
+        assert core.метрики_ai()[-1]["ошибка"] == "Прервано"
+    finally:
+        сервер.shutdown()
+        сервер.server_close()
+
+
+def _молча(функция):
+    try:
+        функция()
+    except Exception:
+        pass
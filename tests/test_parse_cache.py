@@ -0,0 +1,78 @@
+"""Кэш разбора загрузок: попадания, вытеснение LRU, предел по объёму текста."""
+
+import io
+
+import pytest
+
+import core
+
+
+class Загрузка(io.BytesIO):
+    # Как UploadedFile Streamlit: BytesIO с именем файла
+    def __init__(self, данные: bytes, name: str):
+        super().__init__(данные)
+        self.name = name
+
+
+@pytest.fixture
+def кэш(monkeypatch):
+    кэш = core.КэшРазбора(макс_символов=100_000, макс_записей=3)
+    monkeypatch.setattr(core, "кэш_разбора", lambda: кэш)
+    return кэш
+
+
+def _запись(символов):
+    return {"ok": True, "текст": "я" * символов, "извлечённые": None}
+
+
+def test_вытеснение_по_числу_записей():
+    кэш = core.КэшРазбора(макс_символов=1000, макс_записей=2)
+    кэш.положить("a", _запись(1))
+    кэш.положить("b", _запись(1))
+    assert кэш.получить("a") is not None      # a теперь свежее b
+    кэш.положить("c", _запись(1))
+    assert list(кэш.записи) == ["a", "c"]
+    assert кэш.статистика()["вытеснено"] == 1
+
+
+def test_предел_по_объёму_текста():
+    кэш = core.КэшРазбора(макс_символов=10, макс_записей=100)
+    кэш.положить("a", _запись(4))
+    кэш.положить("b", _запись(4))
+    кэш.положить("a", _запись(5))             # замена не считается дважды
+    assert кэш.размер == 9
+    кэш.положить("c", _запись(4))
+    assert list(кэш.записи) == ["a", "c"] and кэш.размер == 9
+    кэш.положить("d", _запись(11))            # больше всего кэша — не кладётся и ничего не вытесняет
+    assert list(кэш.записи) == ["a", "c"]
+    assert кэш.размер == sum(размер for _, размер in кэш.записи.values())
+
+
+def test_статистика_попаданий():
+    кэш = core.КэшРазбора()
+    assert кэш.получить("нет") is None
+    кэш.положить("a", _запись(3))
+    кэш.получить("a")
+    кэш.получить("a")
+    статистика = кэш.статистика()
+    assert (статистика["попаданий"], статистика["промахов"], статистика["записей"], статистика["символов"]) == (2, 1, 1, 3)
+    assert статистика["доля_попаданий"] == pytest.approx(2 / 3)
+
+
+def test_повторная_загрузка_не_разбирается(кэш, monkeypatch):
+    разборов = []
+    разобрать = core.разобрать_содержимое
+    monkeypatch.setattr(core, "разобрать_содержимое", lambda *a, **k: разборов.append(a[1]) or разобрать(*a, **k))
+    данные = core.ДЕМО_ДОГОВОР.encode("cp1251")
+    первая = core.разобрать_загрузку(Загрузка(данные, "договор.TXT"))
+    вторая = core.разобрать_загрузку(Загрузка(данные, "копия.txt"))
+    assert разборов == ["договор.TXT"]
+    assert вторая is первая
+    assert первая["ok"] and первая["текст"] == core.ДЕМО_ДОГОВОР
+    assert первая["извлечённые"] == core.извлечь_все_данные(core.ДЕМО_ДОГОВОР)
+    assert первая["память"]["файл_мб"] == round(len(данные) / 2**20, 1)
+    assert первая["память"]["прирост_мб"] is None or первая["память"]["прирост_мб"] >= 0
+    core.разобрать_загрузку(Загрузка(данные + b" ", "договор.txt"))
+    assert len(разборов) == 2
+    assert кэш.статистика()["попаданий"] == 1
+
@@ -0,0 +1,72 @@
+"""Промпт AI-экспертизы в бюджете токенов: выбор пунктов, порядок нарушений, оценка стоимости."""
+
+import pytest
+
+import bench
+import core
+
+
+@pytest.fixture(scope="module")
+def длинный():
+    текст = bench.синтетический_договор(300_000, seed=3)
+    извлечённые = core.извлечь_все_данные(текст)
+    rag = core.анализ_rag(текст, "услуги_тэо")
+    return текст, извлечённые, rag
+
+
+def test_цена_провайдера():
+    assert core.цена_провайдера("openai") == pytest.approx((0.15e-6, "$"))
+    assert core.цена_провайдера("yandexgpt") == pytest.approx((1.2e-3, "₽"))
+    assert core.цена_провайдера("gigachat") == (0.0, "")
+
+
+def test_промпт_в_бюджете_с_пунктами_нарушений(длинный):
+    текст, извлечённые, rag = длинный
+    assert rag["нарушения"]
+    for бюджет in (1200, core.AI_БЮДЖЕТ_ТОКЕНОВ):
+        промпт = core.построить_промпт(текст, извлечённые, rag, бюджет_токенов=бюджет)
+        assert core.оценить_токены(промпт) <= бюджет
+        assert "[…]" in промпт and текст[:200] in промпт
+    for н in rag["нарушения"]:
+        if н["пункт"]:
+            assert f"\n{н['пункт']}." in промпт, н["название"]
+
+
+def test_выборка_из_кусков_текста(длинный):
+    текст, _, rag = длинный
+    правила = core.набор_правил().формы["услуги_тэо"]["правила"]
+    выборка, сведения = core.выбрать_пункты(текст, rag, 5000, правила)
+    assert not сведения["целиком"] and 1 < сведения["выбрано"] < сведения["пунктов"]
+    assert len(выборка) <= 5000
+    куски = выборка.split("\n[…]")
+    позиция = 0
+    for кусок in куски:
+        # Куски идут в порядке текста и взяты из него дословно
+        позиция = текст.index(кусок, позиция)
+
+
+def test_короткий_договор_целиком():
+    извлечённые = core.извлечь_все_данные(core.ДЕМО_ДОГОВОР)
+    промпт = core.построить_промпт(core.ДЕМО_ДОГОВОР, извлечённые, {})
+    assert core.ДЕМО_ДОГОВОР in промпт and "[…]" not in промпт
+
+
+def test_красные_нарушения_первыми():
+    нарушения = [{"критичность": "жёлтый", "эталон": f"ж{i}"} for i in range(8)] + [
+        {"критичность": "красный", "эталон": "к", "пункт": "5.3"}]
+    строки = core._нарушения_для_промпта(нарушения).strip().splitlines()
+    assert строки[0] == "1. 🔴 [п.5.3] к"
+    assert sum("🟡" in с for с in строки) == 7
+
+
+def test_оценка_анализа(длинный):
+    текст, извлечённые, rag = длинный
+    оценка = core.оценка_анализа(текст, извлечённые, rag, провайдеры=["openai", "yandexgpt"])
+    промпт = core.построить_промпт(текст, извлечённые, rag)
+    assert оценка["openai"]["запросов"] == 1
+    assert оценка["openai"]["токенов"] == core.оценить_токены(промпт)
+    assert оценка["yandexgpt"]["валюта"] == "₽"
+    assert оценка["openai"]["стоимость"] < оценка["openai"]["стоимость_макс"]
+    целиком = core.оценка_анализа(текст, извлечённые, rag, провайдеры=["openai"], целиком=True)
+    assert целиком["openai"]["запросов"] == len(core.разбить_на_фрагменты(текст))
+    assert целиком["openai"]["токенов"] > оценка["openai"]["токенов"]
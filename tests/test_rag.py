@@ -0,0 +1,210 @@
+"""RAG-сличение: набор правил, однопроходный сканер, ограничение охвата — против прямого re.search."""
+
+import re
+
+import core as движок
+from conftest import случайный_договор
+
+
+def эталон_нарушений(текст: str, тф: dict):
+    # Прежний анализ: каждый паттерн компилируется и ищется по всему тексту заново
+    нарушения = []
+    текст_l = текст.lower()
+    for название, данные in тф.get("пункты", {}).items():
+        try:
+            match = re.search(данные.get("паттерн", ""), текст_l, re.IGNORECASE | re.DOTALL) if данные.get("паттерн") else None
+        except re.error:
+            continue
+        if match:
+            пункт = re.search(r'(\d+\.\d+)', текст[max(0, match.start() - 100):match.start()])
+            контекст = текст[max(0, match.start() - 50):min(len(текст), match.end() + 80)].replace('\n', ' ').strip()
+            нарушения.append({"название": название, "эталон": данные.get("эталон", ""),
+                              "критичность": данные.get("критичность", "жёлтый"),
+                              "пункт": пункт.group(1) if пункт else None, "контекст": f"...{контекст}..."})
+    return нарушения
+
+
+СВОИ_ФОРМЫ = {"своя": {"название": "Своя форма", "пункты": {
+    "аванс": {"паттерн": r"аванс\s+\d+", "эталон": "Без аванса", "критичность": "красный"},
+    "сломан": {"паттерн": r"(", "эталон": "", "критичность": "жёлтый"},
+    "пустой": {"паттерн": "", "эталон": "", "критичность": "жёлтый"},
+}}}
+
+
+def test_набор_правил_один_на_содержимое():
+    assert движок.набор_правил() is движок.набор_правил()
+    набор = движок.набор_правил(СВОИ_ФОРМЫ)
+    assert набор is not движок.набор_правил()
+    assert набор.версия != движок.набор_правил().версия
+    assert [п["название"] for п in набор.формы["своя"]["правила"]] == ["аванс"]
+    assert [о["название"] for о in набор.ошибки] == ["сломан"]
+    assert движок.набор_правил({**СВОИ_ФОРМЫ}) is набор
+
+
+def test_реестр_вытесняет_старые_наборы():
+    реестр = движок.РеестрПравил(макс_наборов=2)
+    первый = реестр.получить({"а": {"пункты": {}}})
+    реестр.получить({"б": {"пункты": {}}})
+    реестр.получить({"а": {"пункты": {}}})
+    реестр.получить({"в": {"пункты": {}}})
+    assert реестр.получить({"а": {"пункты": {}}}) is первый
+    # Вытеснен б — вернувшись, он получает новую версию
+    assert реестр.получить({"б": {"пункты": {}}}).версия == 4
+
+
+def test_анализ_как_прежний():
+    тексты = [движок.ДЕМО_ДОГОВОР, движок.ДЕМО_ДОГОВОР.upper(), "", "Аванс 100 000 руб.\n4.1. Штраф"]
+    набор = движок.набор_правил(СВОИ_ФОРМЫ)
+    все_тф = {**движок.ТИПОВЫЕ_ФОРМЫ, **СВОИ_ФОРМЫ}
+    for текст in тексты:
+        for код, тф in все_тф.items():
+            результат = движок.анализ_rag(текст, код, набор)
+            assert результат["нарушения"] == эталон_нарушений(текст, тф)
+            assert результат["версия_правил"] == набор.версия
+
+
+def test_сканер_совпадает_с_search(rnd):
+    правила = движок.набор_правил()
+    тексты = [движок.ДЕМО_ДОГОВОР, движок.ДЕМО_ДОГОВОР.upper(), ""] + [
+        случайный_договор(rnd, rnd.choice([1500, 8000]), с_нарушениями=rnd.random() < 0.5) for _ in range(30)]
+    for текст in тексты:
+        текст_l = текст.lower()
+        for форма in правила.формы.values():
+            позиции = форма["сканер"].позиции(текст_l)
+            for правило in форма["правила"]:
+                найдено = движок.найти_правило(правило, текст_l, позиции)
+                ожидается = правило["regex"].search(текст_l)
+                assert (найдено and найдено.span()) == (ожидается and ожидается.span()), правило["название"]
+
+
+def test_якоря_перекрываются():
+    # «оплат» внутри «предоплат»: кандидаты обоих якорей восстанавливаются из одного прохода
+    правила = [{"название": н, "якоря": движок.якоря_паттерна(п), "regex": None} for н, п in
+               (("а", r"предоплат"), ("б", r"оплат\w*"), ("в", r"(?:опл|предопл)ата"))]
+    сканер = движок.СканерЯкорей(правила)
+    текст = "предоплата и оплата, снова предоплата"
+    позиции = сканер.позиции(текст)
+    for правило in правила:
+        for якорь in правило["якоря"]:
+            assert позиции[якорь] == [i for i in range(len(текст)) if текст.startswith(якорь, i)]
+
+
+def test_без_якорей_и_особые_регистры():
+    # Паттерн без литерального префикса и текст с символами, которые IGNORECASE сопоставляет особо
+    правило = {"название": "класс", "якоря": движок.якоря_паттерна(r"[0-9]+\s*%"), "regex": re.compile(r"[0-9]+\s*%")}
+    assert правило["якоря"] is None
+    assert движок.найти_правило(правило, "неустойка 5 %", {}).span() == (10, 13)
+    правило = {"название": "штраф", "якоря": {"штраф"}, "regex": re.compile("штраф", re.IGNORECASE)}
+    сканер = движок.СканерЯкорей([правило])
+    assert сканер.позиции("штраф") == {"штраф": [0]}
+    # «ᲄ» под IGNORECASE совпадает с «т», а lower() его не меняет — нужен полный поиск
+    текст = "ш\u1c84раф"
+    assert сканер.позиции(текст) is None
+    assert движок.найти_правило(правило, текст, сканер.позиции(текст)).span() == (0, 5)
+
+
+def _первое_в_охвате(regex, текст_l, охват, границы=None):
+    # Эталон ограниченного поиска: первое по началу совпадение, не выходящее за охват и пункт
+    for p in range(len(текст_l) + 1):
+        конец = min(len(текст_l), p + охват)
+        if границы:
+            конец = min([конец] + [г for г in границы if г > p])
+        match = regex.match(текст_l, p, конец)
+        if match:
+            return match
+    return None
+
+
+def test_ограниченный_поиск_как_перебор(rnd):
+    правила = движок.набор_правил()
+    без_якорей = {"название": "без якорей", "якоря": None, "regex": re.compile(r"(?:\d+\s*)?рубл.{0,300}?день")}
+    for _ in range(6):
+        текст_l = случайный_договор(rnd, 3000, с_нарушениями=True).lower()
+        границы = движок.лексемы(текст_l).начала("граница") if rnd.random() < 0.5 else None
+        охват = rnd.choice([40, 200, 2000])
+        позиции = правила.формы["услуги_тэо"]["сканер"].позиции(текст_l)
+        for правило in правила.формы["услуги_тэо"]["правила"] + [без_якорей]:
+            найдено = движок.найти_правило(правило, текст_l, позиции, охват, границы)
+            ожидается = _первое_в_охвате(правило["regex"], текст_l, охват, границы)
+            assert (найдено and найдено.span()) == (ожидается and ожидается.span()), правило["название"]
+
+
+def test_бюджет_правила_прерывает_поиск():
+    результат = движок.анализ_rag(движок.ДЕМО_ДОГОВОР, "услуги_тэо", движок.набор_правил(), бюджет_мс=1e-6)
+    превышено = {п["название"] for п in результат["превышен_бюджет"]}
+    assert превышено
+    assert not превышено & {н["название"] for н in результат["нарушения"]}
+    # Непроверенные правила не засчитываются как пройденные
+    assert результат["неполный"]
+    assert результат["вердикт"] in ("НЕ_ЗАВЕРШЁН", "НЕ_СООТВЕТСТВУЕТ")
+    assert результат["вердикт"] != "НЕ_ЗАВЕРШЁН" or "не проверено" in результат["резюме"]
+
+
+def test_непроверенное_правило_не_даёт_соответствия(monkeypatch):
+    # Нарушений нет, но одно правило не уложилось в бюджет — «соответствует» выносить нельзя
+    найти = движок.найти_правило
+
+    def найти_правило(правило, *args, **kwargs):
+        if правило["название"] == движок.набор_правил().формы["услуги_тэо"]["правила"][0]["название"]:
+            raise движок.ПревышенБюджетПравила()
+        return найти(правило, *args, **kwargs)
+
+    assert движок.анализ_rag("Договор оказания услуг.", "услуги_тэо")["вердикт"] == "СООТВЕТСТВУЕТ"
+    monkeypatch.setattr(движок, "найти_правило", найти_правило)
+    результат = движок.анализ_rag("Договор оказания услуг.", "услуги_тэо", бюджет_мс=500)
+    assert результат["неполный"] and результат["вердикт"] == "НЕ_ЗАВЕРШЁН"
+    assert "1 правил(а) не проверено" in результат["резюме"]
+
+
+def test_окна_совпадают_с_целым_текстом(rnd):
+    for _ in range(40):
+        текст = случайный_договор(rnd, rnd.choice([8000, 40000]), с_нарушениями=rnd.random() < 0.7)
+        параметры = {"макс_охват": движок.ОХВАТ_ПРАВИЛА, "в_пределах_пункта": rnd.random() < 0.4}
+        весь = движок.анализ_rag(текст, "услуги_тэо", окно=None, **параметры)
+        по_окнам = движок.анализ_rag(текст, "услуги_тэо", окно=3000, **параметры)
+        assert по_окнам["нарушения"] == весь["нарушения"]
+        assert по_окнам["вердикт"] == весь["вердикт"]
+
+
+def test_окна_текста_покрывают_текст():
+    текст = "".join(chr(ord("а") + i % 32) for i in range(10_007))
+    ядра = []
+    for сдвиг, кусок, начало, конец in движок.окна_текста(текст, 1000, 50):
+        assert текст[сдвиг:сдвиг + len(кусок)] == кусок
+        assert сдвиг <= начало and сдвиг + len(кусок) >= min(len(текст), конец + 50)
+        ядра.append((начало, конец))
+    assert ядра[0][0] == 0 and ядра[-1][1] == len(текст)
+    assert all(a[1] == b[0] for a, b in zip(ядра, ядра[1:]))
+
+
+def test_длинный_текст_без_охвата_ограничен(rnd):
+    # Вызов без макс_охват для текста длиннее окна идёт по окнам с ОХВАТ_ПРАВИЛА
+    текст = случайный_договор(rnd, 40000, с_нарушениями=True)
+    по_окнам = движок.анализ_rag(текст, "услуги_тэо", окно=3000)
+    assert по_окнам["нарушения"] == \
+        движок.анализ_rag(текст, "услуги_тэо", макс_охват=движок.ОХВАТ_ПРАВИЛА, окно=None)["нарушения"]
+    assert (по_окнам["охват"], по_окнам["по_окнам"]) == (движок.ОХВАТ_ПРАВИЛА, True)
+    целиком = движок.анализ_rag(текст, "услуги_тэо", окно=None)
+    assert (целиком["охват"], целиком["по_окнам"]) == (None, False)
+    # Совпадение длиннее охвата находится только без ограничения
+    правило = {"паттерн": r"начало.{3000,}?конец", "эталон": "", "критичность": "жёлтый"}
+    набор = движок.набор_правил({"длинная": {"название": "Длинная", "пункты": {"длинное": правило}}})
+    длинный = "начало " + "а" * 3500 + " конец" + текст
+    assert движок.анализ_rag(длинный, "длинная", набор, окно=None)["нарушения"]
+    assert not движок.анализ_rag(длинный, "длинная", набор, окно=3000)["нарушения"]
+
+
+def test_пересчёт_изменений_как_полный_анализ(rnd):
+    # Повторно присланный договор: правки в нескольких пунктах, набор нарушений — как при полном анализе
+    for _ in range(20):
+        прежний = случайный_договор(rnd, rnd.choice([3000, 12000]), с_нарушениями=True)
+        прежний_rag = движок.анализ_rag(прежний, "услуги_тэо")
+        строки = прежний.split("\n")
+        for _ in range(rnd.randint(1, 3)):
+            i = rnd.randrange(len(строки))
+            строки[i] = rnd.choice(["", строки[rnd.randrange(len(строки))], "Аванс 30% в течение 5 дней"])
+        текст = "\n".join(строки)
+        полный = движок.анализ_rag(текст, "услуги_тэо")
+        частичный = движок.анализ_rag_изменений(текст, прежний, прежний_rag, "услуги_тэо")
+        assert {н["название"] for н in частичный["нарушения"]} == {н["название"] for н in полный["нарушения"]}
+        assert частичный["вердикт"] == полный["вердикт"]
@@ -0,0 +1,105 @@
+"""Планировщик AI-провайдеров: хедж медленного запроса, переход при ошибке, предохранитель."""
+
+import time
+
+import pytest
+
+import core
+
+
+@pytest.fixture
+def планировщик(monkeypatch):
+    планировщик = core.ПланировщикAI()
+    monkeypatch.setattr(core, "планировщик_ai", lambda: планировщик)
+    return планировщик
+
+
+@pytest.fixture
+def провайдеры(monkeypatch):
+    # Поддельные провайдеры: задержка до первого куска или ошибка, по имени
+    поведение = {}
+
+    def поток_провайдера(провайдер, ключ, промпт, yandex_folder="", **_):
+        задержка, ошибка = поведение[провайдер]
+        time.sleep(задержка)
+        if ошибка:
+            raise core.ОшибкаAI(ошибка)
+        yield f"{провайдер}: "
+        yield "ответ"
+
+    monkeypatch.setattr(core, "поток_провайдера", поток_провайдера)
+    return поведение
+
+
+КЛЮЧИ = {"openai": "k", "anthropic": "k"}
+
+
+def test_хедж_медленного_провайдера(планировщик, провайдеры):
+    провайдеры.update({"openai": (1.0, None), "anthropic": (0.0, None)})
+    начало = time.perf_counter()
+    ответ = "".join(core.поток_ai("промпт", КЛЮЧИ, с_кэшем=False, задержка_хеджа=0.05))
+    assert ответ == "anthropic: ответ"
+    assert time.perf_counter() - начало < 0.9
+    assert (планировщик.хеджей, планировщик.побед_хеджа) == (1, 1)
+    # Проигравший отменён и не считается ни успехом, ни ошибкой
+    time.sleep(1.1)
+    assert "openai" not in планировщик.состояние()
+
+
+def test_без_хеджа_ждёт_первого(планировщик, провайдеры):
+    провайдеры.update({"openai": (0.2, None), "anthropic": (0.0, None)})
+    ответ = "".join(core.поток_ai("промпт", КЛЮЧИ, с_кэшем=False, хедж=False))
+    assert ответ == "openai: ответ"
+    assert планировщик.хеджей == 0
+
+
+def test_ошибка_до_первого_куска_переходит_дальше(планировщик, провайдеры):
+    провайдеры.update({"openai": (0.0, "HTTP 503"), "anthropic": (0.0, None)})
+    assert "".join(core.поток_ai("промпт", КЛЮЧИ, с_кэшем=False)) == "anthropic: ответ"
+    состояние = планировщик.состояние()
+    assert состояние["openai"]["доля_ошибок"] == 1.0
+    assert состояние["anthropic"]["доля_ошибок"] == 0.0
+    # Дальше первым идёт здоровый провайдер
+    assert планировщик.порядок(["openai", "anthropic"]) == ["anthropic", "openai"]
+
+    провайдеры["anthropic"] = (0.0, "HTTP 500")
+    with pytest.raises(core.ОшибкаAI, match="500.*503"):
+        "".join(core.поток_ai("промпт", КЛЮЧИ, с_кэшем=False))
+
+
+def test_предохранитель(планировщик, monkeypatch):
+    часы = [100.0]
+    monkeypatch.setattr(core.time, "monotonic", lambda: часы[0])
+    for _ in range(core.AI_ПРЕДОХРАНИТЕЛЬ_ОШИБОК):
+        assert планировщик.занять("openai")
+        планировщик.учесть("openai", False)
+    assert not планировщик.занять("openai")
+    assert планировщик.состояние()["openai"]["предохранитель"] == "открыт"
+    assert планировщик.порядок(["openai", "anthropic"]) == ["anthropic", "openai"]
+
+    часы[0] += core.AI_ПРЕДОХРАНИТЕЛЬ_С + 1
+    assert планировщик.занять("openai")           # один пробный запрос
+    assert not планировщик.занять("openai")
+    планировщик.отпустить("openai")               # проба отменена без результата
+    assert планировщик.занять("openai")
+    планировщик.учесть("openai", True, 120.0)
+    assert планировщик.состояние()["openai"]["предохранитель"] == "закрыт"
+    assert планировщик.занять("openai") and планировщик.занять("openai")
+
+
+def test_задержка_хеджа_по_p95(планировщик):
+    assert планировщик.задержка_хеджа("openai") == core.AI_ХЕДЖ_ПО_УМОЛЧАНИЮ_С
+    for ttft in (100, 200, 300, 400, 2000):
+        планировщик.учесть("openai", True, ttft)
+    assert планировщик.задержка_хеджа("openai") == 2.0
+    for _ in range(5):
+        планировщик.учесть("anthropic", True, 10)
+    assert планировщик.задержка_хеджа("anthropic") == core.AI_ХЕДЖ_МИН_С
+
+
+def test_без_folder_id_yandex_пропускается():
+    assert core.провайдеры_с_ключами({"yandexgpt": "k", "openai": "k"}) == ["openai"]
+    with pytest.raises(core.ОшибкаAI, match="Folder ID"):
+        core.провайдеры_с_ключами({"yandexgpt": "k"})
+    with pytest.raises(core.ОшибкаAI, match="Не настроен"):
+        core.провайдеры_с_ключами({})
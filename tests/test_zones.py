@@ -0,0 +1,60 @@
+"""Зоны реестра сделок и симулятор порогов — против построчного определить_зону."""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import bench
+import core
+
+ПОРОГИ = [
+    None,
+    {"зелёная_тф_макс": 250_000, "зелёная_нетф_макс": 10_000, "жёлтая_макс": 1_000_000},
+    {"зелёная_тф_макс": 5_000_000, "зелёная_нетф_макс": 5_000_000, "жёлтая_макс": 5_000_000},
+]
+
+
+def _реестр(строк=3000):
+    сделки = bench.синтетический_реестр(строк, seed=7)
+    # Суммы ровно на порогах, NaN, неизвестные тип и форма
+    на_порогах = [50_000, 100_000, 5_000_000, 10_000, 250_000, 1_000_000, float("nan"), 0]
+    краевые = pd.DataFrame(list(itertools.product(
+        на_порогах, core.ФОРМЫ_ДОКУМЕНТА + ["Прочее"], ["", None, "нет такого"] + core.КРАСНАЯ_ЗОНА[:1] + core.ЖЁЛТАЯ_ЗОНА[:1],
+    )), columns=["сумма", "форма", "тип_сделки"])
+    return pd.concat([сделки, краевые], ignore_index=True)
+
+
+def _построчно(сделки, пороги):
+    return [core.определить_зону(с.сумма, с.форма, с.тип_сделки, пороги) for с in сделки.itertuples(index=False)]
+
+
+def test_зоны_как_построчно():
+    сделки = _реестр()
+    for пороги in ПОРОГИ:
+        зоны = core.определить_зоны(сделки, пороги)
+        assert list(зоны.index) == list(сделки.index)
+        получено = list(zip(зоны["зона"].astype(str), зоны["причина"].astype(str),
+                            зоны["юд"].astype(bool), зоны["срок"].astype(int)))
+        ожидается = [(з["зона"], з["причина"], з["юд"], з["срок"]) for з in _построчно(сделки, пороги)]
+        assert получено == ожидается
+
+
+def test_пустой_реестр():
+    сделки = pd.DataFrame({"сумма": pd.Series([], dtype=float), "форма": [], "тип_сделки": []})
+    assert len(core.определить_зоны(сделки)) == 0
+    assert core.СимуляторПорогов(сделки).сравнить(None, ПОРОГИ[1])["сделок"] == 0
+
+
+def test_симулятор_как_перебор():
+    сделки = _реестр()
+    симулятор = core.СимуляторПорогов(сделки)
+    for было, станет in itertools.product(ПОРОГИ, repeat=2):
+        матрица = np.zeros((3, 3), dtype=int)
+        for до, после in zip(_построчно(сделки, было), _построчно(сделки, станет)):
+            матрица[core.ЗОНЫ.index(до["зона"]), core.ЗОНЫ.index(после["зона"])] += 1
+        итог = симулятор.сравнить(было, станет)
+        assert итог["матрица"] == матрица.tolist()
+        assert итог["сменят_зону"] == int(матрица.sum() - матрица.trace())
+        assert итог["было"] == dict(zip(core.ЗОНЫ, матрица.sum(axis=1).tolist()))
+        assert итог["сделок"] == len(сделки)